@@ -1,10 +1,12 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import uuid
 from tastypie.authorization import Authorization
 from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
 
 from tutorons.core.models import ServerQuery, ClientQuery, Region, View
+from tutorons.core.dblogger import is_record_pending
 from tastypie import fields
 
 
@@ -18,13 +20,37 @@ class WriteOnlyMeta(object):
     list_allowed_methods = ['post']
 
 
+class PendingRecordMixin(object):
+    '''
+    Queries and regions may be waiting to be saved by a `DbLogWriter` when a client refers
+    to them.  With this mixin, a resource that the writer hasn't saved yet is referred to
+    by its UUID anyway, instead of failing to be found.  Resources that are neither saved
+    nor waiting to be saved still aren't found.
+    '''
+
+    def obj_get(self, bundle, **kwargs):
+        model = self._meta.object_class
+        pk = kwargs.get('pk')
+        if pk is not None:
+            try:
+                pk = uuid.UUID(pk)
+            except (TypeError, ValueError):
+                raise model.DoesNotExist("'%s' is not the id of a %s" % (
+                    pk, self._meta.resource_name))
+            # Records are only saved after they stop waiting, so a record that isn't
+            # waiting either has been saved already or doesn't exist.
+            if is_record_pending(model, pk):
+                return model(pk=pk)
+        return super(PendingRecordMixin, self).obj_get(bundle, **kwargs)
+
+
 '''
 ServerQueryResource and RegionResource are just specified so they can be used as foreign keys for
 ClientQueryResource and ViewResource.  There should not be a visible API to these resources.
 '''
 
 
-class ServerQueryResource(ModelResource):
+class ServerQueryResource(PendingRecordMixin, ModelResource):
 
     class Meta:
         queryset = ServerQuery.objects.all()
@@ -34,7 +60,7 @@ class ServerQueryResource(ModelResource):
         }
 
 
-class RegionResource(ModelResource):
+class RegionResource(PendingRecordMixin, ModelResource):
 
     class Meta:
         queryset = Region.objects.all()
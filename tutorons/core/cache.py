@@ -0,0 +1,320 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import time
+import threading
+import hashlib
+import functools
+from collections import OrderedDict
+
+from tutorons.core.extractor import Region
+from tutorons.core.metrics import Counters, counters
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def _count_one(value):
+    return 1
+
+
+class LruCache(object):
+    '''
+    In-process cache that evicts the least-recently used entries once the total
+    size of its entries exceeds `max_size`.  By default, every entry has a size
+    of 1; pass a `sizeof` function to measure entries some other way.
+    '''
+
+    def __init__(self, max_size, sizeof=_count_one):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, size = self._entries.pop(key)
+            self._entries[key] = (value, size)
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _get_django_cache(backend):
+    if isinstance(backend, basestring):
+        from django.core.cache import caches
+        return caches[backend]
+    return backend
+
+
+class ExtractionCache(object):
+    '''
+    Cache of the regions extracted from the text of nodes, to pass to a `NodeScanner`.
+
+    Results are stored under the identity of the extractor and a hash of the text it
+    read, so the same code found on many pages is only extracted once.  Extractors
+    should set a `version` attribute and change it whenever they start to extract
+    different regions from the same text.  The cache's own `version` is part of every
+    key too, so a module can ignore all of its old results at once.  Only the offsets
+    and string of each region are stored, along with the class and own attributes of
+    regions that have them.  On a hit, new regions of the same classes are made for the
+    node being scanned.  Those attributes must be picklable to share results through a
+    backend, and shouldn't refer to the node the region was found in.
+
+    Entries are kept in an in-process LRU cache of up to `max_entries` node results.
+    If a Django cache `backend` (a cache alias, like 'default', or a cache object) is
+    given, results are also shared through that cache with other processes, and kept
+    there for `timeout` seconds (or the backend's default timeout, if not given).
+    '''
+
+    def __init__(self, max_entries=10000, backend=None, timeout=None, version=''):
+        self.local_cache = LruCache(max_entries)
+        self.version = version
+        self.backend = backend
+        self.timeout = timeout
+        self.stats = Counters()
+
+    def get_key(self, extractor, node_name, text):
+        extractor_class = type(extractor)
+        identity = '\0'.join([
+            extractor_class.__module__ + '.' + extractor_class.__name__,
+            unicode(getattr(extractor, 'version', '')),
+            unicode(self.version),
+            node_name,
+            text,
+        ])
+        return 'tutorons:extraction:' + hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def _count(self, name):
+        self.stats.increment(name)
+        counters.increment('extraction_cache_' + name)
+
+    def get(self, key, node):
+        ''' Get the regions cached for a key as regions of `node`, or None if there are none. '''
+
+        spans = self.local_cache.get(key)
+        if spans is None and self.backend is not None:
+            spans = _get_django_cache(self.backend).get(key)
+            if spans is not None:
+                self._count('shared_hits')
+                self.local_cache.set(key, spans)
+
+        if spans is None:
+            self._count('misses')
+            return None
+
+        self._count('hits')
+        return [self._make_region(node, *span) for span in spans]
+
+    def _make_region(self, node, start, end, string, region_class=Region, attributes=None):
+        region = region_class.__new__(region_class)
+        Region.__init__(region, node, start, end, string)
+        if attributes:
+            region.__dict__.update(attributes)
+        return region
+
+    def _get_span(self, region):
+        span = (region.start_offset, region.end_offset, region.string)
+        attributes = getattr(region, '__dict__', None)
+        if type(region) is not Region or attributes:
+            span += (type(region), dict(attributes or {}))
+        return span
+
+    def set(self, key, regions):
+        spans = tuple(self._get_span(r) for r in regions)
+        self.local_cache.set(key, spans)
+        if self.backend is not None:
+            kwargs = {} if self.timeout is None else {'timeout': self.timeout}
+            _get_django_cache(self.backend).set(key, spans, **kwargs)
+
+
+class _Flight(object):
+    ''' An explanation being made by one thread, that other threads are waiting for. '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.explanation = None
+        self.failed = True
+
+
+class ExplanationCache(object):
+    '''
+    Cache of the explanations a module makes for the strings of regions, so that code
+    that is explained on many pages, or by many requests, only needs to be explained once.
+
+    Explanations are stored in a Django cache `backend` (a cache alias, like 'default', or
+    a cache object) under the name of the `module`, the `version` of its explainer, and
+    the string, for `timeout` seconds (or the backend's default timeout, if not given).
+    Change the version whenever the module starts to explain the same code differently.
+
+    When many requests need the same explanation at once, only one makes it.  Other
+    threads in this process wait for it, and other processes wait up to `lock_timeout`
+    seconds for it to show up in the cache before making it themselves.
+    '''
+
+    def __init__(self, module, version='', backend='default', timeout=None, lock_timeout=10,
+                 poll_interval=.05):
+        self.module = module
+        self.version = version
+        self.backend = backend
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.stats = Counters()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def get_key(self, string):
+        identity = '\0'.join([self.module, unicode(self.version), string])
+        return 'tutorons:explanation:' + hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def _count(self, name):
+        self.stats.increment(name)
+        counters.increment('explanation_cache_' + name)
+
+    def get_or_explain(self, string, explain):
+        ''' Get the explanation of a string from the cache, or make it with `explain(string)`. '''
+
+        # Explanations are stored in a tuple, so that an explanation of None can be cached.
+        cache = _get_django_cache(self.backend)
+        key = self.get_key(string)
+        entry = cache.get(key)
+        if entry is not None:
+            self._count('hits')
+            return entry[0]
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = _Flight()
+
+        if not leading:
+            flight.done.wait()
+            if not flight.failed:
+                self._count('waits')
+                return flight.explanation
+            return self._explain(cache, key, string, explain)
+
+        try:
+            flight.explanation = self._explain_once(cache, key, string, explain)
+            flight.failed = False
+            return flight.explanation
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _explain_once(self, cache, key, string, explain):
+
+        # Another thread may have saved the explanation and landed its flight since we
+        # last looked in the cache.
+        entry = cache.get(key)
+        if entry is not None:
+            self._count('hits')
+            return entry[0]
+
+        # Only the process that adds the lock makes the explanation.  If another process
+        # has the lock, wait for its explanation, unless it takes too long.
+        lock_key = key + ':lock'
+        if not cache.add(lock_key, True, self.lock_timeout):
+            give_up_time = time.time() + self.lock_timeout
+            while time.time() < give_up_time:
+                time.sleep(self.poll_interval)
+                entry = cache.get(key)
+                if entry is not None:
+                    self._count('waits')
+                    return entry[0]
+            return self._explain(cache, key, string, explain)
+
+        try:
+            return self._explain(cache, key, string, explain)
+        finally:
+            cache.delete(lock_key)
+
+    def _explain(self, cache, key, string, explain):
+        self._count('misses')
+        explanation = explain(string)
+        kwargs = {} if self.timeout is None else {'timeout': self.timeout}
+        cache.set(key, (explanation,), **kwargs)
+        return explanation
+
+    def memoize(self, explain):
+        ''' Decorate a function from a string to its explanation, to look it up in this cache. '''
+
+        @functools.wraps(explain)
+        def wrapper(string):
+            return self.get_or_explain(string, explain)
+
+        wrapper.cache = self
+        return wrapper
+
+
+class ScanResultCache(object):
+    '''
+    Cache of the results of scanning whole documents, for a 'scan' view to respond with
+    when a page it has scanned before is sent again.  A module's results only depend on
+    the document, so results are stored under a tag made from the name of the `module`,
+    the `version` of its scanner and explainer, and a hash of the document's content.
+    Views send the tag as an ETag, so clients can ask whether a page's results changed
+    (see `pagescan`).
+    Change the version whenever the module starts to find or explain code differently.
+
+    Results are stored in a Django cache `backend` (a cache alias, like 'default', or a
+    cache object) for `timeout` seconds (or the backend's default timeout, if not given).
+    '''
+
+    def __init__(self, module, version='', backend='default', timeout=None):
+        self.module = module
+        self.version = version
+        self.backend = backend
+        self.timeout = timeout
+        self.stats = Counters()
+
+    def get_tag(self, document):
+        identity = '\0'.join([self.module, unicode(self.version), document])
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def get_key(self, tag):
+        return 'tutorons:scan:' + tag
+
+    def _count(self, name):
+        self.stats.increment(name)
+        counters.increment('scan_result_cache_' + name)
+
+    def get(self, tag):
+        ''' Get the results stored under a tag, or None if there aren't any. '''
+        results = _get_django_cache(self.backend).get(self.get_key(tag))
+        self._count('hits' if results is not None else 'misses')
+        return results
+
+    def set(self, tag, results):
+        kwargs = {} if self.timeout is None else {'timeout': self.timeout}
+        _get_django_cache(self.backend).set(self.get_key(tag), results, **kwargs)
@@ -3,14 +3,27 @@
 
 from __future__ import unicode_literals
 import logging
+import time
+import atexit
+import threading
+import Queue
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
 
-from tutorons.core.models import Block, ServerQuery
+from tutorons.core.models import Block, ServerQuery, Region
 from tutorons.core.htmltools import get_css_selector
-import datetime
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_QUEUE_SIZE = 10000
+
+# Block hashes are looked up in chunks, to stay under SQLite's limit on query parameters
+BLOCK_LOOKUP_CHUNK_SIZE = 500
+
 
 def _get_request_metadata(request):
     url = request.POST.get('origin')
@@ -21,33 +34,272 @@ def _get_request_metadata(request):
     return url, path, ip
 
 
+def _get_or_create_blocks(block_keys):
+    '''
+    Get a Block for each (url, block_type, block_hash) key, creating the ones that don't
+    exist yet.  Returns a dictionary from each key to its Block.
+    '''
+    block_keys = set(block_keys)
+    hashes_by_url = {}
+    for url, _, block_hash in block_keys:
+        hashes_by_url.setdefault(url, set()).add(block_hash)
+
+    blocks = {}
+
+    def fetch_blocks():
+        for url, hashes in hashes_by_url.items():
+            hashes = sorted(hashes)
+            for i in range(0, len(hashes), BLOCK_LOOKUP_CHUNK_SIZE):
+                chunk = hashes[i:i + BLOCK_LOOKUP_CHUNK_SIZE]
+                for block in Block.objects.filter(url=url, block_hash__in=chunk):
+                    key = (block.url, block.block_type, block.block_hash)
+                    if key in block_keys and key not in blocks:
+                        blocks[key] = block
+
+    fetch_blocks()
+    missing_keys = [k for k in block_keys if k not in blocks]
+    if missing_keys:
+        Block.objects.bulk_create([
+            Block(url=url, block_type=block_type, block_hash=block_hash)
+            for url, block_type, block_hash in missing_keys
+        ])
+        # bulk_create doesn't set the ids of the blocks it creates on all databases
+        fetch_blocks()
+    return blocks
+
+
+def get_region_record_fields(region_record):
+    '''
+    Get the fields of a record made with `DbLogger.make_region_record` that don't depend
+    on its query or the page it was found on, to log copies of it later on with
+    `DbLogger.copy_region_record`.
+    '''
+    _, block_type, block_hash = region_record.block_key
+    return {
+        'node': region_record.node,
+        'start': region_record.start,
+        'end': region_record.end,
+        'string': region_record.string,
+        'region_type': region_record.region_type,
+        'region_method': region_record.region_method,
+        'block_type': block_type,
+        'block_hash': block_hash,
+    }
+
+
+def _save_region_records(region_records):
+    '''
+    Save records of regions, each with a `block_key`, in one transaction.  Their blocks
+    are found or created first, so that each record can refer to its block.
+    '''
+    if not region_records:
+        return
+    with transaction.atomic():
+        blocks = _get_or_create_blocks(r.block_key for r in region_records)
+        for r in region_records:
+            r.block = blocks[r.block_key]
+        Region.objects.bulk_create(region_records)
+
+
+# Markers that tell the writer thread to save what it has, or to save it and stop
+_FLUSH = object()
+_STOP = object()
+
+
+class DbLogWriter(object):
+    '''
+    Saves log records to the database in a background thread, so that requests don't
+    wait for them to be saved.  Records are saved with `bulk_create` in batches of up to
+    `batch_size` records, and no later than `flush_interval` seconds after they are put.
+    If more than `max_queue_size` records are waiting, `put` waits for room in the queue.
+
+    Records are unsaved `ServerQuery` and `Region` models.  Regions should have a
+    `block_key` attribute with the (url, block_type, block_hash) of their block.  Their
+    blocks are found or created when they are saved.
+    '''
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_queue_size=DEFAULT_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = Queue.Queue(max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        # The (model, id) of every record that has been put and not saved yet
+        self._pending_keys = set()
+        self._pending_lock = threading.Lock()
+
+    def start(self):
+        ''' Start the writer thread, if it isn't running. '''
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='DbLogWriter')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def reserve(self, records):
+        '''
+        Mark records as pending before they are put, so that clients can refer to them
+        while they're still being made.  Records that are reserved should be put later,
+        or they stay pending.
+        '''
+        with self._pending_lock:
+            self._pending_keys.update((type(r), r.pk) for r in records)
+
+    def put(self, records):
+        ''' Queue records to be saved. '''
+        self.start()
+        self.reserve(records)
+        for record in records:
+            self._queue.put(record)
+
+    def is_pending(self, model, pk):
+        ''' Check whether a record with this model and id has been put and not saved yet. '''
+        with self._pending_lock:
+            return (model, pk) in self._pending_keys
+
+    def flush(self):
+        ''' Save all records that have been put, and wait until they are saved. '''
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def close(self):
+        ''' Save all records that have been put, and stop the writer thread. '''
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+
+                # Wait for a first record, and then collect records until the batch is
+                # full, the flush interval passes, or the writer is told to save them.
+                batch = []
+                markers = 0
+                flush_time = None
+                while len(batch) < self.batch_size:
+                    timeout = None if flush_time is None else flush_time - time.time()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    try:
+                        record = self._queue.get(timeout=timeout)
+                    except Queue.Empty:
+                        break
+                    if record is _FLUSH or record is _STOP:
+                        markers += 1
+                        stopping = record is _STOP
+                        break
+                    batch.append(record)
+                    if flush_time is None:
+                        flush_time = time.time() + self.flush_interval
+
+                try:
+                    self._write(batch)
+                except Exception:
+                    logging.exception("Failed to save %d log records", len(batch))
+                with self._pending_lock:
+                    self._pending_keys.difference_update((type(r), r.pk) for r in batch)
+                for _ in range(len(batch) + markers):
+                    self._queue.task_done()
+        finally:
+            connection.close()
+
+    def _write(self, records):
+
+        queries = [r for r in records if isinstance(r, ServerQuery)]
+        regions = [r for r in records if isinstance(r, Region)]
+
+        with transaction.atomic():
+            ServerQuery.objects.bulk_create(queries)
+            _save_region_records(regions)
+
+
+_db_log_writer = None
+_db_log_writer_lock = threading.Lock()
+
+
+def get_db_log_writer():
+    '''
+    Get the writer shared by all loggers in this process, configured with the
+    DB_LOG_BATCH_SIZE and DB_LOG_FLUSH_INTERVAL settings.  Records it holds when
+    the process exits are saved before it exits.
+    '''
+    global _db_log_writer
+    with _db_log_writer_lock:
+        if _db_log_writer is None:
+            _db_log_writer = DbLogWriter(
+                batch_size=getattr(settings, 'DB_LOG_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                flush_interval=getattr(settings, 'DB_LOG_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+            )
+            atexit.register(_db_log_writer.close)
+        return _db_log_writer
+
+
+def is_record_pending(model, pk):
+    '''
+    Check whether a record is waiting to be saved by the writer shared by all loggers.
+    Records are never pending if the DB_LOG_ASYNC setting is false.
+    '''
+    if not getattr(settings, 'DB_LOG_ASYNC', False):
+        return False
+    return get_db_log_writer().is_pending(model, pk)
+
+
 class DbLogger(object):
+    '''
+    Logs queries and the regions found for them to the database.
+
+    If a `writer` (a `DbLogWriter`) is given, or the DB_LOG_ASYNC setting is true,
+    records are saved in the background instead of while handling the request.  The
+    records of a query are handed to the writer when `update_server_end_time` is called,
+    but are pending (see `is_record_pending`) from the time they are made.  Either way,
+    the ids of queries and regions can be sent to clients as soon as they are made.
+    '''
+
+    def __init__(self, writer=None):
+        if writer is None and getattr(settings, 'DB_LOG_ASYNC', False):
+            writer = get_db_log_writer()
+        self.writer = writer
+        self._pending_records = []
 
     def log_query(self, request):
         _, path, ip = _get_request_metadata(request)
+        if self.writer is not None:
+            query = ServerQuery(ip_addr=ip, path=path)
+            self.writer.reserve([query])
+            return query
         query = ServerQuery.objects.create(ip_addr=ip, path=path)
         return query
 
     def log_region(self, request, query, region):
+        return self.log_regions(request, query, [region])[0]
 
+    def log_regions(self, request, query, regions):
+        '''
+        Log all of the regions found for a query at once.  The blocks of the regions are
+        looked up with one query, the missing blocks are created with one insert, and the
+        regions are saved with one insert, all in one transaction.  Returns the records of
+        the regions, in the same order as the regions.
+        '''
+        region_records = [self.make_region_record(request, query, r) for r in regions]
+        self.save_region_records(region_records)
+        return region_records
+
+    def make_region_record(self, request, query, region):
+        '''
+        Make a record of a region without saving it.  The record already has its id, so it
+        can be sent to the client before it is saved with `save_region_records`.
+        '''
         url, path, ip = _get_request_metadata(request)
         region_type, request_method = request.path_info.split('/')[0:2]
-        block_hash = hash(region.node)
-        block_type = region.node.name
-
-        # Make a record for the block of text that is being explained
-        block, created = Block.objects.get_or_create(
-            url=url,
-            block_type=block_type,
-            block_hash=block_hash
-        )
-        if created:
-            block.block_test = region.node
-            block.save()
-
-        # Create and save a new region
-        region = query.region_set.create(
-            block=block,
+        region_record = Region(
+            query=query,
             node=get_css_selector(region.node),
             start=region.start_offset,
             end=region.end_offset,
@@ -55,8 +307,38 @@ class DbLogger(object):
             region_type=region_type,
             region_method=request_method
         )
-        return region
+        # Regions are saved with a record of the block of text they were found in
+        region_record.block_key = (url, region.node.name, hash(region.node))
+        if self.writer is not None:
+            self.writer.reserve([region_record])
+        return region_record
+
+    def copy_region_record(self, request, query, fields):
+        '''
+        Make a record of a region that was found before, from the fields returned by
+        `get_region_record_fields`, for a new query.  Like `make_region_record`, it isn't saved.
+        '''
+        url, _, _ = _get_request_metadata(request)
+        fields = dict(fields)
+        block_type = fields.pop('block_type')
+        block_hash = fields.pop('block_hash')
+        region_record = Region(query=query, **fields)
+        region_record.block_key = (url, block_type, block_hash)
+        if self.writer is not None:
+            self.writer.reserve([region_record])
+        return region_record
+
+    def save_region_records(self, region_records):
+        ''' Save records made with `make_region_record`, all at once (see `log_regions`). '''
+        if self.writer is not None:
+            self._pending_records.extend(region_records)
+        else:
+            _save_region_records(region_records)
 
     def update_server_end_time(self, query):
-        query.end_time = datetime.datetime.now()
-        query.save()
+        query.end_time = timezone.now()
+        if self.writer is not None:
+            self.writer.put([query] + self._pending_records)
+            self._pending_records = []
+        else:
+            query.save()
@@ -4,6 +4,11 @@
 from __future__ import unicode_literals
 import logging
 import re
+import hashlib
+import threading
+import contextlib
+from array import array
+from collections import deque
 from slimit.lexer import Lexer as JsLexer
 import copy
 
@@ -22,7 +27,12 @@ class Region(object):
     * start_offset: character index where the region begins
     * end_offset: character index where the region ends
     * string: text of the region
+
+    Subclasses and callers can add attributes of their own.  They're kept in a `__dict__`
+    that is only made once one is set, so plain regions stay small.
     '''
+    __slots__ = ['node', 'start_offset', 'end_offset', 'string', '__dict__']
+
     def __init__(self, node, start_offset, end_offset, string):
         self.node = node
         self.start_offset = start_offset
@@ -37,46 +47,529 @@ class Region(object):
         return str(self)
 
 
+class RegionSet(object):
+    '''
+    Compact collection of regions from one document.  Offsets are stored in arrays, and
+    nodes as their positions in the `tags` of the document's `TreeIndex`, so that regions
+    don't need an object each while they are stored.  Nodes that aren't in the index
+    are stored in a separate table.
+
+    Regions that are instances of a subclass of `Region`, or that have attributes of
+    their own, are stored as they are.  For the others, a new `Region` is made the first
+    time each is read, and kept, so reading a region again gives the same object, and
+    changes made to it are kept.  Sets made from this one (by slicing, `ordered`,
+    `filter`, or `deduplicate`) share the objects that have been made so far.  Sets are
+    ordered and deduplicated by the nodes, offsets, and strings that the regions were
+    added with, though, so don't change those to reorder regions.
+
+    Iterating over a set yields regions in the order they were added.  Sets can be
+    indexed, sliced, added to lists and other sets, and compared to lists like lists.
+    Slices and sums that start with a set are `RegionSet`s.
+    '''
+
+    def __init__(self, index=None, regions=()):
+        self.index = index
+        self._starts = array(str('i'))
+        self._ends = array(str('i'))
+        self._node_ids = array(str('i'))
+        self._strings = []
+        self._regions = []
+        self._other_nodes = []
+        self._other_node_ids = {}
+        self.extend(regions)
+
+    def add(self, node, start_offset, end_offset, string):
+        self._starts.append(start_offset)
+        self._ends.append(end_offset)
+        self._node_ids.append(self._get_node_id(node))
+        self._strings.append(string)
+        self._regions.append(None)
+
+    def append(self, region):
+        self.add(region.node, region.start_offset, region.end_offset, region.string)
+        if type(region) is not Region or getattr(region, '__dict__', None):
+            self._regions[-1] = region
+
+    def extend(self, regions):
+        for region in regions:
+            self.append(region)
+
+    def _get_node_id(self, node):
+        # Nodes in the index get non-negative IDs, and all other nodes get negative IDs.
+        position = self.index.get_position(node) if self.index is not None else None
+        if position is not None:
+            return position
+        if id(node) not in self._other_node_ids:
+            self._other_node_ids[id(node)] = -1 - len(self._other_nodes)
+            self._other_nodes.append(node)
+        return self._other_node_ids[id(node)]
+
+    def _get_node(self, node_id):
+        return self.index.tags[node_id] if node_id >= 0 else self._other_nodes[-1 - node_id]
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._select(range(len(self))[i])
+        region = self._regions[i]
+        if region is None:
+            region = self._regions[i] = Region(
+                self._get_node(self._node_ids[i]), self._starts[i], self._ends[i],
+                self._strings[i])
+        return region
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __add__(self, other):
+        combined = self._select(range(len(self)))
+        combined._other_nodes = list(self._other_nodes)
+        combined._other_node_ids = dict(self._other_node_ids)
+        combined.extend(other)
+        return combined
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, RegionSet)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def _select(self, indexes):
+        selection = RegionSet(self.index)
+        selection._other_nodes = self._other_nodes
+        selection._other_node_ids = self._other_node_ids
+        for i in indexes:
+            selection._starts.append(self._starts[i])
+            selection._ends.append(self._ends[i])
+            selection._node_ids.append(self._node_ids[i])
+            selection._strings.append(self._strings[i])
+            selection._regions.append(self._regions[i])
+        return selection
+
+    def ordered(self):
+        '''
+        Get the regions sorted by the document order of their nodes, and then by their
+        offsets.  Nodes that aren't in the index come after those that are.
+        '''
+        def sort_key(i):
+            node_id = self._node_ids[i]
+            return (node_id < 0, abs(node_id), self._starts[i], self._ends[i])
+        return self._select(sorted(range(len(self)), key=sort_key))
+
+    def filter(self, predicate):
+        ''' Get the regions for which `predicate(region)` is true. '''
+        return self._select(i for i in range(len(self)) if predicate(self[i]))
+
+    def deduplicate(self):
+        ''' Get the regions, without repeats of regions with the same node, offsets, and text. '''
+        seen = set()
+        indexes = []
+        for i in range(len(self)):
+            key = (self._node_ids[i], self._starts[i], self._ends[i], self._strings[i])
+            if key not in seen:
+                seen.add(key)
+                indexes.append(i)
+        return self._select(indexes)
+
+
 class LineExtractor(object):
 
     def extract(self, node):
         ''' Given HTML node, extract all line Regions. '''
+        return list(self.iter_extract(node))
+
+    def iter_extract(self, node):
+        ''' Given HTML node, yield a Region for each line, without splitting all lines at once. '''
 
         text = node.text
 
-        regions = []
         char_index = 0
-        for line in text.split('\n'):
-            first_char = char_index
-            last_char = char_index + len(line) - 1
-            r = Region(node, first_char, last_char, line)
-            regions.append(r)
-            char_index += (len(line) + 1)  # every line has at least 1 char: the newline
+        while True:
+            newline_index = text.find('\n', char_index)
+            line_end = newline_index if newline_index != -1 else len(text)
+            line = text[char_index:line_end]
+            yield Region(node, char_index, line_end - 1, line)
+            if newline_index == -1:
+                break
+            char_index = line_end + 1  # every line has at least 1 char: the newline
+
+
+class _KeywordAutomaton(object):
+    '''
+    Aho-Corasick automaton for a vocabulary of keywords.  `transitions[state]` maps a
+    character to the next state, `failures[state]` is the state for the longest proper
+    suffix of `state` that is also a prefix of a keyword, and `outputs[state]` holds the
+    lengths of all keywords that end at `state`.  `moves` starts as a copy of the
+    transitions, and remembers where failures lead for each character that's been read.
+    '''
+
+    def __init__(self, keywords):
+
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [[]]
+
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.failures.append(0)
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state] = [len(keyword)]
+
+        # Breadth-first, so the failure state of every shorter prefix is known first
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[next_state] = self.transitions[failure].get(char, 0)
+                self.outputs[next_state] = \
+                    self.outputs[next_state] + self.outputs[self.failures[next_state]]
+                queue.append(next_state)
+
+        self.moves = [dict(t) for t in self.transitions]
+
+    def iter_matches(self, text):
+        ''' Yield the (start, end) offsets of every keyword in text, in the order they end. '''
+
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        moves = self.moves
+        state = 0
+        for position, char in enumerate(text):
+            next_state = moves[state].get(char)
+            if next_state is None:
+                failure = state
+                while failure and char not in transitions[failure]:
+                    failure = failures[failure]
+                next_state = moves[state][char] = transitions[failure].get(char, 0)
+            state = next_state
+            if outputs[state]:
+                for length in outputs[state]:
+                    yield position - length + 1, position
+
+
+# Automata are shared by all extractors with the same vocabulary, so that they're only
+# built once, when a module makes its extractor.
+_keyword_automata = {}
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class KeywordExtractor(object):
+    '''
+    Finds every appearance of a vocabulary of keywords in a node's text, in one pass over
+    the text with an Aho-Corasick automaton.  Module authors can pass `keywords` or
+    subclass this extractor and set `keywords` as a class attribute.
+
+    By default, a keyword only matches as a whole word: if it starts or ends with a word
+    character, the character before or after it can't also be one.  When matches overlap,
+    only the one that starts first (and the longest of those) is kept, unless
+    `overlapping` is true, in which case all matches are found in the order they end.
+    Set `case_sensitive` to false to match keywords in any case.
+    '''
+
+    keywords = ()
 
-        return regions
+    def __init__(self, keywords=None, whole_words=True, overlapping=False,
+                 case_sensitive=True):
+
+        keywords = self.keywords if keywords is None else keywords
+        self.whole_words = whole_words
+        self.overlapping = overlapping
+        self.case_sensitive = case_sensitive
+
+        vocabulary = sorted(set(
+            k if case_sensitive else k.lower() for k in keywords if k))
+        self.max_keyword_length = max([len(k) for k in vocabulary] or [0])
+
+        automaton_key = tuple(vocabulary)
+        self.automaton = _keyword_automata.get(automaton_key)
+        if self.automaton is None:
+            self.automaton = _keyword_automata[automaton_key] = _KeywordAutomaton(vocabulary)
+
+        # Extracted regions change whenever the vocabulary or matching rules change
+        identity = '\0'.join(vocabulary + [repr((whole_words, overlapping, case_sensitive))])
+        self.version = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:12]
+
+    def extract(self, node):
+        return list(self.iter_extract(node))
+
+    def iter_extract(self, node):
+        ''' Yield a Region for each keyword in a node's text. '''
+        text = node.text
+        for start, end in self.iter_matches(text):
+            yield Region(node, start, end, text[start:end + 1])
+
+    def _is_whole_word(self, text, start, end):
+        if start > 0 and _is_word_char(text[start]) and _is_word_char(text[start - 1]):
+            return False
+        if end < len(text) - 1 and _is_word_char(text[end]) and _is_word_char(text[end + 1]):
+            return False
+        return True
+
+    def iter_matches(self, text):
+        ''' Yield the (start, end) offsets of the keywords matched in text. '''
+
+        matches = self.automaton.iter_matches(text if self.case_sensitive else text.lower())
+        if self.whole_words:
+            matches = ((s, e) for s, e in matches if self._is_whole_word(text, s, e))
+        if self.overlapping:
+            for match in matches:
+                yield match
+            return
+
+        # Keep the longest match at each start.  Once the automaton is far enough past a
+        # start that no keyword starting there could still be matching, the longest match
+        # at that start is kept if it doesn't overlap the last match that was kept.
+        longest_ends = {}
+        last_end = -1
+        for start, end in matches:
+            longest_ends[start] = end
+            final_starts = [s for s in longest_ends if s <= end - self.max_keyword_length]
+            for final_start in sorted(final_starts):
+                final_end = longest_ends.pop(final_start)
+                if final_start > last_end:
+                    yield final_start, final_end
+                    last_end = final_end
+        for start in sorted(longest_ends):
+            if start > last_end:
+                yield start, longest_ends[start]
+                last_end = longest_ends[start]
+
+
+class JsLexerPool(object):
+    '''
+    Javascript lexers that are built once for each thread and reused.  Building a lexer
+    compiles all of its token patterns, which takes longer than lexing most snippets,
+    so lexers are reset for each new input instead of being built again.
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_free_lexers(self):
+        if not hasattr(self._local, 'lexers'):
+            self._local.lexers = []
+        return self._local.lexers
+
+    def warm_up(self, count=1):
+        ''' Build lexers for this thread ahead of time. '''
+        free_lexers = self._get_free_lexers()
+        while len(free_lexers) < count:
+            free_lexers.append(JsLexer())
+
+    @contextlib.contextmanager
+    def lexer(self, text):
+        ''' Borrow a lexer for this thread that is ready to lex `text`. '''
+
+        free_lexers = self._get_free_lexers()
+        lexer = free_lexers.pop() if free_lexers else JsLexer()
+
+        # Clear all of the state left from the last input.
+        lexer.prev_token = None
+        lexer.cur_token = None
+        lexer.next_tokens = []
+        lexer.lexer.begin('INITIAL')
+        lexer.lexer.lineno = 1
+        lexer.input(text)
+
+        try:
+            yield lexer
+        finally:
+            free_lexers.append(lexer)
+
+
+# Lexers for the importing thread are built at import, so that the first scan doesn't have to.
+js_lexer_pool = JsLexerPool()
+js_lexer_pool.warm_up()
+
+
+# Patterns for the regex backend of the JavascriptStringExtractor.  We reuse slimit's
+# patterns for the tokens that matter when finding strings, so that both backends find
+# the same strings.  Like slimit, patterns are compiled in verbose mode.
+_JS_SPECIAL_CHARS = re.compile(r'["\'`/]')
+_JS_QUOTED_PATTERN = re.compile(r'''
+      (?P<string>''' + JsLexer.string + r''')
+    | (?P<template>`(?:[^`\\]|\\[\s\S])*`)
+''', re.VERBOSE)
+_JS_COMMENT_PATTERN = re.compile(
+    JsLexer.t_BLOCK_COMMENT + '|' + JsLexer.t_LINE_COMMENT, re.VERBOSE)
+_JS_REGEX_PATTERN = re.compile(JsLexer.t_regex_REGEX, re.VERBOSE)
+# Tokens that can appear between strings, comments, and regular expressions
+_JS_OTHER_TOKEN_PATTERN = re.compile(r'''
+      (?P<identifier>''' + JsLexer.identifier + r''')
+    | (?P<number>''' + JsLexer.t_NUMBER + r''')
+    | (?P<line_terminator>[\n\r]+)
+    | (?P<increment>\+\+|--)
+    | (?P<closing>[)\]}])
+    | (?P<punctuator>[-.,;:+*%&|^~?!({[=<>])
+    | (?P<space>[\ \t]+)
+''', re.VERBOSE)
+
+# Keywords after which a '/' starts a regular expression instead of a division
+_JS_KEYWORDS_BEFORE_REGEX = frozenset(
+    k for k in JsLexer.keywords_dict if k not in ('this', 'true', 'false', 'null'))
+
+
+def _scan_js_tokens(text, start, end, division_allowed, after_skipped_chars):
+    '''
+    Read the tokens between two offsets that don't include any strings, comments, or
+    regular expressions.  Returns whether a '/' after these tokens would be a division,
+    and whether it would come right after characters that aren't part of any token.
+    '''
+    position = start
+    while position < end:
+        match = _JS_OTHER_TOKEN_PATTERN.match(text, position, end)
+        if match is None:
+            position += 1
+            after_skipped_chars = True
+            continue
+        kind = match.lastgroup
+        if kind != 'space':
+            if kind == 'identifier':
+                division_allowed = match.group() not in _JS_KEYWORDS_BEFORE_REGEX
+            else:
+                division_allowed = kind in ('number', 'increment', 'closing')
+            after_skipped_chars = False
+        position = match.end()
+    return division_allowed, after_skipped_chars
+
+
+def iter_js_strings(text):
+    '''
+    Find the string literals in Javascript, yielding the (start, end, string) of each,
+    where `start` and `end` are the offsets of the first and last character of the string
+    between the quotes.  Strings are found without a Python step for every token: we jump
+    between quotes and slashes, and only read the tokens before a slash when we need to
+    know if it starts a regular expression.
+
+    This finds the same strings as slimit's lexer.  Like slimit, a '/' starts a regular
+    expression unless it follows a token that ends an expression (a name, literal, closing
+    bracket, or ++/--), or comes right after characters that aren't part of any token.
+    Unlike slimit, it skips over template literals, and keeps going when it can't read a
+    regular expression instead of giving up on the rest of the text.
+    '''
+    length = len(text)
+
+    # Whether a '/' at `position` would be a division, if the tokens from `position`
+    # to the next special character don't say otherwise.
+    position = 0
+    division_allowed = False
+    after_skipped_chars = False
+
+    search_position = 0
+    while True:
+
+        special_match = _JS_SPECIAL_CHARS.search(text, search_position)
+        if special_match is None:
+            return
+        special_position = special_match.start()
+
+        if text[special_position] != '/':
+            quoted_match = _JS_QUOTED_PATTERN.match(text, special_position)
+            if quoted_match is None:
+                # Quotes without an end aren't part of any token, and are skipped.
+                search_position = special_position + 1
+                continue
+            if quoted_match.lastgroup == 'string':
+                string = quoted_match.group()[1:-1].replace('\\\n', '')
+                start = special_position + 1
+                yield start, start + len(string) - 1, string
+            position = search_position = quoted_match.end()
+            division_allowed = True
+            after_skipped_chars = False
+            continue
+
+        next_char = text[special_position + 1] if special_position + 1 < length else ''
+        if next_char in ('/', '*'):
+            comment_match = _JS_COMMENT_PATTERN.match(text, special_position)
+            position = search_position = \
+                comment_match.end() if comment_match else special_position + 1
+            division_allowed = False
+            after_skipped_chars = False
+            continue
+
+        division_allowed, after_skipped_chars = _scan_js_tokens(
+            text, position, special_position, division_allowed, after_skipped_chars)
+        regex_match = None
+        if next_char and not (division_allowed or after_skipped_chars):
+            regex_match = _JS_REGEX_PATTERN.match(text, special_position)
+        if regex_match:
+            position = search_position = regex_match.end()
+            division_allowed = True
+        else:
+            position = search_position = special_position + 1
+            division_allowed = False
+        after_skipped_chars = False
 
 
 class JavascriptStringExtractor(object):
+    '''
+    Extracts the string literals from Javascript.  Strings are found with slimit's lexer
+    by default.  Pass `backend='regex'` to find them with `iter_js_strings` instead,
+    which is much faster and recovers from text that slimit can't lex.
+    '''
+
+    def __init__(self, lexer_pool=None, backend='slimit'):
+        # Lexers are borrowed from the module's pool unless another pool is given.  We
+        # don't save the module's pool here, so that the extractor can be pickled.
+        self.lexer_pool = lexer_pool
+        if backend not in ('slimit', 'regex'):
+            raise ValueError("Unknown Javascript string backend '%s'" % backend)
+        self.backend = backend
+        # The backends find different strings in text that slimit can't lex
+        self.version = backend
 
     def extract(self, node):
+        return list(self.iter_extract(node))
 
-        lexer = JsLexer()
-        lexer.input(node.text)
+    def iter_extract(self, node):
+        ''' Yield a Region for each string literal in a node's Javascript, as it is lexed. '''
 
-        regions = []
-        while True:
-            try:
-                tok = lexer.token()
-                if not tok:
-                    break
-                if tok.type == "STRING":
-                    start_char = tok.lexpos + 1
-                    string = tok.value[1:-1]
-                    end_char = start_char + len(string) - 1
-                    r = Region(node, start_char, end_char, string)
-                    regions.append(r)
-            except (TypeError, AttributeError):
-                logging.warn("Failed to parse text: %s...", node.text[:100])
-                break
+        if self.backend == 'regex':
+            for start_char, end_char, string in iter_js_strings(node.text):
+                yield Region(node, start_char, end_char, string)
+            return
 
-        return regions
+        lexer_pool = self.lexer_pool or js_lexer_pool
+        with lexer_pool.lexer(node.text) as lexer:
+            while True:
+                try:
+                    tok = lexer.token()
+                    if not tok:
+                        break
+                    if tok.type == "STRING":
+                        start_char = tok.lexpos + 1
+                        string = tok.value[1:-1]
+                        end_char = start_char + len(string) - 1
+                        yield Region(node, start_char, end_char, string)
+                except (TypeError, AttributeError):
+                    logging.warn("Failed to parse text: %s...", node.text[:100])
+                    break
@@ -3,25 +3,976 @@
 
 from __future__ import unicode_literals
 import logging
-from bs4 import BeautifulSoup
+import re
+import hashlib
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from bs4 import BeautifulSoup, Tag, NavigableString, CData
+from bs4.builder import builder_registry
+from html5lib.tokenizer import HTMLTokenizer
+from html5lib.constants import tokenTypes, voidElements, headingElements, \
+    specialElements, scopingElements, namespaces
+
+from tutorons.core.metrics import counters
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 
+DEFAULT_PARSER_BACKEND = 'html5lib'
+
+
+def get_parser_backends():
+    ''' Get the names of all HTML tree builders that BeautifulSoup can use here. '''
+    return [b.NAME for b in builder_registry.builders if 'html' in b.features]
+
+
+DEFAULT_DOCUMENT_CACHE_SIZE = 128 * 1024 * 1024
+
+# A tree parsed by BeautifulSoup takes up about this many bytes of memory for each byte of
+# the HTML it was parsed from (measured with html5lib on real pages).
+PARSED_DOCUMENT_BYTES_PER_SOURCE_BYTE = 100
+
+
+def _get_setting(name, default):
+    ''' Get a Django setting, or the default if it isn't set or Django isn't configured. '''
+    try:
+        return getattr(settings, name, default)
+    except ImproperlyConfigured:
+        return default
+
+
+def get_default_parser_backend():
+    '''
+    Get the parser backend chosen with the HTML_PARSER setting, or html5lib if there
+    is no setting (or Django hasn't been configured).
+    '''
+    return _get_setting('HTML_PARSER', DEFAULT_PARSER_BACKEND)
+
+
 class HtmlDocument(BeautifulSoup):
-    ''' Subclass of BeautifulSoup that cleans HTML documents for our processing purposes. '''
+    '''
+    Subclass of BeautifulSoup that cleans HTML documents for our processing purposes.
+    Documents are parsed with the `parser` backend if one is given, and otherwise with
+    the backend in the HTML_PARSER setting.
+    '''
 
-    def __init__(self, text, *args, **kwargs):
-        # Parse with html5lib to "parse the page the same way a web browser does".
+    def __init__(self, text, parser=None, *args, **kwargs):
+        # By default, we parse with html5lib to "parse the page the same way a web browser does".
         # Source: http://www.crummy.com/software/BeautifulSoup/bs4/doc/
         # Lxml parser takes liberties in removing newlines, which makes it hard to get
-        # absolute character positions of explainable regions in the original doc
-        super(self.__class__, self).__init__(text, 'html5lib', *args, **kwargs)
+        # absolute character positions of explainable regions in the original doc.
+        # Before switching to a faster backend, check that it finds the same regions on
+        # real pages with the `compareparsers` command.
+        parser = parser or get_default_parser_backend()
+        if parser not in get_parser_backends():
+            raise ValueError(
+                "Unknown HTML parser backend '%s'. Available backends: %s" %
+                (parser, ', '.join(get_parser_backends())))
+        super(self.__class__, self).__init__(text, parser, *args, **kwargs)
+        self.parser_backend = parser
+        self._index = None
+
+    @property
+    def index(self):
+        '''
+        Index of the document's text and tags.  It's built the first time it's
+        needed, and is not updated if the document is modified afterwards.
+        '''
+        if self._index is None:
+            self._index = TreeIndex(self)
+        return self._index
+
+    def get_text_span(self, tag):
+        '''
+        Get the (start, end) character offsets of a tag's text within the text of
+        the whole document.  The end offset is exclusive.
+        '''
+        return self.index.get_text_span(tag)
+
+    def get_node_text(self, tag):
+        ''' Get the same text as `tag.text`, without walking the tag's descendants. '''
+        return self.index.get_text(tag)
+
+    def to_document_offset(self, tag, offset):
+        ''' Convert a character offset within a tag's text to an offset in the document's text. '''
+        return self.index.get_text_span(tag)[0] + offset
+
+    def to_node_offset(self, tag, offset):
+        ''' Convert a character offset in the document's text to an offset within a tag's text. '''
+        return offset - self.index.get_text_span(tag)[0]
+
+
+_document_cache = None
+_document_cache_lock = threading.Lock()
+
+
+def get_document_cache():
+    '''
+    Get the cache of parsed documents for this process.  Its size is an estimate of the
+    bytes of memory that the documents in it take up, up to the PARSED_DOCUMENT_CACHE_SIZE
+    setting.  Documents are estimated to take PARSED_DOCUMENT_BYTES_PER_SOURCE_BYTE times
+    as much memory as their HTML.
+    '''
+    global _document_cache
+    with _document_cache_lock:
+        if _document_cache is None:
+            # Imported here as the cache module depends on modules that depend on this one.
+            from tutorons.core.cache import LruCache
+            _document_cache = LruCache(
+                _get_setting('PARSED_DOCUMENT_CACHE_SIZE', DEFAULT_DOCUMENT_CACHE_SIZE),
+                sizeof=lambda entry: entry[1],
+            )
+    return _document_cache
+
+
+# Elements that a parser can add to a page without there being a tag with their name in
+# the page's HTML: html, head, body, tbody, tr, and colgroup are implied by other tags,
+# <image> becomes an img, and <isindex> becomes a form with an hr, label, and input.
+_ELEMENTS_WITHOUT_TAGS = frozenset([
+    'html', 'head', 'body', 'tbody', 'tr', 'colgroup', 'img', 'form', 'hr', 'label', 'input',
+])
+
+
+def compile_tag_pattern(tags):
+    '''
+    Compile a pattern that finds start or end tags with any of these names in raw HTML.
+    If the pattern isn't found in a page's HTML, the page can't contain any elements
+    with these names, so it doesn't need to be parsed to look for them.  Returns None if
+    parsers can add some of these elements without a tag for them in the HTML.
+    '''
+    if any(t.lower() in _ELEMENTS_WITHOUT_TAGS for t in tags):
+        return None
+    names = '|'.join(re.escape(t) for t in tags)
+    # A tag name ends at whitespace, a '/', a '>', or the end of the document
+    return re.compile(r'</?(?:' + names + r')(?![^\s/>])', re.IGNORECASE)
+
+
+def get_parsed_document(html, parser=None):
+    '''
+    Get an `HtmlDocument` for some HTML, reusing the document from an earlier call with
+    the same HTML and parser backend if it is still in the document cache.
+
+    Cached documents are shared between requests and threads, so they must not be
+    modified.  Scanners only read documents, so they can scan them.
+    '''
+    parser = parser or get_default_parser_backend()
+    source = html.encode('utf-8')
+    key = hashlib.sha256(parser.encode('utf-8') + b'\0' + source).hexdigest()
+
+    document_cache = get_document_cache()
+    entry = document_cache.get(key)
+    if entry is not None:
+        counters.increment('document_cache_hits')
+        return entry[0]
+
+    counters.increment('document_cache_misses')
+    document = HtmlDocument(html, parser=parser)
+    document_cache.set(key, (document, len(source) * PARSED_DOCUMENT_BYTES_PER_SOURCE_BYTE))
+    return document
+
+
+class TreeIndex(object):
+    '''
+    Index of the text and tags beneath a root node, built with a single walk of the tree.
+    Properties:
+    * text: the text of the root node, the same as `root.text`
+    * tags: the root (if it is a tag) and all tags beneath it, in document order
+    '''
+
+    def __init__(self, root):
+
+        pieces = []
+        tags = []
+        text_spans = {}
+        positions = {}
+        tag_ends = {}
+        names = {}
+        type_indexes = {}
+        offset = 0
+
+        open_tags = [root]
+        starts = [0]
+        # For each open tag, the number of children it has seen with each name
+        child_counts = [{}]
+        if isinstance(root, Tag) and not isinstance(root, BeautifulSoup):
+            positions[id(root)] = 0
+            tags.append(root)
+            names.setdefault(root.name, []).append(0)
+
+        def close_tag():
+            tag = open_tags.pop()
+            text_spans[id(tag)] = (starts.pop(), offset)
+            tag_ends[id(tag)] = len(tags)
+            child_counts.pop()
+
+        # The tree is walked through each tag's `contents`, with a stack of the children
+        # left to visit in each open tag.  `descendants` isn't used, as it follows the
+        # `next_element` links, which html5lib leaves broken when it moves content out of
+        # a misnested table, so it can skip the rest of the page.
+        children = [iter(getattr(root, 'contents', []))]
+        while children:
+
+            element = next(children[-1], None)
+            if element is None:
+                # All children of the innermost open tag have been visited
+                children.pop()
+                if children:
+                    close_tag()
+                continue
+
+            if isinstance(element, Tag):
+                positions[id(element)] = len(tags)
+                names.setdefault(element.name, []).append(len(tags))
+                tags.append(element)
+                sibling_counts = child_counts[-1]
+                sibling_counts[element.name] = sibling_counts.get(element.name, 0) + 1
+                type_indexes[id(element)] = sibling_counts[element.name]
+                open_tags.append(element)
+                starts.append(offset)
+                child_counts.append({})
+                children.append(iter(element.contents))
+            elif type(element) in (NavigableString, CData):
+                # These are the only types of strings that BeautifulSoup includes in `text`
+                pieces.append(element)
+                offset += len(element)
+
+        while open_tags:
+            close_tag()
+
+        self.text = ''.join(pieces)
+        self.tags = tags
+        self._text_spans = text_spans
+        self._positions = positions
+        self._tag_ends = tag_ends
+        self._names = names
+        self._type_indexes = type_indexes
+        self._selectors = {}
+
+    def get_text_span(self, tag):
+        ''' Get the (start, end) offsets of a tag's text in the root's text (end is exclusive). '''
+        return self._text_spans[id(tag)]
+
+    def get_text(self, tag):
+        start, end = self._text_spans[id(tag)]
+        return self.text[start:end]
+
+    def get_position(self, tag):
+        ''' Get the position of a tag in `tags`, or None if the tag isn't in the index. '''
+        return self._positions.get(id(tag))
+
+    def get_extent(self, tag):
+        '''
+        Get the (start, end) positions of a tag and its descendants in `tags`.
+        `tags[start]` is the tag itself, and the end position is exclusive.
+        '''
+        return self._positions[id(tag)], self._tag_ends[id(tag)]
+
+    def find_all(self, names, within=None):
+        ''' Find all tags with one of the names, in document order, without walking the tree. '''
+        positions = sorted(p for n in set(names) for p in self._names.get(n, []))
+        if within is not None and id(within) in self._positions:
+            start, end = self.get_extent(within)
+            positions = [p for p in positions if start <= p < end]
+        return [self.tags[p] for p in positions]
+
+    def get_type_index(self, tag):
+        ''' Get a tag's position among the siblings with its name, starting at 1 (as in CSS). '''
+        return self._type_indexes[id(tag)]
+
+    def get_css_selector(self, tag):
+        '''
+        Create a CSS selector that chooses a tag beneath the root, starting from the root's
+        children.  Selectors are saved for each tag, so that getting the selector of a tag
+        only takes as many steps as there are ancestors whose selectors aren't known yet.
+        Tags that aren't in the index (e.g., ones added after it was built) get their
+        selector by walking up the tree instead.
+        '''
+        if id(tag) not in self._type_indexes:
+            return _get_css_selector_from_tree(tag)
+        selectors = self._selectors
+
+        path = []
+        element = tag
+        while id(element) in self._type_indexes and id(element) not in selectors:
+            path.append(element)
+            element = element.parent
+
+        prefix = selectors.get(id(element))
+        for element in reversed(path):
+            element_selector = '%s:nth-of-type(%d)' % (
+                element.name.upper(), self._type_indexes[id(element)])
+            if prefix is not None:
+                selector = prefix + ' > ' + element_selector
+            elif element.name == 'html':
+                selector = element.name.upper()
+            else:
+                selector = element_selector
+            selectors[id(element)] = selector
+            prefix = selector
+
+        return selectors[id(tag)]
+
+
+def get_document(node):
+    ''' Get the `HtmlDocument` that a node belongs to, or None if it doesn't belong to one. '''
+    while node.parent is not None:
+        node = node.parent
+    return node if isinstance(node, HtmlDocument) else None
+
+
+class StreamedElement(object):
+    '''
+    An element found while streaming through a document with `iter_html_events`.
+    Properties:
+    * name: the element's tag name
+    * attrs: a dictionary of the element's attributes
+    * index: the position of the element among its parent's children with the same name,
+      starting at 1.  This is the index used for the element in CSS selectors.
+    * parent: the element's parent element, or None for the root (`html`) element
+    * text: the text of the element.  This is only set by scanners that buffer an
+      element's text, and only after the element has closed.
+    '''
+
+    def __init__(self, name, attrs, index, parent):
+        self.name = name
+        self.attrs = attrs
+        self.index = index
+        self.parent = parent
+        self.text = None
+        self._child_counts = {}
+
+    def _add_child(self, name, attrs):
+        index = self._child_counts.get(name, 0) + 1
+        self._child_counts[name] = index
+        return StreamedElement(name, attrs, index, self)
+
+    def __hash__(self):
+        return hash((self.name, self.text))
+
+    def __str__(self):
+        return '<%s>' % self.name
+
+
+# Names of the formatting elements.  When other tags close them before their end tags,
+# html5lib reopens them, and when their end tags are misnested, it can move the elements
+# opened inside of them.
+FORMATTING_ELEMENTS = frozenset([
+    'a', 'b', 'big', 'code', 'em', 'font', 'i', 'nobr', 's', 'small', 'strike', 'strong',
+    'tt', 'u',
+])
+
+# Names of HTML elements that html5lib treats specially when building a tree
+_HTML_SPECIAL_ELEMENTS = frozenset(n for ns, n in specialElements if ns == namespaces['html'])
+_HTML_SCOPING_ELEMENTS = frozenset(n for ns, n in scopingElements if ns == namespaces['html'])
+_HEAD_ELEMENTS = frozenset([
+    'base', 'basefont', 'bgsound', 'command', 'link', 'meta', 'noframes', 'noscript',
+    'script', 'style', 'title',
+])
+_CLOSE_P_ELEMENTS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'center', 'details', 'dir', 'div',
+    'dl', 'fieldset', 'figcaption', 'figure', 'footer', 'header', 'hgroup', 'main',
+    'menu', 'nav', 'ol', 'p', 'section', 'summary', 'ul', 'pre', 'listing', 'form',
+    'plaintext', 'hr', 'xmp',
+]) | frozenset(headingElements)
+_LIST_ITEM_CLOSERS = {'li': ('li',), 'dd': ('dd', 'dt'), 'dt': ('dd', 'dt')}
+_IMPLIED_END_ELEMENTS = frozenset(['dd', 'dt', 'li', 'option', 'optgroup', 'p', 'rp', 'rt'])
+_TABLE_SECTIONS = frozenset(['tbody', 'thead', 'tfoot'])
+_TABLE_CELLS = frozenset(['td', 'th'])
+_TABLE_PARTS = _TABLE_SECTIONS | _TABLE_CELLS | frozenset(['tr'])
+_TABLE_HEADERS = frozenset(['caption', 'colgroup', 'col'])
+# Elements whose children html5lib moves out in front of them, unless they are table parts
+_TABLE_CONTEXT_ELEMENTS = frozenset(['table', 'tbody', 'thead', 'tfoot', 'tr'])
+_TABLE_CONTENT_ELEMENTS = _TABLE_PARTS | _TABLE_HEADERS | frozenset(['style', 'script'])
+_DROP_NEWLINE_ELEMENTS = frozenset(['pre', 'listing', 'textarea'])
+_RCDATA_ELEMENTS = frozenset(['title', 'textarea'])
+_RAWTEXT_ELEMENTS = frozenset(['style', 'xmp', 'iframe', 'noembed', 'noframes', 'noscript'])
+_RAW_TEXT_PARENTS = _TABLE_CONTEXT_ELEMENTS | _RAWTEXT_ELEMENTS | frozenset(['title', 'script'])
+# Elements that keep formatting elements opened outside of them from being reopened inside
+_FORMATTING_MARKER_ELEMENTS = frozenset(['td', 'th', 'caption', 'applet', 'marquee', 'object'])
+_FORMATTING_MARKER = object()
+# Elements whose start tags don't reopen formatting elements that were closed early
+_NO_REOPEN_FORMATTING_ELEMENTS = (
+    _CLOSE_P_ELEMENTS | _HEAD_ELEMENTS | _TABLE_PARTS | _TABLE_HEADERS |
+    frozenset(headingElements) | frozenset([
+        'li', 'dd', 'dt', 'table', 'param', 'source', 'track', 'textarea', 'iframe',
+        'noembed', 'rp', 'rt', 'frame', 'head', 'html', 'body', 'frameset',
+    ])
+) - frozenset(['xmp'])
+
+
+class MisnestedTagsError(Exception):
+    '''
+    Exception when a document has tags so misnested that a browser would move elements
+    that have already been streamed to another place in the document.
+    '''
+
+
+class _StreamTreeBuilder(object):
+    '''
+    Tracks the open elements of a document from html5lib tokens, turning each token
+    into the events that `iter_html_events` yields.
+    '''
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.root = StreamedElement('html', {}, 1, None)
+        self.head = None
+        self.open_elements = [self.root]
+        self.phase = 'before head'
+        self.no_quirks = False
+        self.drop_newline = None
+
+        # Like html5lib, we keep a list of the formatting elements (like `b` and `a`) that
+        # are open, so that the ones closed early by other tags can be reopened, and the
+        # form that is open, so that forms nested in it can be ignored.
+        self.active_formatting = []
+        self.form = None
+        self.after_body = False
+
+    def open_element(self, name, attrs):
+        if self.open_elements[-1] is self.drop_newline:
+            self.drop_newline = None
+        element = self.open_elements[-1]._add_child(name, attrs)
+        self.open_elements.append(element)
+        return [('start', element)]
+
+    def close_element(self):
+        element = self.open_elements.pop()
+        if element.name in _FORMATTING_MARKER_ELEMENTS:
+            while self.active_formatting and \
+                    self.active_formatting.pop() is not _FORMATTING_MARKER:
+                pass
+        return [('end', element)]
+
+    def close_through(self, element):
+        ''' Close the open elements up to and including `element`. '''
+        events = []
+        while self.open_elements[-1] is not element:
+            events.extend(self.close_element())
+        return events + self.close_element()
+
+    def is_open(self, element):
+        return any(e is element for e in self.open_elements)
+
+    def get_active_formatting_element(self, name):
+        ''' Get the latest formatting element with this name since the last marker. '''
+        for element in reversed(self.active_formatting):
+            if element is _FORMATTING_MARKER:
+                break
+            if element.name == name:
+                return element
+        return None
+
+    def add_formatting_element(self, element):
+        ''' Add a formatting element to the list, keeping at most three with the same tag. '''
+        matching_elements = []
+        for e in reversed(self.active_formatting):
+            if e is _FORMATTING_MARKER:
+                break
+            if e.name == element.name and e.attrs == element.attrs:
+                matching_elements.append(e)
+        if len(matching_elements) >= 3:
+            self.active_formatting.remove(matching_elements[-1])
+        self.active_formatting.append(element)
+
+    def reopen_formatting_elements(self):
+        '''
+        Reopen the formatting elements that other tags closed before their end tags,
+        so that the text that follows is formatted by them as html5lib does.
+        '''
+        entries = self.active_formatting
+        if not entries or entries[-1] is _FORMATTING_MARKER or self.is_open(entries[-1]):
+            return []
+        first = len(entries) - 1
+        while first > 0 and entries[first - 1] is not _FORMATTING_MARKER and \
+                not self.is_open(entries[first - 1]):
+            first -= 1
+        events = []
+        for i in range(first, len(entries)):
+            events.extend(self.open_element(entries[i].name, dict(entries[i].attrs)))
+            entries[i] = self.open_elements[-1]
+        return events
+
+    def close_formatting_element(self, name):
+        '''
+        Close a formatting element, like html5lib's "adoption agency algorithm".  When block
+        elements were opened inside the formatting element, html5lib moves them out of it,
+        which can't be done to elements that have already been streamed.
+        '''
+        element = self.get_active_formatting_element(name)
+        if element is None or (self.is_open(element) and not self.in_scope(name)):
+            return self.close_other(name)
+        if not self.is_open(element):
+            self.active_formatting.remove(element)
+            return []
+        position = next(i for i, e in enumerate(self.open_elements) if e is element)
+        if any(e.name in _HTML_SPECIAL_ELEMENTS for e in self.open_elements[position:]):
+            raise MisnestedTagsError(
+                "</%s> closes a formatting element around a block element" % name)
+        self.active_formatting.remove(element)
+        return self.close_through(element)
+
+    def close_other(self, name):
+        ''' Close the latest element with this name, unless a special element is inside it. '''
+        for element in reversed(self.open_elements[1:]):
+            if element.name == name:
+                return self.close_until(name)
+            if element.name in _HTML_SPECIAL_ELEMENTS:
+                break
+        return []
+
+    def in_select(self):
+        return any(e.name == 'select' for e in reversed(self.open_elements))
+
+    def close_select(self):
+        ''' Close the open `select`, if it isn't inside of an element other than an option. '''
+        for element in reversed(self.open_elements):
+            if element.name == 'select':
+                return self.close_until('select')
+            if element.name not in ('option', 'optgroup'):
+                break
+        return []
+
+    def start_tag_in_select(self, name):
+        '''
+        Like html5lib, only let options and scripts be added to a `select`.  Close the
+        options an option or option group ends, and the `select` that ends at fields and
+        table parts.  The caller adds the element if the `select` is still open.
+        '''
+        events = []
+        if name in ('option', 'optgroup') and self.open_elements[-1].name == 'option':
+            events.extend(self.close_element())
+        if name == 'optgroup' and self.open_elements[-1].name == 'optgroup':
+            events.extend(self.close_element())
+        if name in ('select', 'input', 'keygen', 'textarea'):
+            events.extend(self.close_select())
+        elif name in _TABLE_PARTS or name in ('caption', 'table'):
+            if any(e.name == 'table' for e in self.open_elements):
+                events.extend(self.close_until('select'))
+        return events
+
+    def end_tag_in_select(self, name):
+        '''
+        Like html5lib, ignore end tags in a `select` other than those of its options and
+        of itself, and of the table parts that it's in.
+        '''
+        current = self.open_elements[-1]
+        if name == 'option' and current.name == 'option':
+            return self.close_element()
+        if name == 'optgroup':
+            if current.name == 'option' and self.open_elements[-2].name == 'optgroup':
+                return self.close_element() + self.close_element()
+            if current.name == 'optgroup':
+                return self.close_element()
+        if name == 'select':
+            return self.close_select()
+        if (name in _TABLE_PARTS or name in ('caption', 'table')) and \
+                self.in_scope(name, extra_boundaries=('select',)):
+            return self.close_until('select')
+        return []
+
+    def check_table_context(self, name):
+        '''
+        Make sure an element can be added to the open element.  html5lib moves elements
+        and text that aren't table parts out in front of the table they appear in.
+        '''
+        if self.open_elements[-1].name in _TABLE_CONTEXT_ELEMENTS:
+            raise MisnestedTagsError(
+                "%s found in <%s> outside of a table cell" % (
+                    '<%s>' % name if name is not None else 'Text',
+                    self.open_elements[-1].name))
+
+    def close_until(self, name):
+        events = []
+        while self.open_elements[-1].name != name:
+            events.extend(self.close_element())
+        return events + self.close_element()
+
+    def in_scope(self, name, extra_boundaries=()):
+        for element in reversed(self.open_elements):
+            if element.name == name:
+                return True
+            if element.name in _HTML_SCOPING_ELEMENTS or element.name in extra_boundaries:
+                return False
+        return False
+
+    def close_table_part(self, names):
+        ''' Close the innermost element with one of these names in the current table. '''
+        for element in reversed(self.open_elements):
+            if element.name in names:
+                return self.close_until(element.name)
+            if element.name in ('table', 'html'):
+                break
+        return []
+
+    def open_head(self):
+        self.phase = 'in head'
+        events = self.open_element('head', {})
+        self.head = self.open_elements[-1]
+        return events
+
+    def open_body(self):
+        events = []
+        if self.phase == 'before head':
+            events.extend(self.open_head())
+        while len(self.open_elements) > 1:
+            events.extend(self.close_element())
+        self.phase = 'in body'
+        return events + self.open_element('body', {})
+
+    def start_tag(self, name, attrs):
+
+        self.after_body = False
+        events = []
+        if name == 'html' or (self.phase == 'in body' and name in ('head', 'body')):
+            return events
+
+        if self.phase != 'in body':
+            if name == 'head':
+                return self.open_head() if self.phase == 'before head' else events
+            elif name == 'body':
+                return self.open_body()
+            elif name in _HEAD_ELEMENTS and \
+                    (self.phase != 'after head' or name not in ('noscript', 'command')):
+                if self.phase == 'before head':
+                    events.extend(self.open_head())
+                elif self.phase == 'after head':
+                    # Like html5lib, put head elements found after the head into the head
+                    self.open_elements.append(self.head)
+                    events.append(('start', self.head))
+                    self.phase = 'in head'
+                    events.extend(self._start_element(name, attrs))
+                    if self.open_elements[-1] is self.head:
+                        events.extend(self.close_element())
+                        self.phase = 'after head'
+                    return events
+                return events + self._start_element(name, attrs)
+            else:
+                events.extend(self.open_body())
+
+        if self.in_select():
+            events.extend(self.start_tag_in_select(name))
+            if self.in_select() or name == 'select':
+                return events if name not in ('option', 'optgroup', 'script') else \
+                    events + self._start_element(name, attrs)
+
+        # Like html5lib, a column group only holds columns
+        if self.open_elements[-1].name == 'colgroup' and name != 'col':
+            events.extend(self.close_element())
+
+        if name not in _TABLE_CONTENT_ELEMENTS and \
+                not (name == 'input' and attrs.get('type', '').lower() == 'hidden'):
+            self.check_table_context(name)
+
+        # Like html5lib, ignore forms nested in another form
+        if name == 'form' and self.form is not None:
+            return events
+
+        if name == 'a':
+            element = self.get_active_formatting_element('a')
+            if element is not None:
+                # Like html5lib, a link ends the link that is still open
+                events.extend(self.close_formatting_element('a'))
+                if self.is_open(element):
+                    raise MisnestedTagsError("<a> found in a link that can't be closed")
+                if element in self.active_formatting:
+                    self.active_formatting.remove(element)
+        elif name == 'nobr':
+            events.extend(self.reopen_formatting_elements())
+            if self.in_scope('nobr'):
+                events.extend(self.close_formatting_element('nobr'))
+        elif name == 'button' and self.in_scope('button'):
+            # Like html5lib, a button ends the button that is still open
+            events.extend(self.end_tag('button'))
+        elif name in ('option', 'optgroup') and self.open_elements[-1].name == 'option':
+            events.extend(self.close_element())
+
+        if name in _LIST_ITEM_CLOSERS:
+            for element in reversed(self.open_elements):
+                if element.name in _LIST_ITEM_CLOSERS[name]:
+                    events.extend(self.close_until(element.name))
+                    break
+                if element.name in _HTML_SPECIAL_ELEMENTS and \
+                        element.name not in ('address', 'div', 'p'):
+                    break
+
+        if name in _CLOSE_P_ELEMENTS or name in _LIST_ITEM_CLOSERS or \
+                (name == 'table' and self.no_quirks):
+            if self.in_scope('p', extra_boundaries=('button',)):
+                events.extend(self.close_until('p'))
+
+        if name in headingElements and self.open_elements[-1].name in headingElements:
+            events.extend(self.close_element())
+
+        # Like html5lib, close the captions, cells, rows, and sections of tables that this
+        # element ends, and add the sections and rows that table cells need.  Captions and
+        # column groups are only added right inside of a table.
+        if name in _TABLE_PARTS or name in _TABLE_HEADERS:
+            if not any(e.name == 'table' for e in self.open_elements):
+                return events
+            events.extend(self.close_table_part(('caption',)))
+        if name in _TABLE_HEADERS:
+            while self.open_elements[-1].name not in ('table', 'html'):
+                events.extend(self.close_element())
+            if name == 'col':
+                events.extend(self.open_element('colgroup', {}))
+        elif name in _TABLE_PARTS:
+            events.extend(self.close_table_part(_TABLE_CELLS))
+            if name not in _TABLE_CELLS:
+                events.extend(self.close_table_part(('tr',)))
+            if name in _TABLE_SECTIONS:
+                events.extend(self.close_table_part(_TABLE_SECTIONS))
+            if name not in _TABLE_SECTIONS and self.open_elements[-1].name == 'table':
+                events.extend(self.open_element('tbody', {}))
+            if name in _TABLE_CELLS and self.open_elements[-1].name in _TABLE_SECTIONS:
+                events.extend(self.open_element('tr', {}))
+
+        if name not in _NO_REOPEN_FORMATTING_ELEMENTS:
+            events.extend(self.reopen_formatting_elements())
+
+        events.extend(self._start_element(name, attrs))
+        if name in FORMATTING_ELEMENTS:
+            self.add_formatting_element(self.open_elements[-1])
+        elif name in _FORMATTING_MARKER_ELEMENTS:
+            self.active_formatting.append(_FORMATTING_MARKER)
+        elif name == 'form':
+            self.form = self.open_elements[-1]
+        return events
+
+    def _start_element(self, name, attrs):
+
+        events = self.open_element(name, attrs)
+        if name in voidElements:
+            events.extend(self.close_element())
+        elif name in _DROP_NEWLINE_ELEMENTS:
+            # html5lib's tree builder only drops the newline outside of table cells
+            in_cell = any(
+                e.name in _TABLE_CELLS or e.name == 'caption' for e in self.open_elements)
+            self.drop_newline = self.open_elements[-1] if not in_cell else None
+
+        # Some elements contain raw text instead of markup.  html5lib's tree
+        # builder tells its tokenizer to switch states for them, so we do too.
+        if name in _RCDATA_ELEMENTS:
+            self.tokenizer.state = self.tokenizer.rcdataState
+        elif name in _RAWTEXT_ELEMENTS:
+            self.tokenizer.state = self.tokenizer.rawtextState
+        elif name == 'script':
+            self.tokenizer.state = self.tokenizer.scriptDataState
+        elif name == 'plaintext':
+            self.tokenizer.state = self.tokenizer.plaintextState
+
+        return events
+
+    def end_tag(self, name):
+
+        self.after_body = False
+        if name == 'pre':
+            self.drop_newline = None
+        if self.phase == 'before head' and name in ('head', 'body', 'html', 'br'):
+            return self.open_head() + self.end_tag(name)
+        if self.phase == 'in head' and self.open_elements[-1] is self.head:
+            if name == 'head':
+                self.phase = 'after head'
+                return self.close_element()
+            elif name not in ('body', 'html', 'br'):
+                return []
+        if self.phase != 'in body' and len(self.open_elements) <= 2:
+            if name not in ('body', 'html', 'br'):
+                return []
+            events = self.open_body()
+            return events + self.start_tag('br', {}) if name == 'br' else events
+        if self.in_select():
+            events = self.end_tag_in_select(name)
+            if self.in_select() or name == 'select':
+                return events
+            return events + self.end_tag(name)
+        if name in ('body', 'html') and self.in_scope('body'):
+            # Whitespace after the end of the body is added as it is
+            self.after_body = name == 'body'
+            return []
+        if name in ('html', 'body', 'head'):
+            return []
+        if name == 'br':
+            return self.start_tag('br', {})
+        if name == 'p' and not self.in_scope('p', extra_boundaries=('button',)):
+            # html5lib adds an empty paragraph for a closing tag without an opening tag
+            return self.start_tag('p', {}) + self.close_until('p')
+
+        if name in FORMATTING_ELEMENTS:
+            return self.close_formatting_element(name)
+        if name == 'form':
+            return self.close_form()
+
+        events = []
+        if name in headingElements:
+            for element in reversed(self.open_elements):
+                if element.name in headingElements:
+                    return self.close_until(element.name)
+                if element.name in _HTML_SCOPING_ELEMENTS:
+                    return []
+        if (name in _TABLE_PARTS and name not in _TABLE_CELLS) or name == 'table':
+            # Rows, sections, and tables close the cell that's open in them
+            for element in reversed(self.open_elements):
+                if element.name == name:
+                    events.extend(self.close_table_part(_TABLE_CELLS))
+                    break
+                if element.name in ('table', 'html'):
+                    break
+        if name in _HTML_SPECIAL_ELEMENTS:
+            scope = ('ol', 'ul') if name == 'li' else ()
+            if self.in_scope(name, scope):
+                events.extend(self.close_until(name))
+            return events
+
+        return self.close_other(name)
+
+    def close_form(self):
+
+        form = self.form
+        self.form = None
+        if form is None:
+            return []
+        for element in reversed(self.open_elements):
+            if element is form:
+                break
+            if element.name in _HTML_SCOPING_ELEMENTS:
+                return []
+
+        events = []
+        while self.open_elements[-1] is not form and \
+                self.open_elements[-1].name in _IMPLIED_END_ELEMENTS:
+            events.extend(self.close_element())
+        if self.open_elements[-1] is not form:
+            # html5lib takes the form off of the stack of open elements, but leaves the
+            # elements in it open, so they are still in the form.
+            raise MisnestedTagsError("</form> found in an element opened inside the form")
+        return events + self.close_element()
+
+    def text(self, data, is_space):
+
+        if self.after_body and is_space:
+            if self.open_elements[-1] is self.drop_newline:
+                self.drop_newline = None
+            return [('text', data)]
+        self.after_body = False
+
+        # Like html5lib, drop the newline at the start of the first whitespace after a `pre`
+        # starts, if nothing has been added to the `pre` yet
+        if self.drop_newline is not None and \
+                (is_space or self.open_elements[-1] is self.drop_newline):
+            if self.open_elements[-1] is self.drop_newline and data.startswith('\n'):
+                data = data[1:]
+            self.drop_newline = None
+
+        events = []
+        if self.phase != 'in body' and self.open_elements[-1] in (self.root, self.head):
+            if is_space and self.phase == 'before head':
+                # Whitespace before the head of the document is ignored
+                return events
+            elif not is_space:
+                events.extend(self.open_body())
+
+        if not is_space:
+            data = data.replace('\u0000', '')
+            if self.phase == 'in body':
+                self.check_table_context(None)
+        if data:
+            # Like html5lib, reopen formatting elements for text that isn't the raw text of
+            # an element like `script` or `title`.  `textarea`s are treated as markup here.
+            current_name = self.open_elements[-1].name
+            if self.phase == 'in body' and current_name not in _RAW_TEXT_PARENTS and \
+                    not self.in_select():
+                events.extend(self.reopen_formatting_elements())
+            events.append(('text', data))
+        return events
+
+    def finish(self):
+        events = []
+        if self.phase != 'in body':
+            events.extend(self.open_body())
+        while self.open_elements:
+            events.extend(self.close_element())
+        return events
+
+
+def iter_html_events(html):
+    '''
+    Stream through an HTML document without building a tree of the whole document.
+    `html` can be a string or a file-like object.  Yields tuples of:
+    * ('start', element) when an element opens
+    * ('end', element) when an element closes
+    * ('text', string) for text in the open element
+
+    Elements are `StreamedElement`s.  Like html5lib's tree builder, this adds the
+    `html`, `head`, and `body` elements when they are missing, drops the newline
+    at the start of `pre` elements, and closes elements with implied end tags
+    (like a `p` followed by a `div`), so elements have the same position they
+    would have in an `HtmlDocument`.  It also follows the tree builder's rules for
+    misnested formatting tags (reopening a `b` that a `p` closed, or closing an open
+    `a` when another starts), nested forms, selects, and table captions and columns.
+
+    Raises `MisnestedTagsError` for the misnesting the tree builder fixes by moving
+    elements that have already been yielded: a formatting tag that closes around a
+    block element, and content that isn't in a cell of the table it appears in.
+    '''
+
+    tokenizer = HTMLTokenizer(html)
+    builder = _StreamTreeBuilder(tokenizer)
+    yield ('start', builder.root)
+
+    for token in tokenizer:
+
+        token_type = token['type']
+        if token_type == tokenTypes['ParseError']:
+            continue
+        elif token_type == tokenTypes['Characters']:
+            events = builder.text(token['data'], is_space=False)
+        elif token_type == tokenTypes['SpaceCharacters']:
+            events = builder.text(token['data'], is_space=True)
+        else:
+            if token_type == tokenTypes['StartTag'] or token_type == tokenTypes['EmptyTag']:
+                # Like html5lib, keep the first value of attributes that are repeated
+                events = builder.start_tag(token['name'], dict(token['data'][::-1]))
+            elif token_type == tokenTypes['EndTag']:
+                events = builder.end_tag(token['name'])
+            elif token_type == tokenTypes['Doctype']:
+                builder.no_quirks = token['name'] == 'html' and token['publicId'] is None
+                continue
+            else:
+                continue
+
+        for event in events:
+            yield event
+
+    for event in builder.finish():
+        yield event
 
 
 def get_css_selector(tag):
-    ''' Create a CSS selector that can choose this tag from the document. '''
+    '''
+    Create a CSS selector that can choose this tag from the document.
+    For tags in an `HtmlDocument`, this uses the document's index.
+    '''
+
+    if isinstance(tag, StreamedElement):
+        element_selectors = []
+        while tag is not None:
+            if tag.parent is None:
+                element_selectors.append(tag.name.upper())
+            else:
+                element_selectors.append('%s:nth-of-type(%d)' % (tag.name.upper(), tag.index))
+            tag = tag.parent
+        return ' > '.join(reversed(element_selectors))
+
+    document = get_document(tag)
+    if document is not None and tag is not document:
+        return document.index.get_css_selector(tag)
+    return _get_css_selector_from_tree(tag)
+
+
+def _get_css_selector_from_tree(tag):
 
     elements = []
 
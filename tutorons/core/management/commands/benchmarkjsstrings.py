@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import time
+import contextlib
+from django.core.management.base import BaseCommand
+from slimit.lexer import Lexer as JsLexer
+
+from tutorons.core.htmltools import HtmlDocument
+from tutorons.core.extractor import JavascriptStringExtractor, JsLexerPool
+from tutorons.core.scanner import NodeScanner
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+SCRIPT_BLOCK = '\n'.join([
+    '<script>',
+    '// Show the greeting once the page has loaded',
+    '$(document).ready(function() {',
+    '  var greeting = "hello, " + name, half = $(window).width() / 2;',
+    '  /* Match ids like "item-12" */',
+    '  var pattern = /^item-(\\d+)$/i;',
+    "  $('#message').text(greeting).addClass('shown');",
+    '  if (count > 1) { label = "items"; } else { label = "item"; }',
+    '});',
+    '</script>',
+])
+
+
+class _NewLexerPool(object):
+    ''' Stand-in for a lexer pool that builds a new lexer for every input. '''
+
+    @contextlib.contextmanager
+    def lexer(self, text):
+        lexer = JsLexer()
+        lexer.input(text)
+        yield lexer
+
+
+class Command(BaseCommand):
+    """
+    Measure how long it takes to find strings in each script block of a page with
+    many script blocks: with slimit, building a new lexer for each block or reusing
+    lexers from a pool, and with the regex backend.
+    """
+
+    help = "Benchmark the per-node cost of extracting Javascript strings."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--blocks', type=int, default=300, help=(
+            "Number of script blocks on the page."
+        ))
+        parser.add_argument('--repeat', type=int, default=5, help=(
+            "Number of times to scan the page with each kind of extractor."
+        ))
+
+    def handle(self, *args, **options):
+
+        blocks = options['blocks']
+        document = HtmlDocument('<html><body>' + SCRIPT_BLOCK * blocks + '</body></html>')
+
+        pooled_lexers = JsLexerPool()
+        pooled_lexers.warm_up()
+        extractors = [
+            ('new lexer per node', JavascriptStringExtractor(lexer_pool=_NewLexerPool())),
+            ('pooled lexers', JavascriptStringExtractor(lexer_pool=pooled_lexers)),
+            ('regex backend', JavascriptStringExtractor(backend='regex')),
+        ]
+
+        self.stdout.write("Scanning a page with %d script blocks, best of %d runs" % (
+            blocks, options['repeat']))
+        for name, extractor in extractors:
+            scanner = NodeScanner(extractor, ['script'])
+            times = []
+            for _ in range(options['repeat']):
+                start_time = time.time()
+                regions = scanner.scan(document)
+                times.append(time.time() - start_time)
+            best_time = min(times)
+            self.stdout.write("%-20s %8.1f us/node  (%.3fs per page, %d regions)" % (
+                name, best_time / blocks * 1e6, best_time, len(regions)))
@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import os.path
+import codecs
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from tutorons.core.htmltools import get_parser_backends, DEFAULT_PARSER_BACKEND
+from tutorons.core.parsercheck import compare_parser_backends
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+class Command(BaseCommand):
+    """
+    Parse a corpus of web pages with each HTML parser backend, and report which
+    backends find regions at the same positions as html5lib, and how fast they are.
+    Only switch the HTML_PARSER setting to a backend that matches on all pages.
+    """
+
+    help = "Compare the positions of regions found by each HTML parser backend."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help=(
+            "HTML files, or directories of '.html' files, to parse."
+        ))
+        parser.add_argument('--backends', help=(
+            "Comma-separated list of backends to compare.  Defaults to all available."
+        ))
+        parser.add_argument('--detector', help=(
+            "Dotted path to a function that finds regions in an HtmlDocument " +
+            "(e.g., tutorons.modules.<name>.views.detect_code).  If not given, " +
+            "the selectors and text of all tags are compared."
+        ))
+        parser.add_argument('--verbose-differences', action='store_true', help=(
+            "Print each position that differs."
+        ))
+
+    def handle(self, *args, **options):
+
+        backends = options['backends'].split(',') if options['backends'] \
+            else get_parser_backends()
+        unknown_backends = [b for b in backends if b not in get_parser_backends()]
+        if unknown_backends:
+            raise CommandError("Unknown parser backends: " + ', '.join(unknown_backends))
+        detect_func = import_string(options['detector']) if options['detector'] else None
+
+        parse_times = dict((b, 0.0) for b in backends)
+        mismatched_pages = dict((b, 0) for b in backends)
+        pages = 0
+
+        for filename in self._find_pages(options['paths']):
+            with codecs.open(filename, encoding='utf-8', errors='replace') as page_file:
+                html = page_file.read()
+            pages += 1
+            comparisons = compare_parser_backends(html, backends, detect_func=detect_func)
+            for backend, comparison in comparisons.items():
+                parse_times[backend] += comparison['parse_time']
+                if comparison['missing'] or comparison['extra']:
+                    mismatched_pages[backend] += 1
+                    if options['verbose_differences']:
+                        self._print_differences(filename, backend, comparison)
+
+        self.stdout.write("Compared %d pages with %s" % (pages, DEFAULT_PARSER_BACKEND))
+        for backend in sorted(backends, key=lambda b: parse_times[b]):
+            self.stdout.write("%-12s %8.3fs total parse time, %d mismatched pages%s" % (
+                backend, parse_times[backend], mismatched_pages[backend],
+                " (offset-equivalent)" if mismatched_pages[backend] == 0 else "",
+            ))
+
+    def _find_pages(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, _, filenames in os.walk(path):
+                    for filename in sorted(filenames):
+                        if filename.endswith('.html') or filename.endswith('.htm'):
+                            yield os.path.join(dirpath, filename)
+            else:
+                yield path
+
+    def _print_differences(self, filename, backend, comparison):
+        self.stdout.write("%s (%s):" % (filename, backend))
+        for label, positions in [('-', comparison['missing']), ('+', comparison['extra'])]:
+            for position in positions:
+                self.stdout.write("  %s %s" % (label, repr(position)[:200]))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+# Tables whose integer ids are replaced with UUIDs, and the columns that refer to them
+UUID_TABLES = [
+    ('core_serverquery', [
+        ('core_region', 'query_id'),
+        ('core_clientquery', 'server_query_id'),
+        ('core_view', 'server_query_id'),
+    ]),
+    ('core_region', [
+        ('core_view', 'region_id'),
+    ]),
+]
+
+
+def replace_ids_with_uuids(apps, schema_editor):
+    ''' Give every existing query and region a UUID, and update the references to it. '''
+    quote_name = schema_editor.quote_name
+    with schema_editor.connection.cursor() as cursor:
+        for table, references in UUID_TABLES:
+            cursor.execute("SELECT id FROM %s" % quote_name(table))
+            for (old_id,) in cursor.fetchall():
+                new_id = uuid.uuid4().hex
+                cursor.execute(
+                    "UPDATE %s SET id = %%s WHERE id = %%s" % quote_name(table),
+                    [new_id, old_id])
+                for referring_table, column in references:
+                    cursor.execute(
+                        "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                            quote_name(referring_table), quote_name(column), quote_name(column)),
+                        [new_id, old_id])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='region',
+            name='created_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='region',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, serialize=False, editable=False, primary_key=True),
+        ),
+        migrations.AlterField(
+            model_name='serverquery',
+            name='end_time',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='serverquery',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, serialize=False, editable=False, primary_key=True),
+        ),
+        migrations.AlterField(
+            model_name='serverquery',
+            name='start_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        # The fields that refer to queries and regions are unchanged, but their
+        # columns need to be rebuilt to hold UUIDs.
+        migrations.AlterField(
+            model_name='region',
+            name='query',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, to='core.ServerQuery', null=True),
+        ),
+        migrations.AlterField(
+            model_name='clientquery',
+            name='server_query',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, to='core.ServerQuery', null=True),
+        ),
+        migrations.AlterField(
+            model_name='view',
+            name='server_query',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, to='core.ServerQuery', null=True),
+        ),
+        migrations.AlterField(
+            model_name='view',
+            name='region',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, to='core.Region', null=True),
+        ),
+        migrations.RunPython(replace_ids_with_uuids),
+    ]
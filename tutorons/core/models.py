@@ -1,7 +1,9 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import uuid
 from django.db import models
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 
@@ -25,10 +27,15 @@ class Block(models.Model):
 
 @python_2_unicode_compatible
 class ServerQuery(models.Model):
-    ''' A query made to this server. '''
-
-    start_time = models.DateTimeField(auto_now_add=True)
-    end_time = models.DateTimeField(null=True, blank=True, auto_now=True)
+    '''
+    A query made to this server.  Queries (and the regions found for them) have UUIDs
+    made by this server, so that they can be sent to clients before they are saved.
+    Their times are set when they're made, not when they're saved.
+    '''
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    start_time = models.DateTimeField(default=timezone.now)
+    end_time = models.DateTimeField(null=True, blank=True)
     ip_addr = models.GenericIPAddressField(blank=True, null=True)
     path = models.CharField(max_length=100)
 
@@ -58,9 +65,10 @@ class ClientQuery(models.Model):
 class Region(models.Model):
     ''' An explainable segment of text from a webpage. '''
 
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     query = models.ForeignKey(ServerQuery, on_delete=models.SET_NULL, null=True)
     block = models.ForeignKey(Block, on_delete=models.SET_NULL, null=True)
-    created_time = models.DateTimeField(auto_now_add=True)
+    created_time = models.DateTimeField(default=timezone.now)
 
     node = models.CharField(max_length=1000)
     start = models.IntegerField()
@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import time
+
+from tutorons.core.htmltools import HtmlDocument, get_css_selector, DEFAULT_PARSER_BACKEND
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def get_tag_positions(document):
+    '''
+    Get the selector and text of every tag in a document, in document order.  Regions
+    are located by the selector of their node and offsets into the node's text, so if
+    two parses of a page agree on these, they agree on the position of any region.
+    '''
+    return [(get_css_selector(t), document.get_node_text(t)) for t in document.index.tags]
+
+
+def get_region_positions(document, detect_func):
+    ''' Get the selector, offsets, and text of every region that `detect_func` finds. '''
+    return [
+        (get_css_selector(r.node), r.start_offset, r.end_offset, r.string)
+        for r in detect_func(document)
+    ]
+
+
+def compare_parser_backends(html, backends, reference=DEFAULT_PARSER_BACKEND, detect_func=None):
+    '''
+    Parse a page with each of the parser backends, and compare the positions found in the
+    parse with those found when it is parsed with the `reference` backend.  If `detect_func`
+    (a function from an `HtmlDocument` to a list of `Region`s) is given, the positions of
+    the regions it detects are compared.  Otherwise, the positions of all tags are compared.
+
+    Returns a dictionary with an entry for each backend, with:
+    * parse_time: the number of seconds it took to parse the page
+    * missing: positions found with the reference backend, but not with this backend
+    * extra: positions found with this backend, but not with the reference backend
+    '''
+    def get_positions(backend):
+        start_time = time.time()
+        document = HtmlDocument(html, parser=backend)
+        parse_time = time.time() - start_time
+        if detect_func is not None:
+            positions = get_region_positions(document, detect_func)
+        else:
+            positions = get_tag_positions(document)
+        return parse_time, positions
+
+    _, reference_positions = get_positions(reference)
+    reference_set = set(reference_positions)
+
+    comparisons = {}
+    for backend in backends:
+        parse_time, positions = get_positions(backend)
+        position_set = set(positions)
+        comparisons[backend] = {
+            'parse_time': parse_time,
+            'missing': [p for p in reference_positions if p not in position_set],
+            'extra': [p for p in positions if p not in reference_set],
+        }
+    return comparisons
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import cgi
+import zlib
+from django.conf import settings
+from django.http import QueryDict
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+DEFAULT_MAX_REQUEST_BODY_SIZE = 20 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+FORM_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+RAW_CONTENT_TYPES = ('text/html', 'text/plain')
+PARAM_HEADER_PREFIX = 'HTTP_X_TUTORONS_'
+
+
+class RequestBodyError(Exception):
+    ''' The body of a request can't be read.  `status` is the HTTP status to respond with. '''
+
+    def __init__(self, message, status):
+        super(RequestBodyError, self).__init__(message)
+        self.status = status
+
+
+def read_body(request, max_size):
+    '''
+    Read the body of a request, decompressing it if it has a Content-Encoding of gzip.
+    The body is read and decompressed a piece at a time, and reading stops with a
+    `RequestBodyError` as soon as it is more than `max_size` bytes.
+    '''
+    content_encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding in ('', 'identity'):
+        decompressor = None
+    else:
+        raise RequestBodyError("Unsupported Content-Encoding: " + content_encoding, 415)
+
+    pieces = []
+    size = 0
+    while True:
+        chunk = request.read(READ_CHUNK_SIZE)
+        if decompressor is not None:
+            try:
+                # Don't decompress more than one byte past the limit
+                chunk = decompressor.decompress(chunk, max_size - size + 1) if chunk \
+                    else decompressor.flush()
+            except zlib.error:
+                raise RequestBodyError("Request body is not valid gzip data", 400)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise RequestBodyError("Request body is larger than %d bytes" % max_size, 413)
+        pieces.append(chunk)
+    return b''.join(pieces)
+
+
+def get_request_params(request, body_param, raw_content_types=RAW_CONTENT_TYPES):
+    '''
+    Get the parameters of a request to scan a document or explain a snippet.  Clients can
+    send them in any of these ways:
+    * as a form, like before
+    * as a form compressed with gzip (with a `Content-Encoding: gzip` header)
+    * with the value of `body_param` (e.g., the document) as a body with one of the
+      `raw_content_types` (by default, `text/html` or `text/plain`), which can also be
+      compressed with gzip.  The other parameters are read from
+      the query string, and from headers named after them (e.g., `X-Tutorons-Origin` for
+      `origin`, or `X-Tutorons-Client-Start-Time` for `client_start_time`).
+
+    Bodies are read up to the MAX_REQUEST_BODY_SIZE setting (in bytes, after they are
+    decompressed).  Raises a `RequestBodyError` if the body can't be read.  Returns a
+    `QueryDict`, which also replaces `request.POST` so that code that logs the request
+    can read its parameters the usual way.
+    '''
+    content_type, content_params = cgi.parse_header(request.META.get('CONTENT_TYPE', ''))
+    content_encoding = request.META.get('HTTP_CONTENT_ENCODING', '')
+    if content_type in FORM_CONTENT_TYPES and not content_encoding:
+        return request.POST
+
+    if content_type not in FORM_CONTENT_TYPES + tuple(raw_content_types):
+        raise RequestBodyError("Unsupported Content-Type: " + content_type, 415)
+    if content_type == 'multipart/form-data':
+        raise RequestBodyError("Compressed multipart forms are not supported", 415)
+
+    max_size = getattr(settings, 'MAX_REQUEST_BODY_SIZE', DEFAULT_MAX_REQUEST_BODY_SIZE)
+    body = read_body(request, max_size)
+    charset = content_params.get('charset', settings.DEFAULT_CHARSET)
+    try:
+        if content_type in FORM_CONTENT_TYPES:
+            params = QueryDict(body, encoding=charset)
+        else:
+            params = request.GET.copy()
+            for key, value in request.META.items():
+                if key.startswith(PARAM_HEADER_PREFIX):
+                    params[key[len(PARAM_HEADER_PREFIX):].lower()] = value
+            params[body_param] = body.decode(charset)
+    except (LookupError, UnicodeDecodeError):
+        raise RequestBodyError("Request body is not valid " + charset, 400)
+
+    request.POST = params
+    return params
@@ -4,9 +4,17 @@
 from __future__ import unicode_literals
 import logging
 import re
-import copy
+import time
+import threading
+import contextlib
+import itertools
+import multiprocessing
 from bs4 import Tag
 
+from tutorons.core.htmltools import get_document, TreeIndex, HtmlDocument, iter_html_events, \
+    MisnestedTagsError, FORMATTING_ELEMENTS
+from tutorons.core.extractor import RegionSet
+
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 RARE_CHARACTER = '\u3222'  # A character we never expect to appear on an HTML page
@@ -20,47 +28,258 @@ class InvalidCommandException(Exception):
         self.exception = exception
 
 
+class ScanDeadline(object):
+    '''
+    A time by which scans should finish.  When scanners find that the deadline
+    has passed, they stop visiting nodes, return the regions they have found so
+    far, and mark the deadline as having truncated the scan.
+    '''
+
+    def __init__(self, time_budget=None):
+        self.start_time = time.time()
+        self.end_time = self.start_time + time_budget if time_budget is not None else None
+        self.truncated = False
+
+    def check(self):
+        ''' Check whether the deadline has passed.  If it has, mark the scan as truncated. '''
+        if self.end_time is not None and time.time() >= self.end_time:
+            self.truncated = True
+        return self.truncated
+
+    @property
+    def elapsed_time(self):
+        return time.time() - self.start_time
+
+
+_deadlines = threading.local()
+
+
+@contextlib.contextmanager
+def scan_deadline(time_budget):
+    '''
+    Give all scans in this thread a time budget (in seconds, or None for no limit)
+    until the end of the `with` block.  Yields the `ScanDeadline`.
+    '''
+    previous_deadline = getattr(_deadlines, 'current', None)
+    _deadlines.current = ScanDeadline(time_budget)
+    try:
+        yield _deadlines.current
+    finally:
+        _deadlines.current = previous_deadline
+
+
+def get_scan_deadline():
+    ''' Get the deadline for scans in this thread, or None if there isn't one. '''
+    return getattr(_deadlines, 'current', None)
+
+
+class MaskedNode(object):
+    '''
+    A view of an HTML node whose text has the characters of some of its children
+    blanked out.  Extractors read `text` from this view; all other attributes are
+    looked up on the original node, which is never copied or modified.
+    '''
+
+    def __init__(self, node, text):
+        self.node = node
+        self.text = text
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+
+
+class DetachedNode(object):
+    '''
+    Stand-in for an HTML node whose text is sent to a worker process for extraction.
+    It only has the name and (masked) text of the node it stands in for.
+    '''
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+
+
+def _iter_extract(extractor, node):
+    '''
+    Iterate over the regions an extractor finds in a node.  Extractors that have an
+    `iter_extract` method can yield regions as they find them; for all others, this
+    iterates over the list of regions from `extract`.
+    '''
+    if hasattr(extractor, 'iter_extract'):
+        return extractor.iter_extract(node)
+    return iter(extractor.extract(node))
+
+
+def _extract_detached(args):
+    '''
+    Extract regions from the text of many nodes in a worker process.  The extractor is
+    sent once with all of the nodes, instead of once for each node.
+    '''
+    extractor, nodes = args
+    node_regions = []
+    for name, text in nodes:
+        regions = extractor.extract(DetachedNode(name, text))
+        for r in regions:
+            r.node = None
+        node_regions.append(regions)
+    return node_regions
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    ''' Get a pool of worker processes shared by all scanners in this process, one per core. '''
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = multiprocessing.Pool()
+    return _worker_pool
+
+
 class NodeScanner(object):
-    ''' Scans document for explainable regions inside node types.'''
+    '''
+    Scans document for explainable regions inside node types.
+
+    If a `pool` of worker processes is given (e.g., from `get_worker_pool`), regions
+    are extracted from many nodes at once in the workers.  Extractors used this way
+    must be picklable, and can only read the `name` and `text` of the nodes they get.
+
+    If the extractor has an `extract_many(nodes)` method, it gets all nodes that can be
+    extracted from at once in a batch, instead of one node at a time.  It should return
+    a list with the regions for each node, in the same order as the nodes.
+
+    If a `cache` (an `ExtractionCache`) is given, regions are only extracted from
+    text that the extractor hasn't seen before.
+
+    If the thread has a deadline (see `scan_deadline`) that passes during a scan, the
+    scanner stops visiting nodes and returns the regions it has found so far.
+    '''
 
-    def __init__(self, extractor, tags):
+    def __init__(self, extractor, tags, pool=None, cache=None):
         self.extractor = extractor
         self.tags = tags
+        self.pool = pool
+        self.cache = cache
 
     def scan(self, document):
-        return self.visit(document)
+        '''
+        Find regions in all nodes with one of the scanner's tags.  Nodes are visited
+        children-first: once regions are found in a node, the text of that node is
+        blanked out when looking for regions in the nodes that contain it.
+        Returns a `RegionSet` of the regions, in the order that they were found.
+        '''
+        scan = _Scan(self, document)
+        if self.pool is not None:
+            self._scan_in_waves(scan, self._extract_in_pool)
+        elif hasattr(self.extractor, 'extract_many'):
+            self._scan_in_waves(scan, self._extract_many)
+        else:
+            return RegionSet(scan.index, self._iter_scan_serially(scan))
+
+        # Candidates that weren't visited before the deadline have no regions.
+        return RegionSet(scan.index, (
+            r for i in scan.post_order for r in (scan.regions[i] or [])))
+
+    def _scan_in_waves(self, scan, extract_batch):
+        '''
+        Extract regions from candidates one wave at a time.  The candidates in a wave whose
+        regions aren't cached are passed to `extract_batch` together, as a list of pairs of
+        a node and its masked text.  It returns a list of the regions found in each.
+        '''
+        deadline = get_scan_deadline()
+        for wave in scan.waves():
+            if deadline is not None and deadline.check():
+                break
+            uncached = []
+            for i in wave:
+                node = scan.candidates[i]
+                text = scan.masked_text(i)
+                key, regions = self._get_cached_regions(node, text)
+                if regions is None:
+                    uncached.append((i, key, text))
+                else:
+                    scan.add_regions(i, regions)
+            if not uncached:
+                continue
+            node_regions = extract_batch([(scan.candidates[i], text) for i, _, text in uncached])
+            for (i, key, _), regions in zip(uncached, node_regions):
+                regions = list(regions)
+                self._cache_regions(key, regions)
+                scan.add_regions(i, regions)
 
-    def visit(self, node):
+    def _extract_in_pool(self, nodes):
 
-        regions = []
-        children_with_regions = []
+        # Split the nodes into one task for each worker, so that the extractor (which
+        # can be large, like the automaton of a `KeywordExtractor`) is only pickled and
+        # sent to the workers a few times.
+        worker_count = getattr(self.pool, '_processes', None) or multiprocessing.cpu_count()
+        task_size = -(-len(nodes) // worker_count)
+        tasks = [
+            (self.extractor, [(node.name, text) for node, text in nodes[i:i + task_size]])
+            for i in range(0, len(nodes), task_size)
+        ]
+        return [regions for task_regions in self.pool.map(_extract_detached, tasks)
+                for regions in task_regions]
 
-        if hasattr(node, 'children'):
-            for c in node.children:
-                child_regions = self.visit(c)
-                regions.extend(child_regions)
-                if len(child_regions) >= 1:
-                    children_with_regions.append(c)
+    def _extract_many(self, nodes):
+        return self.extractor.extract_many([MaskedNode(node, text) for node, text in nodes])
 
-        # To avoid sensing the same explainable region twice, we literally
-        # 'blank out' tags in which regions have been detected when examining
-        # their parent for regions.
-        if type(node) is Tag and node.name in self.tags and self.extract_allowed(node):
-            node_clone = copy.copy(node)
-            for c in node_clone.children:
-                if c in children_with_regions:
-                    c.replace_with(' ' * len(c.text))
+    def iter_scan(self, document):
+        '''
+        Find the same regions as `scan`, in the same order, yielding each region as
+        soon as the extractor finds it.  Consumers can handle the first regions before
+        the rest of the document has been scanned.  Scanners with a worker pool or an
+        extractor with `extract_many` extract from many nodes at once, so they yield
+        regions after the scan is done.
+        '''
+        if self.pool is not None or hasattr(self.extractor, 'extract_many'):
+            return iter(self.scan(document))
+        return self._iter_scan_serially(_Scan(self, document))
 
-            # As the clone is detached from the rest of the document, we need
-            # to reset the region's parent node to the original node, even though
-            # the text and position of the region found is the same
-            node_regions = self.extractor.extract(node_clone)
-            for r in node_regions:
-                r.node = node
+    def _iter_scan_serially(self, scan):
+        deadline = get_scan_deadline()
+        for i in scan.post_order:
+            if deadline is not None and deadline.check():
+                break
+            node = scan.candidates[i]
+            found_regions = False
+            for region in self._extract_regions(node, scan.masked_text(i)):
+                found_regions = True
+                yield region
+            scan.finish(i, found_regions)
 
-            regions.extend(node_regions)
+    def _extract_regions(self, node, text):
+        '''
+        Iterate over the regions in the text of a node (with some of its children
+        blanked out), from the cache or from the extractor.  Regions point to `node`.
+        '''
+        key, regions = self._get_cached_regions(node, text)
+        if regions is not None:
+            for r in regions:
+                yield r
+            return
 
-        return regions
+        # Keep the regions to save in the cache once the extractor is done with the node
+        found_regions = [] if self.cache is not None else None
+        for r in _iter_extract(self.extractor, MaskedNode(node, text)):
+            r.node = node
+            if found_regions is not None:
+                found_regions.append(r)
+            yield r
+        self._cache_regions(key, found_regions)
+
+    def _get_cached_regions(self, node, text):
+        ''' Get the cache key for a node's text, and the regions cached for it, if any. '''
+        if self.cache is None:
+            return None, None
+        key = self.cache.get_key(self.extractor, node.name, text)
+        return key, self.cache.get(key, node)
+
+    def _cache_regions(self, key, regions):
+        if self.cache is not None:
+            self.cache.set(key, regions)
 
     def extract_allowed(self, node):
         '''
@@ -68,3 +287,244 @@ class NodeScanner(object):
         Override this for your subclasses of scanner.
         '''
         return True
+
+
+class StreamScanner(NodeScanner):
+    '''
+    Scans the HTML of a document for explainable regions without building a tree of
+    the document.  Text is only kept while inside an element with one of the scanner's
+    tags, and regions are extracted from an element as soon as it closes, so a scan
+    needs about as much memory as the largest element it scans.
+
+    Regions point to `StreamedElement`s instead of BeautifulSoup nodes.  These have
+    the name, attributes, and text of the element, and can be passed to `get_css_selector`.
+    The regions found are the same as those found by a `NodeScanner`.
+
+    Some misnested tags make browsers move elements that have already been streamed
+    (see `iter_html_events`).  Regions found inside of formatting elements (like `b`) are
+    held back until those elements close, as they are the only ones that can be moved.
+    If the scanner runs into such tags, it parses the whole document, and yields the
+    rest of the regions from a scan of its tree, so those regions point to BeautifulSoup
+    nodes.  If `html` is a file, it must be seekable for this.
+    '''
+
+    def __init__(self, extractor, tags, cache=None):
+        super(StreamScanner, self).__init__(extractor, tags, cache=cache)
+
+    def scan(self, html):
+        ''' Find regions in the HTML of a document.  Returns a `RegionSet` of the regions. '''
+        return RegionSet(regions=self.iter_scan(html))
+
+    def iter_scan(self, html):
+        ''' Find regions in the HTML of a document, yielding each region as it is found. '''
+
+        regions = self._iter_scan_stream(html)
+        yielded_count = 0
+        held_regions = []
+        try:
+            for region, can_move in regions:
+                if can_move:
+                    held_regions.append(region)
+                    continue
+                for held_region in held_regions + [region]:
+                    yielded_count += 1
+                    yield held_region
+                held_regions = []
+            for held_region in held_regions:
+                yield held_region
+        except MisnestedTagsError as error:
+            logging.info("Scanning tree of document with misnested tags: %s", error)
+            if hasattr(html, 'read'):
+                html.seek(0)
+                html = html.read()
+            document = HtmlDocument(html, parser='html5lib')
+            tree_regions = self._iter_scan_serially(_Scan(self, document))
+            for region in itertools.islice(tree_regions, yielded_count, None):
+                yield region
+
+    def _iter_scan_stream(self, html):
+        '''
+        Find regions in the HTML of a document.  Yields pairs of a region and whether
+        it's inside of a formatting element, where html5lib could move it later.
+        '''
+
+        # Text of the open elements with the scanner's tags, and the elements they contain
+        pieces = []
+        text_length = 0
+        open_targets = 0
+        open_formatting_elements = 0
+
+        # For each open element, we save the element, where its text starts, the spans of
+        # text of its children to blank out, and whether regions were found inside of it.
+        stack = []
+        deadline = get_scan_deadline()
+
+        for event, value in iter_html_events(html):
+
+            if deadline is not None and deadline.check():
+                break
+
+            if event == 'text':
+                if open_targets > 0:
+                    pieces.append(value)
+                    text_length += len(value)
+
+            elif event == 'start':
+                if value.name in FORMATTING_ELEMENTS:
+                    open_formatting_elements += 1
+                is_target = value.name in self.tags
+                if is_target:
+                    open_targets += 1
+                inside_target = open_targets > 0
+                stack.append([
+                    value,
+                    (len(pieces), text_length) if inside_target else None,
+                    [] if is_target else None,
+                    False,
+                ])
+
+            elif event == 'end':
+
+                element, start, blanked_spans, has_regions = stack.pop()
+                if element.name in FORMATTING_ELEMENTS:
+                    open_formatting_elements -= 1
+                if blanked_spans is not None:
+                    has_regions = has_regions or len(blanked_spans) > 0
+                    start_piece, start_char = start
+                    element.text = ''.join(pieces[start_piece:])
+                    if self.extract_allowed(element):
+                        masked_text = self._mask(element.text, blanked_spans, start_char)
+                        for region in self._extract_regions(element, masked_text):
+                            has_regions = True
+                            yield region, open_formatting_elements > 0
+                    open_targets -= 1
+                    if open_targets == 0:
+                        pieces = []
+                        text_length = 0
+
+                # Blank out this element when scanning the closest element with one of
+                # the scanner's tags that contains it.  If this element isn't inside such
+                # an element, the ancestors of this element also contain regions.
+                if has_regions and stack:
+                    parent = stack[-1]
+                    if parent[2] is not None and start is not None:
+                        parent[2].append((start[1], text_length))
+                    else:
+                        parent[3] = True
+
+    def _mask(self, text, blanked_spans, start_char):
+        if blanked_spans:
+            masked_pieces = []
+            last_end = 0
+            for span_start, span_end in blanked_spans:
+                span_start -= start_char
+                span_end -= start_char
+                masked_pieces.append(text[last_end:span_start])
+                masked_pieces.append(' ' * (span_end - span_start))
+                last_end = span_end
+            masked_pieces.append(text[last_end:])
+            text = ''.join(masked_pieces)
+        return text
+
+
+class _Scan(object):
+    '''
+    The state of one scan of a document: the candidate nodes to extract regions from,
+    how they are nested, and the regions found in them so far.
+    '''
+
+    def __init__(self, scanner, document):
+
+        html_document = get_document(document)
+        self.index = html_document.index if html_document is not None else TreeIndex(document)
+        self.candidates = [
+            n for n in self.index.find_all(scanner.tags, within=document)
+            if type(n) is Tag and scanner.extract_allowed(n)
+        ]
+
+        # For each candidate, find the closest candidate that encloses it, and the
+        # order to visit candidates so that each is visited after those it encloses.
+        # We use an explicit stack instead of recursing, so that deeply nested pages
+        # don't exceed the recursion limit.
+        self.enclosing = [None] * len(self.candidates)
+        self.post_order = []
+        stack = []
+        for i, node in enumerate(self.candidates + [None]):
+            position = self.index.get_extent(node)[0] if node is not None \
+                else len(self.index.tags)
+            while stack and position >= self.index.get_extent(self.candidates[stack[-1]])[1]:
+                self.post_order.append(stack.pop())
+            if node is not None:
+                self.enclosing[i] = stack[-1] if stack else None
+                stack.append(i)
+
+        self.regions = [None] * len(self.candidates)
+        self.children_with_regions = [{} for _ in self.candidates]
+
+    def waves(self):
+        '''
+        Group candidates into waves that can be extracted from independently.  Each wave
+        holds the candidates that enclose others at most as deeply nested as the earlier waves.
+        '''
+        heights = [0] * len(self.candidates)
+        for i in self.post_order:
+            parent = self.enclosing[i]
+            if parent is not None:
+                heights[parent] = max(heights[parent], heights[i] + 1)
+        waves = [[] for _ in range(max(heights) + 1)] if heights else []
+        for i, height in enumerate(heights):
+            waves[height].append(i)
+        return waves
+
+    def masked_text(self, i):
+        '''
+        Get the text of a candidate, with the text of its children in which regions
+        have been found replaced by spaces.  Blanking these children out keeps
+        the scanner from sensing the same explainable region twice.
+        '''
+        node = self.candidates[i]
+        text = self.index.get_text(node)
+        blanked_children = sorted(
+            self.children_with_regions[i].values(),
+            key=lambda c: self.index.get_extent(c)[0]
+        )
+        if not blanked_children:
+            return text
+
+        node_start = self.index.get_text_span(node)[0]
+        pieces = []
+        last_end = 0
+        for c in blanked_children:
+            start, end = self.index.get_text_span(c)
+            start -= node_start
+            end -= node_start
+            pieces.append(text[last_end:start])
+            pieces.append(' ' * (end - start))
+            last_end = end
+        pieces.append(text[last_end:])
+        return ''.join(pieces)
+
+    def add_regions(self, i, regions):
+        ''' Save the regions extracted from a candidate. '''
+
+        # Extractors create regions that point to a view of the node, so we need
+        # to reset each region's node to the original node.  The text and
+        # position of the region found is the same.
+        node = self.candidates[i]
+        for r in regions:
+            r.node = node
+        self.regions[i] = regions
+        self.finish(i, len(regions) > 0)
+
+    def finish(self, i, found_regions):
+        ''' Mark a candidate as visited, noting whether any regions were found in its text. '''
+
+        # Let the closest enclosing candidate know which of its children contains regions.
+        node = self.candidates[i]
+        parent = self.enclosing[i]
+        if parent is not None and (found_regions or self.children_with_regions[i]):
+            ancestor = self.candidates[parent]
+            child = node
+            while child.parent is not ancestor:
+                child = child.parent
+            self.children_with_regions[parent][id(child)] = child
@@ -25,7 +25,7 @@ class CodeDetectionTest(unittest.TestCase):
             "  </body>",
             "</html>",
         ]))
-        code_regions = detect_code(html_doc)
+        code_regions = list(detect_code(html_doc))
 
         self.assertEqual(1, len(code_regions))
         code_region = code_regions[0]
@@ -5,4 +5,5 @@ urlpatterns = patterns(
     '',
     url(r'^example$', 'tutorons.modules.{{ app_name }}.views.example', name='example'),
     url(r'^scan$', 'tutorons.modules.{{ app_name }}.views.scan', name='scan'),
+    url(r'^scan_batch$', 'tutorons.modules.{{ app_name }}.views.scan_batch', name='scan_batch'),
 )
@@ -9,12 +9,40 @@ from django.template.loader import get_template
 from django.template import Context
 
 from tutorons.core.scanner import NodeScanner
-from tutorons.core.views import pagescan, snippetexplain
+from tutorons.core.cache import ExtractionCache, ExplanationCache, ScanResultCache
+from tutorons.core.views import pagescan, pagescan_batch, snippetexplain
 from detect import {{ title_case_app_name }}Extractor
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
+# The version of how this module detects and explains code.  All of the caches below
+# save their results under it, so change it whenever you change how code is detected
+# or explained, and the old results will be ignored.
+VERSION = '1'
+
+# Regions found in the text of HTML elements are saved here, so that code that
+# appears on many pages only needs to be detected once.
+extraction_cache = ExtractionCache(version=VERSION)
+
+# Explanations are saved in Django's cache, so that code that appears on many pages,
+# or in many requests at once, only needs to be explained once.
+explanation_cache = ExplanationCache('{{ app_name }}', version=VERSION)
+
+# The regions and explanations found for each page are saved too, so that pages that
+# are sent again aren't scanned again.  Clients that send a page's ETag in an
+# If-None-Match header get a 412 status if its results haven't changed, and new
+# results once the version changes.
+scan_result_cache = ScanResultCache('{{ app_name }}', version=VERSION)
+
+# HTML tags of the elements where code will be detected.  Add extra HTML tags to this
+# list (e.g., 'p', 'div') if you want to detect code entities in HTML elements besides
+# those listed here.  Pages without any of these tags are skipped without being parsed.
+SCANNED_TAGS = [
+    'code',
+    'pre',
+]
+
 
 def detect_code(html_doc):
     '''
@@ -25,30 +53,27 @@ def detect_code(html_doc):
                   tree should be traversed to find explainable code.
 
     Returns:
-        A list of `Region`s, one for each piece of code found
+        An iterator over `Region`s, one for each piece of code found.
+        Call `list` on it if you need all of the regions at once.
     '''
 
     # You will need to implement this class in the `detect.py` file.
     # The extractor takes in an HTML element and extracts pieces of code
-    # that you want to explain.
+    # that you want to explain.  If it's a `KeywordExtractor`, you only need
+    # to list the symbols to find, and its automaton is only built once.
     extractor = {{ title_case_app_name }}Extractor()
 
     # The NodeScanner picks elements from an HTML document where code should be
     # detected, and iterates through them.  It does a pre-order (children-first)
     # traversal: if a piece of code is extracted from a child node, it won't
     # be found a second time in the parent node.
-    scanner = NodeScanner(extractor, [
-        # Add extra HTML tags to this list (e.g., 'p', 'div') if you want to
-        # detect code entities in HTML elements besides those listed here.
-        'code',
-        'pre',
-    ])
-
-    # The scanner will return a list of regions of explainable code.
+    scanner = NodeScanner(extractor, SCANNED_TAGS, cache=extraction_cache)
+
+    # The scanner will yield regions of explainable code as it finds them.
     # Each region includes the text of the code found as well as a pointer
     # to its location (HTML element and text offset).
     # See `Region` in `tutorons.core.detect`
-    explainable_regions = scanner.scan(html_doc)
+    explainable_regions = scanner.iter_scan(html_doc)
 
     return explainable_regions
 
@@ -100,9 +125,17 @@ def render_explanation_as_html(code_string, explanation):
     return explanation_html
 
 
-@csrf_exempt
-@pagescan
-def scan(html_doc):
+@explanation_cache.memoize
+def explain_code_as_html(code_string):
+    '''
+    Explain a piece of code and render the explanation as HTML.  The result is
+    looked up in the explanation cache before the code is explained.
+    '''
+    explanation = explain_code(code_string)
+    return render_explanation_as_html(code_string, explanation)
+
+
+def annotate_code(html_doc):
     '''
     Create annotations for all explainable code in a web page.
 
@@ -110,18 +143,14 @@ def scan(html_doc):
         html_doc: an `HTMLDocument`, representing a web page whose element
                   tree should be traversed to find explainable code.
 
-    Return:
-        A list of tuples.  Each tuple is a pair, where the first element is
+    Yields:
+        Tuples.  Each tuple is a pair, where the first element is
         a `Region` representing detected code, and the second element is a
         string of the HTML that should be shown in a tooltip when a user
-        wants an explanation for that code.
+        wants an explanation for that code.  Pairs are yielded one at a time,
+        so each region is explained as soon as it is detected.
     '''
 
-    # This list will eventually contain pairs (tuples) of two elements:
-    # 1. A region where explainable code was detected
-    # 2. HTML that should be shown in a tooltip next to that code
-    rendered_regions = []
-
     # Detect all explainable code in the document
     explainable_regions = detect_code(html_doc)
 
@@ -131,16 +160,32 @@ def scan(html_doc):
         # Get the code that was detected for this region
         code_string = region.string
 
-        # Create an explanation for the code
-        explanation = explain_code(code_string)
-
-        # Render the explanation as HTML that can be viewed in a tooltip
-        explanation_html = render_explanation_as_html(code_string, explanation)
+        # Create an explanation for the code, rendered as HTML that can be viewed
+        # in a tooltip.  Code that has been explained before comes from the cache.
+        explanation_html = explain_code_as_html(code_string)
 
         # Link the explainable code to the HTML of its explanation
-        rendered_regions.append((region, explanation_html))
+        yield (region, explanation_html)
+
+
+@csrf_exempt
+@pagescan(tags=SCANNED_TAGS, result_cache=scan_result_cache)
+def scan(html_doc):
+    '''
+    Handle a request to annotate the code in a web page.  The wrapper fetches the page
+    from the request, logs the request and its results, and sends the annotations back.
+    '''
+    return annotate_code(html_doc)
+
 
-    return rendered_regions
+@csrf_exempt
+@pagescan_batch(tags=SCANNED_TAGS)
+def scan_batch(html_doc):
+    '''
+    Handle a request to annotate the code in many web pages at once (e.g., all of the
+    frames of a page).  The pages are annotated one at a time, and logged as one query.
+    '''
+    return annotate_code(html_doc)
 
 
 def example(request):
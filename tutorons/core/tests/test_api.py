@@ -3,16 +3,26 @@
 
 from __future__ import unicode_literals
 import logging
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from tastypie.test import ResourceTestCaseMixin
 import datetime
+import uuid
 
+from tutorons.core import dblogger
 from tutorons.core.models import ServerQuery, ClientQuery
+from tutorons.core.dblogger import DbLogWriter
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 
+class UnstartedDbLogWriter(DbLogWriter):
+    ''' Writer that keeps the records put in it waiting, without a thread to save them. '''
+
+    def start(self):
+        pass
+
+
 class WriteOnlyMetaTest(ResourceTestCaseMixin, TestCase):
     '''
     We test the write-only meta (which only enables creating at list level) by testing
@@ -50,6 +60,48 @@ class WriteOnlyMetaTest(ResourceTestCaseMixin, TestCase):
         ))
         self.assertEqual(ClientQuery.objects.count(), 2)
 
+    def post_client_query(self, server_query_id):
+        return self.api_client.post(
+            '/api/v1/client_query/',
+            format='json',
+            data={
+                'start_time': '2016-01-01T01:00:00',
+                'end_time': '2016-01-01T01:00:05',
+                'server_query': '/api/v1/server_query/{0}/'.format(server_query_id),
+            }
+        )
+
+    def test_refer_to_server_query_by_uuid(self):
+        # Queries are referred to by the UUID strings sent with scan results, not integers.
+        self.assertIsInstance(self.server_query.pk, uuid.UUID)
+        self.assertEqual(self.post_client_query(1).status_code, 400)
+        self.assertEqual(ClientQuery.objects.count(), 1)
+
+    def test_refuse_server_query_that_does_not_exist(self):
+        self.assertEqual(self.post_client_query(uuid.uuid4()).status_code, 400)
+        self.assertEqual(ClientQuery.objects.count(), 1)
+
+    @override_settings(DB_LOG_ASYNC=True)
+    def test_post_item_for_server_query_waiting_to_be_saved(self):
+        dblogger._db_log_writer = UnstartedDbLogWriter()
+        try:
+            server_query = ServerQuery(ip_addr='192.168.0.0', path='/python/scan')
+            dblogger._db_log_writer.put([server_query])
+            self.assertHttpCreated(self.post_client_query(server_query.pk))
+            self.assertEqual(
+                ClientQuery.objects.filter(server_query_id=server_query.pk).count(), 1)
+        finally:
+            dblogger._db_log_writer = None
+
+    @override_settings(DB_LOG_ASYNC=True)
+    def test_refuse_server_query_not_waiting_to_be_saved(self):
+        dblogger._db_log_writer = UnstartedDbLogWriter()
+        try:
+            self.assertEqual(self.post_client_query(uuid.uuid4()).status_code, 400)
+            self.assertEqual(ClientQuery.objects.count(), 1)
+        finally:
+            dblogger._db_log_writer = None
+
     def test_get_detail_not_allowed(self):
         self.assertHttpMethodNotAllowed(self.api_client.get(
             '/api/v1/client_query/{0}/'.format(self.client_query.pk)))
@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import unittest
+import threading
+from django.core.cache.backends.locmem import LocMemCache
+
+from tutorons.core.cache import LruCache, ExtractionCache, ExplanationCache
+from tutorons.core.metrics import counters
+from tutorons.core.htmltools import HtmlDocument
+from tutorons.core.scanner import NodeScanner
+from tutorons.core.tests.test_node_visitor import HelloTextExtractor
+from tutorons.core.tests.test_region_set import CommandExtractor, CommandRegion
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+class LruCacheTest(unittest.TestCase):
+
+    def test_get_value_that_was_set(self):
+        cache = LruCache(2)
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertIsNone(cache.get('other key'))
+
+    def test_evict_least_recently_used_entry(self):
+        cache = LruCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_evict_by_size_of_entries(self):
+        cache = LruCache(10, sizeof=len)
+        cache.set('a', 'x' * 6)
+        cache.set('b', 'x' * 6)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 6)
+
+    def test_skip_entries_larger_than_cache(self):
+        cache = LruCache(10, sizeof=len)
+        cache.set('a', 'x' * 11)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 0)
+
+
+class ExtractionCacheTest(unittest.TestCase):
+
+    def test_extract_from_repeated_text_once(self):
+        cache = ExtractionCache()
+        extractor = HelloTextExtractor()
+        scanner = NodeScanner(extractor, ['p'], cache=cache)
+        document = HtmlDocument('<p>hello</p><p>hello</p>')
+        regions = scanner.scan(document)
+        self.assertEqual(extractor.texts_seen, ['hello'])
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(len(regions), 2)
+        self.assertIs(regions[1].node, document.find_all('p')[1])
+        self.assertEqual((regions[1].start_offset, regions[1].end_offset), (0, 4))
+
+    def test_cache_region_subclasses_and_their_attributes(self):
+        backend = LocMemCache('extraction-subclass-test', {})
+        document = HtmlDocument('<p>ls</p><p>ls</p>')
+        for cache in [ExtractionCache(), ExtractionCache(), ExtractionCache(backend=backend)]:
+            regions = NodeScanner(CommandExtractor(), ['p'], cache=cache).scan(document)
+            self.assertEqual([type(r) for r in regions], [CommandRegion, CommandRegion])
+            self.assertEqual([r.cmd for r in regions], ['list', 'list'])
+            self.assertIs(regions[1].node, document.find_all('p')[1])
+
+    def test_count_hits_in_process_metrics(self):
+        hits = counters['extraction_cache_hits']
+        misses = counters['extraction_cache_misses']
+        scanner = NodeScanner(HelloTextExtractor(), ['p'], cache=ExtractionCache())
+        scanner.scan(HtmlDocument('<p>hello</p><p>hello</p>'))
+        self.assertEqual(counters['extraction_cache_hits'], hits + 1)
+        self.assertEqual(counters['extraction_cache_misses'], misses + 1)
+
+    def test_cache_results_by_extractor_version(self):
+        cache = ExtractionCache()
+        extractor = HelloTextExtractor()
+        scanner = NodeScanner(extractor, ['p'], cache=cache)
+        scanner.scan(HtmlDocument('<p>hello</p>'))
+        extractor.version = 2
+        scanner.scan(HtmlDocument('<p>hello</p>'))
+        self.assertEqual(extractor.texts_seen, ['hello', 'hello'])
+
+    def test_cache_results_by_cache_version(self):
+        backend = LocMemCache('extraction-version-test', {})
+        extractor = HelloTextExtractor()
+        for version in ['1', '1', '2']:
+            cache = ExtractionCache(backend=backend, version=version)
+            NodeScanner(extractor, ['p'], cache=cache).scan(HtmlDocument('<p>hello</p>'))
+        self.assertEqual(extractor.texts_seen, ['hello', 'hello'])
+
+    def test_share_results_through_backend(self):
+        backend = LocMemCache('extraction-test', {})
+        scanner = NodeScanner(HelloTextExtractor(), ['p'], cache=ExtractionCache(backend=backend))
+        scanner.scan(HtmlDocument('<p>hello</p>'))
+
+        cache = ExtractionCache(backend=backend)
+        extractor = HelloTextExtractor()
+        regions = NodeScanner(extractor, ['p'], cache=cache).scan(HtmlDocument('<p>hello</p>'))
+        self.assertEqual(extractor.texts_seen, [])
+        self.assertEqual(cache.stats['shared_hits'], 1)
+        self.assertEqual(regions[0].string, 'hello')
+
+
+class ExplanationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = LocMemCache('explanation-test', {})
+        self.backend.clear()
+        self.explained = []
+
+    def explain(self, string):
+        self.explained.append(string)
+        return "Explanation of " + string
+
+    def test_explain_repeated_string_once(self):
+        cache = ExplanationCache('module', backend=self.backend)
+        self.assertEqual(cache.get_or_explain('foo', self.explain), "Explanation of foo")
+        self.assertEqual(cache.get_or_explain('foo', self.explain), "Explanation of foo")
+        self.assertEqual(self.explained, ['foo'])
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['hits'], 1)
+
+    def test_cache_region_subclasses_and_their_attributes(self):
+        backend = LocMemCache('extraction-subclass-test', {})
+        document = HtmlDocument('<p>ls</p><p>ls</p>')
+        for cache in [ExtractionCache(), ExtractionCache(), ExtractionCache(backend=backend)]:
+            regions = NodeScanner(CommandExtractor(), ['p'], cache=cache).scan(document)
+            self.assertEqual([type(r) for r in regions], [CommandRegion, CommandRegion])
+            self.assertEqual([r.cmd for r in regions], ['list', 'list'])
+            self.assertIs(regions[1].node, document.find_all('p')[1])
+
+    def test_count_hits_in_process_metrics(self):
+        hits = counters['explanation_cache_hits']
+        cache = ExplanationCache('module', backend=self.backend)
+        cache.get_or_explain('foo', self.explain)
+        cache.get_or_explain('foo', self.explain)
+        self.assertEqual(counters['explanation_cache_hits'], hits + 1)
+
+    def test_cache_explanations_by_module_and_version(self):
+        ExplanationCache('module', version=1, backend=self.backend).get_or_explain(
+            'foo', self.explain)
+        ExplanationCache('module', version=2, backend=self.backend).get_or_explain(
+            'foo', self.explain)
+        ExplanationCache('other', version=1, backend=self.backend).get_or_explain(
+            'foo', self.explain)
+        self.assertEqual(self.explained, ['foo', 'foo', 'foo'])
+
+    def test_cache_explanation_of_none(self):
+        cache = ExplanationCache('module', backend=self.backend)
+        explain = lambda string: self.explained.append(string)
+        self.assertIsNone(cache.get_or_explain('foo', explain))
+        self.assertIsNone(cache.get_or_explain('foo', explain))
+        self.assertEqual(self.explained, ['foo'])
+
+    def test_memoize_explanation_function(self):
+        cache = ExplanationCache('module', backend=self.backend)
+        explain = cache.memoize(self.explain)
+        explain('foo')
+        self.assertEqual(explain('foo'), "Explanation of foo")
+        self.assertEqual(self.explained, ['foo'])
+        self.assertIs(explain.cache, cache)
+
+    def test_explain_once_when_many_threads_need_explanation(self):
+
+        cache = ExplanationCache('module', backend=self.backend)
+        explaining = threading.Event()
+        finish_explaining = threading.Event()
+
+        def slow_explain(string):
+            explaining.set()
+            finish_explaining.wait()
+            return self.explain(string)
+
+        results = []
+
+        def get_explanation():
+            results.append(cache.get_or_explain('foo', slow_explain))
+
+        threads = [threading.Thread(target=get_explanation) for _ in range(4)]
+        threads[0].start()
+        explaining.wait()
+        for thread in threads[1:]:
+            thread.start()
+        finish_explaining.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.explained, ['foo'])
+        self.assertEqual(results, ["Explanation of foo"] * 4)
+
+    def test_use_explanation_saved_after_cache_was_checked(self):
+
+        # The first lookup misses, as if another thread saved the explanation right after
+        cache = ExplanationCache('module', backend=self.backend)
+        self.backend.set(cache.get_key('foo'), ("Explanation of foo",))
+        lookups = []
+        get = self.backend.get
+
+        def get_after_first_lookup(key, *args, **kwargs):
+            lookups.append(key)
+            return get(key, *args, **kwargs) if len(lookups) > 1 else None
+
+        self.backend.get = get_after_first_lookup
+        self.assertEqual(cache.get_or_explain('foo', self.explain), "Explanation of foo")
+        self.assertEqual(self.explained, [])
+
+    def test_wait_for_explanation_from_process_with_lock(self):
+        cache = ExplanationCache('module', backend=self.backend, poll_interval=.01)
+        key = cache.get_key('foo')
+        self.backend.add(key + ':lock', True)
+        timer = threading.Timer(.05, self.backend.set, [key, ("Shared explanation",)])
+        timer.start()
+        explanation = cache.get_or_explain('foo', self.explain)
+        timer.join()
+        self.assertEqual(explanation, "Shared explanation")
+        self.assertEqual(self.explained, [])
+        self.assertEqual(cache.stats['waits'], 1)
+
+    def test_explain_if_process_with_lock_takes_too_long(self):
+        cache = ExplanationCache('module', backend=self.backend, lock_timeout=.05,
+                                 poll_interval=.01)
+        self.backend.add(cache.get_key('foo') + ':lock', True)
+        self.assertEqual(cache.get_or_explain('foo', self.explain), "Explanation of foo")
+        self.assertEqual(self.explained, ['foo'])
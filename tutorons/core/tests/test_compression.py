@@ -0,0 +1,328 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import json
+import zlib
+import types
+import unittest
+import mock
+from django.test import TestCase, RequestFactory, override_settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.urlresolvers import reverse
+from django.core.cache.backends.locmem import LocMemCache
+
+from tutorons.middleware import compression
+from tutorons.middleware.compression import CompressionMiddleware, choose_encoding, \
+    get_available_encodings
+from tutorons.core.views import pagescan
+from tutorons.core.cache import ScanResultCache
+from tutorons.core.tests.test_views import scan_hellos
+from tutorons.core.metrics import counters
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class _StubCompressor(object):
+    ''' Compressor for stub modules, that makes raw deflate data and records its level. '''
+
+    levels = []
+    flush_modes = []
+
+    def __init__(self, level):
+        self.levels.append(level)
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self, flush_mode=None):
+        self.flush_modes.append(flush_mode)
+        if flush_mode is None:
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class _StubBrotliCompressor(_StubCompressor):
+
+    def __init__(self, quality):
+        super(_StubBrotliCompressor, self).__init__(quality)
+
+    def process(self, data):
+        return self.compress(data)
+
+    def flush(self):
+        return super(_StubBrotliCompressor, self).flush(flush_mode='flush')
+
+    def finish(self):
+        return super(_StubBrotliCompressor, self).flush()
+
+
+class _StubZstdCompressor(object):
+
+    def __init__(self, level):
+        self.level = level
+
+    def compressobj(self):
+        return _StubCompressor(self.level)
+
+
+def inflate(data):
+    return zlib.decompress(data, -zlib.MAX_WBITS)
+
+
+def make_stub_modules():
+    ''' Make stand-ins for the brotli and zstandard modules, which may not be installed. '''
+    brotli = types.ModuleType(str('brotli'))
+    brotli.Compressor = _StubBrotliCompressor
+    zstandard = types.ModuleType(str('zstandard'))
+    zstandard.ZstdCompressor = _StubZstdCompressor
+    zstandard.COMPRESSOBJ_FLUSH_BLOCK = 'block'
+    return brotli, zstandard
+
+
+class ChooseEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encodings = [('br', None), ('gzip', None)]
+
+    def get_encoding_name(self, header):
+        encoding = choose_encoding(header, self.encodings)
+        return encoding[0] if encoding is not None else None
+
+    def test_choose_preferred_encoding_that_client_accepts(self):
+        self.assertEqual(self.get_encoding_name('gzip, deflate, br'), 'br')
+        self.assertEqual(self.get_encoding_name('gzip, deflate'), 'gzip')
+
+    def test_choose_encoding_with_highest_quality(self):
+        self.assertEqual(self.get_encoding_name('br;q=0.5, gzip'), 'gzip')
+
+    def test_skip_encodings_client_refuses(self):
+        self.assertIsNone(self.get_encoding_name('br;q=0, gzip;q=0'))
+        self.assertIsNone(self.get_encoding_name('identity'))
+        self.assertIsNone(self.get_encoding_name(''))
+
+    def test_accept_any_encoding_with_wildcard(self):
+        self.assertEqual(self.get_encoding_name('*'), 'br')
+        self.assertEqual(self.get_encoding_name('*, br;q=0'), 'gzip')
+
+
+class AvailableEncodingsTest(unittest.TestCase):
+
+    def get_encoding_names(self, brotli, zstandard):
+        with mock.patch.object(compression, 'brotli', brotli), \
+                mock.patch.object(compression, 'zstandard', zstandard):
+            return [name for name, _ in get_available_encodings()]
+
+    def test_prefer_brotli_and_zstd_when_installed(self):
+        brotli, zstandard = make_stub_modules()
+        self.assertEqual(self.get_encoding_names(brotli, zstandard), ['br', 'zstd', 'gzip'])
+
+    def test_use_gzip_when_nothing_else_is_installed(self):
+        self.assertEqual(self.get_encoding_names(None, None), ['gzip'])
+
+
+@override_settings(COMPRESSION_MIN_SIZE=100, COMPRESSION_LEVELS={'gzip': 9})
+class CompressionMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.middleware = CompressionMiddleware()
+        self.request = RequestFactory().post('/scan', HTTP_ACCEPT_ENCODING='gzip')
+        self.content = json.dumps({'regions': ['<p>Explanation</p>'] * 50})
+
+    def test_compress_response_with_gzip(self):
+        response = self.middleware.process_response(self.request, HttpResponse(self.content))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(gunzip(response.content), self.content)
+
+    def test_skip_responses_below_min_size(self):
+        response = self.middleware.process_response(self.request, HttpResponse('{}'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, '{}')
+
+    def test_skip_clients_that_do_not_accept_compression(self):
+        request = RequestFactory().post('/scan')
+        response = self.middleware.process_response(request, HttpResponse(self.content))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_skip_content_that_is_not_text(self):
+        response = self.middleware.process_response(
+            self.request, HttpResponse(self.content, content_type='image/png'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_keep_cors_and_vary_headers(self):
+        response = HttpResponse(self.content)
+        response['Access-Control-Allow-Origin'] = '*'
+        response['Vary'] = 'Origin'
+        response = self.middleware.process_response(self.request, response)
+        self.assertEqual(response['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(response['Vary'], 'Origin, Accept-Encoding')
+
+    @override_settings(COMPRESSION_STREAM_FLUSH_SIZE=30, COMPRESSION_STREAM_FLUSH_INTERVAL=60)
+    def test_flush_streamed_response_once_enough_is_compressed(self):
+        chunks = ['{"regions": [', '"<p>Explanation</p>"', ',"<p>More</p>"', ']}']
+        response = self.middleware.process_response(
+            self.request, StreamingHttpResponse(iter(chunks)))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        # The first two pieces are flushed together, and can be decompressed as soon as
+        # they arrive, before the rest of the response is ready
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressed_chunks = [decompressor.decompress(c) for c in response.streaming_content]
+        self.assertEqual(
+            [c for c in decompressed_chunks if c], [b''.join(chunks[:2]), b''.join(chunks[2:])])
+
+    @override_settings(COMPRESSION_STREAM_FLUSH_INTERVAL=0)
+    def test_flush_streamed_response_once_flush_interval_passes(self):
+        chunks = ['{"regions": [', '"<p>Explanation</p>"', ']}']
+        response = self.middleware.process_response(
+            self.request, StreamingHttpResponse(iter(chunks)))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressed_chunks = [decompressor.decompress(c) for c in response.streaming_content]
+        self.assertEqual([c for c in decompressed_chunks if c], chunks)
+
+    @override_settings(COMPRESSION_STREAM_FLUSH_INTERVAL=60)
+    def test_buffer_small_pieces_of_streamed_response(self):
+        chunks = ['{"regions":['] + [
+            ('' if i == 0 else ',') + json.dumps({'region_id': i, 'document': '<p>Greeting</p>'})
+            for i in range(500)] + [']}']
+        content = b''.join(chunks)
+        response = self.middleware.process_response(
+            self.request, StreamingHttpResponse(iter(chunks)))
+        streamed_content = b''.join(response.streaming_content)
+        self.assertEqual(gunzip(streamed_content), content)
+        whole_content = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        whole_content = whole_content.compress(content) + whole_content.flush()
+        self.assertLess(len(streamed_content), len(whole_content) * 1.2)
+
+    def test_keep_weak_etags_of_compressed_responses(self):
+        response = HttpResponse(self.content)
+        response['ETag'] = 'W/"abc"'
+        response = self.middleware.process_response(self.request, response)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['ETag'], 'W/"abc"')
+
+    def test_add_encoding_to_strong_etags_of_compressed_responses(self):
+        response = HttpResponse(self.content)
+        response['ETag'] = '"abc"'
+        response = self.middleware.process_response(self.request, response)
+        self.assertEqual(response['ETag'], '"abc;gzip"')
+
+    def test_count_raw_and_compressed_sizes(self):
+        raw_bytes = counters['compression_raw_bytes']
+        compressed_bytes = counters['compression_compressed_bytes']
+        response = self.middleware.process_response(self.request, HttpResponse(self.content))
+        self.assertEqual(counters['compression_raw_bytes'], raw_bytes + len(self.content))
+        self.assertEqual(
+            counters['compression_compressed_bytes'], compressed_bytes + len(response.content))
+
+    def test_compress_views_with_decorator(self):
+        view = compression.compress_response(lambda request: HttpResponse(self.content))
+        response = view(self.request)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gunzip(response.content), self.content)
+
+    def test_only_compress_responses_of_tutoron_views(self):
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertGreater(len(response.content), 100)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_scan_responses_are_compressed_with_cors_headers(self):
+        document = '<code>' + 'abs(2)\n' * 20 + '</code>'
+        response = self.client.post(
+            reverse('python_builtins:scan'), data={'origin': 'a.com', 'document': document},
+            HTTP_ACCEPT_ENCODING='gzip', HTTP_ORIGIN='http://a.com')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(len(json.loads(gunzip(response.content))['regions']), 20)
+
+
+@override_settings(COMPRESSION_MIN_SIZE=100, COMPRESSION_LEVELS={'br': 5, 'zstd': 7})
+class StubEncodingCompressionTest(TestCase):
+    ''' Tests of compressing with brotli and zstd, with stand-ins for their modules. '''
+
+    def setUp(self):
+        self.middleware = CompressionMiddleware()
+        self.content = json.dumps({'regions': ['<p>Explanation</p>'] * 50})
+        brotli, zstandard = make_stub_modules()
+        patches = [
+            mock.patch.object(compression, 'brotli', brotli),
+            mock.patch.object(compression, 'zstandard', zstandard),
+            mock.patch.object(_StubCompressor, 'levels', []),
+            mock.patch.object(_StubCompressor, 'flush_modes', []),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def compress(self, accept_encoding, response):
+        request = RequestFactory().post('/scan', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return self.middleware.process_response(request, response)
+
+    def test_compress_response_with_brotli(self):
+        response = self.compress('gzip, zstd, br', HttpResponse(self.content))
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(inflate(response.content), self.content)
+        self.assertEqual(_StubCompressor.levels, [5])
+
+    def test_compress_response_with_zstd(self):
+        response = self.compress('gzip, zstd', HttpResponse(self.content))
+        self.assertEqual(response['Content-Encoding'], 'zstd')
+        self.assertEqual(inflate(response.content), self.content)
+        self.assertEqual(_StubCompressor.levels, [7])
+
+    @override_settings(COMPRESSION_STREAM_FLUSH_INTERVAL=0)
+    def test_flush_blocks_of_streamed_zstd_response(self):
+        chunks = ['{"regions": [', '"<p>Explanation</p>"', ']}']
+        response = self.compress('zstd', StreamingHttpResponse(iter(chunks)))
+        self.assertEqual(response['Content-Encoding'], 'zstd')
+        self.assertEqual(inflate(b''.join(response.streaming_content)), b''.join(chunks))
+        self.assertEqual(_StubCompressor.flush_modes, ['block', 'block', 'block', None])
+
+    @override_settings(COMPRESSION_STREAM_FLUSH_INTERVAL=0)
+    def test_flush_streamed_brotli_response(self):
+        chunks = ['{"regions": [', '"<p>Explanation</p>"', ']}']
+        response = self.compress('br', StreamingHttpResponse(iter(chunks)))
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        decompressed_chunks = [decompressor.decompress(c) for c in response.streaming_content]
+        self.assertEqual([c for c in decompressed_chunks if c], chunks)
+
+    def test_count_responses_by_encoding(self):
+        responses = counters['compressed_responses_br']
+        self.compress('br', HttpResponse(self.content))
+        self.assertEqual(counters['compressed_responses_br'], responses + 1)
+
+
+@override_settings(API_JSON_INDENT=None)
+class CompressedScanResultEtagTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        backend = LocMemCache('compressed-etag-test', {})
+        backend.clear()
+        self.view = pagescan(scan_hellos, result_cache=ScanResultCache('hello', backend=backend))
+
+    def post(self, **headers):
+        request = self.factory.post('/hello/scan', data={
+            'origin': 'www.test.com',
+            'document': '<p>hello</p>' * 20,
+        }, HTTP_ACCEPT_ENCODING='gzip', **headers)
+        return self.view(request)
+
+    def test_precondition_failed_response_has_same_etag_as_compressed_response(self):
+        response = self.post()
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gunzip(b''.join(response.streaming_content))
+        self.assertEqual(len(json.loads(content)['regions']), 20)
+        precondition_failed_response = self.post(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(precondition_failed_response.status_code, 412)
+        self.assertEqual(precondition_failed_response['ETag'], response['ETag'])
@@ -5,9 +5,13 @@ from __future__ import unicode_literals
 import logging
 import django
 import json
-from django.test import Client
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.client import RequestFactory
 from django.core.urlresolvers import reverse
 from tutorons.core.models import Block, ServerQuery, Region
+from tutorons.core.dblogger import DbLogger, DbLogWriter, get_db_log_writer
+from tutorons.core.htmltools import HtmlDocument
+from tutorons.core.extractor import Region as DetectedRegion
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
@@ -56,3 +60,153 @@ class DbLoggerTest(django.test.TestCase):
         self.get_python_regions(string, "test1.com")
         b = Block.objects.all()
         self.assertEqual(len(b), 2)
+
+
+class BulkDbLoggerTest(django.test.TestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().post('/python_builtins', {'origin': 'www.test.com'})
+        self.document = HtmlDocument('<code>abs(2)\nbin(1)</code><pre>len(x)</pre>')
+        self.regions = [
+            DetectedRegion(self.document.code, 0, 2, 'abs'),
+            DetectedRegion(self.document.code, 7, 9, 'bin'),
+            DetectedRegion(self.document.pre, 0, 2, 'len'),
+        ]
+
+    def scan(self, document, url="www.test.com"):
+        return Client().post(
+            reverse('python_builtins:scan'),
+            data={'origin': url, 'document': document})
+
+    def test_log_regions_in_order(self):
+        logger = DbLogger()
+        query = logger.log_query(self.request)
+        region_records = logger.log_regions(self.request, query, self.regions)
+        self.assertEqual([r.string for r in region_records], ['abs', 'bin', 'len'])
+        saved_records = Region.objects.in_bulk([r.id for r in region_records])
+        self.assertEqual(len(saved_records), 3)
+        self.assertEqual(saved_records[region_records[2].id].block.block_type, 'pre')
+        self.assertEqual(region_records[0].block, region_records[1].block)
+
+    def test_reuse_existing_blocks(self):
+        logger = DbLogger()
+        query = logger.log_query(self.request)
+        logger.log_regions(self.request, query, self.regions)
+        logger.log_regions(self.request, query, self.regions)
+        self.assertEqual(Block.objects.count(), 2)
+        self.assertEqual(Region.objects.count(), 6)
+
+    def test_scan_with_same_number_of_queries_for_any_number_of_regions(self):
+        # Queries: insert the query, look up blocks, insert blocks, look up the new blocks,
+        # insert regions, update the query, and a savepoint around the regions.
+        with self.assertNumQueries(8):
+            self.scan("<code>" + "abs(2)\n" * 3 + "</code>", url="a.com")
+        with self.assertNumQueries(8):
+            self.scan("<code>" + "abs(2)\n" * 30 + "</code>", url="b.com")
+        self.assertEqual(Region.objects.count(), 33)
+
+    def test_scan_without_inserting_blocks_that_exist(self):
+        document = "<code>abs(2)\nlen('x')\nbin(1)</code>"
+        self.scan(document)
+        with self.assertNumQueries(6):
+            self.scan(document)
+
+
+class AsyncDbLoggerTest(TransactionTestCase):
+
+    def setUp(self):
+        self.writer = DbLogWriter(batch_size=100, flush_interval=60)
+        document = HtmlDocument('<code>abs(2)</code><pre>len(x)</pre>')
+        self.regions = [
+            DetectedRegion(document.code, 0, 2, 'abs'),
+            DetectedRegion(document.pre, 0, 2, 'len'),
+        ]
+        self.request = RequestFactory().post('/python_builtins', {'origin': 'www.test.com'})
+
+    def tearDown(self):
+        self.writer.close()
+
+    def log_query(self, logger):
+        query = logger.log_query(self.request)
+        region_records = [logger.log_region(self.request, query, r) for r in self.regions]
+        logger.update_server_end_time(query)
+        return query, region_records
+
+    def test_save_records_when_flushed(self):
+        query, region_records = self.log_query(DbLogger(writer=self.writer))
+        self.writer.flush()
+        saved_query = ServerQuery.objects.get()
+        self.assertEqual(saved_query.id, query.id)
+        self.assertIsNotNone(saved_query.end_time)
+        self.assertEqual(
+            sorted(r.id for r in Region.objects.filter(query=saved_query)),
+            sorted(r.id for r in region_records),
+        )
+        self.assertEqual(Block.objects.count(), 2)
+
+    def test_records_are_pending_until_they_are_saved(self):
+        query, region_records = self.log_query(DbLogger(writer=self.writer))
+        self.assertTrue(self.writer.is_pending(ServerQuery, query.pk))
+        self.assertTrue(self.writer.is_pending(Region, region_records[0].pk))
+        self.assertFalse(self.writer.is_pending(Region, query.pk))
+        self.writer.flush()
+        self.assertFalse(self.writer.is_pending(ServerQuery, query.pk))
+        self.assertFalse(self.writer.is_pending(Region, region_records[0].pk))
+
+    def test_records_are_pending_from_when_they_are_made(self):
+        logger = DbLogger(writer=self.writer)
+        query = logger.log_query(self.request)
+        region_record = logger.make_region_record(self.request, query, self.regions[0])
+        self.assertTrue(self.writer.is_pending(ServerQuery, query.pk))
+        self.assertTrue(self.writer.is_pending(Region, region_record.pk))
+        logger.save_region_records([region_record])
+        logger.update_server_end_time(query)
+        self.writer.flush()
+        self.assertFalse(self.writer.is_pending(Region, region_record.pk))
+        self.assertEqual(Region.objects.get().id, region_record.id)
+
+    def test_records_are_not_saved_before_writer_flushes(self):
+        self.log_query(DbLogger(writer=self.writer))
+        self.assertEqual(ServerQuery.objects.count(), 0)
+        self.assertEqual(Region.objects.count(), 0)
+
+    def test_save_records_when_batch_is_full(self):
+        writer = DbLogWriter(batch_size=3, flush_interval=60)
+        self.log_query(DbLogger(writer=writer))
+        writer._queue.join()
+        self.assertEqual(ServerQuery.objects.count(), 1)
+        self.assertEqual(Region.objects.count(), 2)
+        writer.close()
+
+    def test_save_records_after_flush_interval(self):
+        writer = DbLogWriter(batch_size=100, flush_interval=.01)
+        self.log_query(DbLogger(writer=writer))
+        writer._queue.join()
+        self.assertEqual(Region.objects.count(), 2)
+        writer.close()
+
+    def test_reuse_blocks_across_batches(self):
+        logger = DbLogger(writer=self.writer)
+        self.log_query(logger)
+        self.writer.flush()
+        self.log_query(logger)
+        self.writer.flush()
+        self.assertEqual(ServerQuery.objects.count(), 2)
+        self.assertEqual(Region.objects.count(), 4)
+        self.assertEqual(Block.objects.count(), 2)
+
+    def test_drain_records_on_close(self):
+        self.log_query(DbLogger(writer=self.writer))
+        self.writer.close()
+        self.assertEqual(Region.objects.count(), 2)
+
+    @override_settings(DB_LOG_ASYNC=True)
+    def test_scan_responds_with_ids_of_records_saved_later(self):
+        resp = Client().post(
+            reverse('python_builtins:scan'),
+            data={'origin': 'www.test.com', 'document': '<code>abs(2)</code>'})
+        response_data = json.loads(resp.content)
+        get_db_log_writer().flush()
+        region = Region.objects.get()
+        self.assertEqual(unicode(region.id), response_data['regions'][0]['region_id'])
+        self.assertEqual(unicode(region.query.id), response_data['query_id'])
@@ -4,8 +4,17 @@
 from __future__ import unicode_literals
 import logging
 import unittest
+from bs4 import BeautifulSoup
+from django.test.utils import override_settings
+from tutorons.core import htmltools
 from tutorons.core.htmltools import HtmlDocument
+from tutorons.core.htmltools import get_parsed_document
+from tutorons.core.htmltools import compile_tag_pattern
 from tutorons.core.htmltools import get_css_selector
+from tutorons.core.htmltools import iter_html_events
+from tutorons.core.htmltools import MisnestedTagsError
+from tutorons.core.scanner import NodeScanner
+from tutorons.core.tests.test_node_visitor import HelloTextExtractor
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -78,3 +87,229 @@ class GetPathTest(unittest.TestCase):
             selector,
             'HTML > BODY:nth-of-type(1) > ' +
             'DIV:nth-of-type(2) > P:nth-of-type(3)')
+
+    def test_get_path_of_tag_outside_html_document(self):
+        soup = BeautifulSoup('<div><p></p></div><div><p></p><p></p></div>', 'html.parser')
+        p = soup.find_all('p')[2]
+        self.assertEqual(get_css_selector(p), 'DIV:nth-of-type(2) > P:nth-of-type(2)')
+
+
+class ParserBackendTest(unittest.TestCase):
+
+    def test_parse_with_html5lib_by_default(self):
+        doc = HtmlDocument('<p>hello</p>')
+        self.assertEqual(doc.parser_backend, 'html5lib')
+        self.assertIsNotNone(doc.html.body)
+
+    def test_parse_with_backend_from_settings(self):
+        with override_settings(HTML_PARSER='html.parser'):
+            doc = HtmlDocument('<p>hello</p>')
+        self.assertEqual(doc.parser_backend, 'html.parser')
+        self.assertIsNone(doc.html)
+
+    def test_parse_with_backend_passed_to_document(self):
+        doc = HtmlDocument('<p>hello</p>', parser='html.parser')
+        self.assertEqual(doc.parser_backend, 'html.parser')
+
+    def test_fail_on_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            HtmlDocument('<p>hello</p>', parser='not-a-parser')
+
+
+class DocumentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        htmltools._document_cache = None
+
+    def tearDown(self):
+        htmltools._document_cache = None
+
+    def test_reuse_document_parsed_from_same_html(self):
+        document = get_parsed_document('<p>hello</p>')
+        self.assertIsInstance(document, HtmlDocument)
+        self.assertIs(get_parsed_document('<p>hello</p>'), document)
+        self.assertIsNot(get_parsed_document('<p>hello!</p>'), document)
+
+    def test_parse_again_with_different_backend(self):
+        document = get_parsed_document('<p>hello</p>')
+        other_document = get_parsed_document('<p>hello</p>', parser='html.parser')
+        self.assertIsNot(other_document, document)
+        self.assertEqual(other_document.parser_backend, 'html.parser')
+
+    def test_evict_documents_when_cache_exceeds_size_in_bytes(self):
+        with override_settings(PARSED_DOCUMENT_CACHE_SIZE=3000):
+            first = get_parsed_document('<p>' + 'a' * 10 + '</p>')
+            get_parsed_document('<p>' + 'é' * 5 + '</p>')  # 17 bytes in UTF-8
+        # Documents are sized by the memory their trees are estimated to take up
+        self.assertEqual(
+            htmltools.get_document_cache().size,
+            17 * htmltools.PARSED_DOCUMENT_BYTES_PER_SOURCE_BYTE)
+        self.assertIsNot(get_parsed_document('<p>' + 'a' * 10 + '</p>'), first)
+
+    def test_scan_does_not_change_cached_document(self):
+        html = '<div><p>hello</p> hello <pre>hello</pre></div>'
+        document = get_parsed_document(html)
+        markup = unicode(document)
+        text = document.index.text
+        regions = NodeScanner(HelloTextExtractor(), ['p', 'pre', 'div']).scan(document)
+        self.assertEqual(len(regions), 3)
+        cached_document = get_parsed_document(html)
+        self.assertIs(cached_document, document)
+        self.assertEqual(unicode(cached_document), markup)
+        self.assertEqual(cached_document.index.text, text)
+        self.assertEqual(cached_document.div.text, 'hello hello hello')
+
+
+class TagPatternTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pattern = compile_tag_pattern(['pre', 'code'])
+
+    def test_find_start_and_end_tags_in_any_case(self):
+        self.assertTrue(self.pattern.search('<div><PRE class="x">a</PRE></div>'))
+        self.assertTrue(self.pattern.search('<div>a</code></div>'))
+        self.assertTrue(self.pattern.search('<code/>'))
+        self.assertTrue(self.pattern.search('<p>text <code'))
+
+    def test_skip_tags_that_start_with_same_name(self):
+        self.assertIsNone(self.pattern.search('<div><precious>a</precious> <codex></div>'))
+        self.assertIsNone(self.pattern.search('<p>&lt;pre&gt; and < code></p>'))
+
+    def test_no_pattern_for_elements_parsers_add_without_tags(self):
+        self.assertIsNone(compile_tag_pattern(['pre', 'body']))
+        self.assertIsNone(compile_tag_pattern(['img']))
+
+
+class SelectorIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = HtmlDocument('<div><p></p></div><div><p></p><span></span><p></p></div>')
+
+    def test_get_type_index_counts_siblings_with_same_name(self):
+        spans = self.doc.find_all('span')
+        ps = self.doc.find_all('p')
+        self.assertEqual(self.doc.index.get_type_index(ps[2]), 2)
+        self.assertEqual(self.doc.index.get_type_index(spans[0]), 1)
+
+    def test_selectors_of_all_tags_match_selectors_found_by_walking_tree(self):
+        expected = {}
+        for tag in self.doc.find_all(True):
+            names = []
+            for element in [tag] + list(tag.parents)[:-1]:
+                siblings = element.parent.find_all(element.name, recursive=False)
+                index = [id(s) for s in siblings].index(id(element)) + 1
+                names.insert(0, '%s:nth-of-type(%d)' % (element.name.upper(), index))
+            names[0] = 'HTML'
+            expected[id(tag)] = ' > '.join(names)
+        # Look up descendants before ancestors, to check selectors saved along the way
+        for tag in reversed(self.doc.find_all(True)):
+            self.assertEqual(get_css_selector(tag), expected[id(tag)])
+
+    def test_get_selector_of_tag_added_after_index_was_built(self):
+        self.doc.index
+        span = self.doc.new_tag('span')
+        self.doc.find_all('div')[1].append(span)
+        self.assertEqual(
+            self.doc.index.get_css_selector(span),
+            'HTML > BODY:nth-of-type(1) > DIV:nth-of-type(2) > SPAN:nth-of-type(2)')
+
+
+class TextIndexTest(unittest.TestCase):
+
+    def test_node_text_matches_text_of_every_tag(self):
+        doc = HtmlDocument('\n'.join([
+            '<html>',
+            '   <body>',
+            '       <div>before<!-- comment --><p>in <b>bold</b></p>after</div>',
+            '       <pre><![CDATA[data]]>\ncode</pre>',
+            '   </body>',
+            '</html>',
+        ]))
+        for tag in [doc] + doc.find_all(True):
+            self.assertEqual(doc.get_node_text(tag), tag.text)
+
+    def test_get_text_span_of_tag(self):
+        doc = HtmlDocument('<div>ab<p>cde</p>f</div>')
+        self.assertEqual(doc.get_text_span(doc.p), (2, 5))
+        self.assertEqual(doc.get_text_span(doc.div), (0, 6))
+
+    def test_convert_offsets_between_node_and_document(self):
+        doc = HtmlDocument('<div>ab<p>cde</p>f</div>')
+        self.assertEqual(doc.to_document_offset(doc.p, 1), 3)
+        self.assertEqual(doc.to_node_offset(doc.p, 3), 1)
+
+
+class IterHtmlEventsTest(unittest.TestCase):
+
+    def get_selectors(self, doc):
+        return [get_css_selector(e) for event, e in iter_html_events(doc) if event == 'start']
+
+    def assertSelectorsMatchParsedDocument(self, doc):
+        soup = HtmlDocument(doc)
+        self.assertEqual(
+            self.get_selectors(doc),
+            [get_css_selector(t) for t in [soup.html] + soup.html.find_all(True)]
+        )
+
+    def test_selectors_match_selectors_in_parsed_document(self):
+        doc = '\n'.join([
+            '<!DOCTYPE html>',
+            '<html>',
+            '<head><title>Title</title><script>if (a<b) {}</script></head>',
+            '<body>',
+            '  <div><p>one<p>two<div>three</div></div>',
+            '  <ul><li>a<li>b<li><code>c</code></ul>',
+            '  <table><tr><td>1<td><pre>x</pre></table>',
+            '</body>',
+            '</html>',
+        ])
+        soup = HtmlDocument(doc)
+        self.assertEqual(
+            self.get_selectors(doc),
+            [get_css_selector(t) for t in [soup.html] + soup.html.find_all(True)]
+        )
+
+    def test_add_missing_html_head_and_body(self):
+        self.assertEqual(self.get_selectors('<p>hello</p>'), [
+            'HTML',
+            'HTML > HEAD:nth-of-type(1)',
+            'HTML > BODY:nth-of-type(1)',
+            'HTML > BODY:nth-of-type(1) > P:nth-of-type(1)',
+        ])
+
+    def test_close_open_link_when_another_link_starts(self):
+        self.assertSelectorsMatchParsedDocument('<a href=x>1<a>2</a><pre>x</pre>')
+
+    def test_reopen_formatting_elements_closed_by_other_tags(self):
+        self.assertSelectorsMatchParsedDocument('<p><b>1<i>2</p>3<pre>x</pre>')
+        self.assertSelectorsMatchParsedDocument(
+            '<p><i>1<div>2</i>3</div><pre>x</pre></p><pre>z</pre>')
+
+    def test_ignore_form_nested_in_open_form(self):
+        self.assertSelectorsMatchParsedDocument(
+            '<form><div><form><p>x</p></div></form><pre>y</pre>')
+
+    def test_only_add_options_to_select(self):
+        self.assertSelectorsMatchParsedDocument(
+            '<select><option>1<option>2<p>x</select><pre>y</pre>')
+
+    def test_add_implied_column_group_to_table(self):
+        self.assertSelectorsMatchParsedDocument(
+            '<table><col><caption>c</caption><tr><td>1</table>')
+
+    def test_raise_error_when_formatting_tag_closes_around_block(self):
+        with self.assertRaises(MisnestedTagsError):
+            list(iter_html_events('<b>1<p>2</b>3</p><pre>x</pre>'))
+
+    def test_raise_error_when_form_closes_around_open_element(self):
+        with self.assertRaises(MisnestedTagsError):
+            list(iter_html_events('<form><div>1</form>2</div><pre>x</pre>'))
+
+    def test_raise_error_for_text_outside_of_table_cell(self):
+        with self.assertRaises(MisnestedTagsError):
+            list(iter_html_events('<table><tr>x<td>1</table>'))
+
+    def test_text_matches_text_in_parsed_document(self):
+        doc = '<pre>\nfirst line\r\nsecond &amp; line</pre><script>var s = "</p>";</script>'
+        text = ''.join(value for event, value in iter_html_events(doc) if event == 'text')
+        self.assertEqual(text, HtmlDocument(doc).text)
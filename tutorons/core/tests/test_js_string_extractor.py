@@ -4,8 +4,13 @@
 from __future__ import unicode_literals
 import logging
 import unittest
+import random
+import sys
+import os
+import contextlib
+from slimit.lexer import Lexer as JsLexer
 from tutorons.core.htmltools import HtmlDocument
-from tutorons.core.extractor import JavascriptStringExtractor
+from tutorons.core.extractor import JavascriptStringExtractor, JsLexerPool, iter_js_strings
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -56,3 +61,148 @@ class JavascriptStringExtractText(unittest.TestCase):
         r = regions[0]
         self.assertEqual(r.start_offset, 8)
         self.assertEqual(r.end_offset, 13)
+
+
+class RegexJavascriptStringExtractText(JavascriptStringExtractText):
+    ''' Run the same tests against the regex backend. '''
+
+    def setUp(self):
+        self.extractor = JavascriptStringExtractor(backend='regex')
+
+    def test_skip_strings_in_comments_and_regular_expressions(self):
+        node = HtmlDocument('\n'.join([
+            '<code>// "one"',
+            '/* "two" */ var r = /"three"/g;',
+            'x = a / "four" / 2;</code>',
+        ])).code
+        regions = self.extractor.extract(node)
+        self.assertEqual([r.string for r in regions], ['four'])
+
+    def test_skip_template_literals(self):
+        node = HtmlDocument('<code>var t = `say "hi" ${name}`, s = "real";</code>').code
+        regions = self.extractor.extract(node)
+        self.assertEqual([r.string for r in regions], ['real'])
+
+    def test_keep_finding_strings_after_text_slimit_cannot_lex(self):
+        node = HtmlDocument('<code>x = "a"; y = (/[/; z = "b";</code>').code
+        slimit_regions = JavascriptStringExtractor().extract(node)
+        regex_regions = self.extractor.extract(node)
+        self.assertEqual([r.string for r in slimit_regions], ['a'])
+        self.assertEqual([r.string for r in regex_regions], ['a', 'b'])
+
+
+# Corpus for comparing the regex backend to slimit: hand-written snippets for cases where
+# it's easy to get strings wrong, and snippets made by joining random tokens.
+JS_CORPUS = [
+    'var s = "a" + \'b\';',
+    'x = "escaped \\" quote" + \'it\\\'s\';',
+    'x = "\\x41\\u0041"; y = "\\\\";',
+    'x = "line \\\ncontinued";',
+    'x = "\\0"; y = "after";',
+    'return /"not a string"/.test("string");',
+    'a = b / "c" / d;',
+    'a = (b) / "c" / (d);',
+    'a++ / "c" / 2;',
+    'typeof /"x"/ === "object";',
+    'a\n/"regex"/g.exec("s");',
+    '// "comment"\nx = "code";',
+    '/* "block" */ x = "code"; /* unterminated "c"',
+    'x = 1 / 2; y = .5 / "s"; z = 0x1f / "t";',
+    'if (a) /"r"/.exec(b); else "s";',
+    "don't / do / \"this\"",
+    'x = "unterminated\ny = "fine";',
+    'x = # / "a" / 2;',
+]
+JS_TOKENS = [
+    'a', 'foo', '$', '_b', 'return', 'typeof', 'this', 'true', 'null', 'in',
+    '1', '.5', '0x1f', '1e3', '2.', '"a"', "'b'", '"a\\"b"', "'it\\'s'", '"\\x41"',
+    '"line\\\ncont"', '""', '"\\0"', '/a\\/b[/]c/gi', '/"x"/', "/'/", '/', '/=', '*', '+',
+    '-', '++', '--', '=', '===', '!', '<', '?', ':', ',', ';', '.', '(', ')', '[', ']',
+    '{', '}', '// "c"', "/* 'd' */", '\n', ' ', '"open', "'", '#', '\\',
+]
+
+
+@contextlib.contextmanager
+def _hide_stdout():
+    # slimit prints a message for every character it can't lex
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def _get_slimit_strings(text):
+    lexer = JsLexer()
+    lexer.input(text)
+    strings = []
+    with _hide_stdout():
+        for token in lexer:
+            if token.type == 'STRING':
+                string = token.value[1:-1]
+                start = token.lexpos + 1
+                strings.append((start, start + len(string) - 1, string))
+    return strings
+
+
+class RegexBackendEquivalenceTest(unittest.TestCase):
+
+    def assertSameStringsAsSlimit(self, text):
+        try:
+            expected_strings = _get_slimit_strings(text)
+        except (TypeError, AttributeError):
+            # slimit gives up on text like this, so there's nothing to compare to.
+            return False
+        self.assertEqual(list(iter_js_strings(text)), expected_strings, msg=repr(text))
+        return True
+
+    def test_find_same_strings_as_slimit_in_corpus(self):
+        for text in JS_CORPUS:
+            self.assertSameStringsAsSlimit(text)
+
+    def test_find_same_strings_as_slimit_in_random_snippets(self):
+        rand = random.Random(0)
+        compared = 0
+        for _ in range(1000):
+            text = ''.join(
+                rand.choice(JS_TOKENS) + rand.choice(['', ' '])
+                for _ in range(rand.randint(0, 20))
+            )
+            compared += self.assertSameStringsAsSlimit(text)
+        self.assertGreater(compared, 800)
+
+
+class ReuseLexersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = JsLexerPool()
+        self.pool.warm_up()
+        self.extractor = JavascriptStringExtractor(lexer_pool=self.pool)
+
+    def get_spans(self, text):
+        node = HtmlDocument('<code>' + text + '</code>').code
+        return [(r.start_offset, r.end_offset, r.string) for r in self.extractor.extract(node)]
+
+    def test_reused_lexer_finds_same_strings_as_new_lexer(self):
+        text = 'var s = "a";\nreturn\n"b" / 2;'
+        first_spans = self.get_spans(text)
+        self.assertEqual(self.get_spans(text), first_spans)
+        self.assertEqual(len(first_spans), 2)
+
+    def test_reset_lexer_after_input_was_left_half_lexed(self):
+        node = HtmlDocument('<code>x = /re"g/; y = "one"; z = "two";</code>').code
+        regions = self.extractor.iter_extract(node)
+        next(regions)
+        regions.close()
+        self.assertEqual(self.get_spans("'fresh'"), [(1, 5, 'fresh')])
+
+    def test_lexers_are_not_shared_by_interleaved_extractions(self):
+        first = HtmlDocument('<code>f("a", "b")</code>').code
+        second = HtmlDocument('<code>g("c", "d")</code>').code
+        first_regions = self.extractor.iter_extract(first)
+        second_regions = self.extractor.iter_extract(second)
+        strings = [next(first_regions).string, next(second_regions).string,
+                   next(first_regions).string, next(second_regions).string]
+        self.assertEqual(strings, ['a', 'c', 'b', 'd'])
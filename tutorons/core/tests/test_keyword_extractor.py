@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import unittest
+from tutorons.core.htmltools import HtmlDocument
+from tutorons.core.extractor import KeywordExtractor
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+class ExtractKeywordsTest(unittest.TestCase):
+
+    def get_strings(self, extractor, text):
+        return [(s, e, text[s:e + 1]) for s, e in extractor.iter_matches(text)]
+
+    def test_extract_regions_for_all_keywords(self):
+        node = HtmlDocument('<code>x = len(range(3))</code>').code
+        regions = KeywordExtractor(['len', 'range', 'sorted']).extract(node)
+        self.assertEqual(len(regions), 2)
+        self.assertEqual(regions[0].node, node)
+        self.assertEqual((regions[0].start_offset, regions[0].end_offset), (4, 6))
+        self.assertEqual(regions[0].string, 'len')
+        self.assertEqual((regions[1].start_offset, regions[1].end_offset), (8, 12))
+        self.assertEqual(regions[1].string, 'range')
+
+    def test_match_whole_words_only(self):
+        extractor = KeywordExtractor(['len'])
+        self.assertEqual(self.get_strings(extractor, 'lens length my_len len'), [
+            (19, 21, 'len'),
+        ])
+
+    def test_match_keywords_that_start_or_end_in_punctuation_inside_words(self):
+        extractor = KeywordExtractor(['.append(', '->'])
+        self.assertEqual(self.get_strings(extractor, 'items.append(x); a->b'), [
+            (5, 12, '.append('),
+            (18, 19, '->'),
+        ])
+
+    def test_match_inside_words_if_whole_words_not_required(self):
+        extractor = KeywordExtractor(['len'], whole_words=False)
+        self.assertEqual(self.get_strings(extractor, 'lens my_len'), [
+            (0, 2, 'len'),
+            (8, 10, 'len'),
+        ])
+
+    def test_keep_leftmost_longest_of_overlapping_matches(self):
+        extractor = KeywordExtractor(['ab', 'abcd', 'bcde', 'de'], whole_words=False)
+        self.assertEqual(self.get_strings(extractor, 'abcde'), [
+            (0, 3, 'abcd'),
+        ])
+
+    def test_find_all_overlapping_matches(self):
+        extractor = KeywordExtractor(['ab', 'abcd', 'bcde', 'de'], whole_words=False,
+                                     overlapping=True)
+        self.assertEqual(sorted(self.get_strings(extractor, 'abcde')), [
+            (0, 1, 'ab'),
+            (0, 3, 'abcd'),
+            (1, 4, 'bcde'),
+            (3, 4, 'de'),
+        ])
+
+    def test_match_any_case_if_not_case_sensitive(self):
+        extractor = KeywordExtractor(['select'], case_sensitive=False)
+        self.assertEqual(self.get_strings(extractor, 'SELECT * ... Select'), [
+            (0, 5, 'SELECT'),
+            (13, 18, 'Select'),
+        ])
+
+    def test_use_keywords_of_subclass(self):
+
+        class BuiltinExtractor(KeywordExtractor):
+            keywords = ['print', 'open']
+
+        extractor = BuiltinExtractor()
+        self.assertEqual(self.get_strings(extractor, 'print(open(f))'), [
+            (0, 4, 'print'),
+            (6, 9, 'open'),
+        ])
+
+    def test_share_automaton_between_extractors_with_same_vocabulary(self):
+        extractor1 = KeywordExtractor(['b', 'a'])
+        extractor2 = KeywordExtractor(['a', 'b', 'a'], overlapping=True)
+        self.assertIs(extractor1.automaton, extractor2.automaton)
+
+    def test_version_changes_with_vocabulary(self):
+        self.assertEqual(
+            KeywordExtractor(['a', 'b']).version, KeywordExtractor(['b', 'a']).version)
+        self.assertNotEqual(KeywordExtractor(['a']).version, KeywordExtractor(['b']).version)
+        self.assertNotEqual(
+            KeywordExtractor(['a']).version, KeywordExtractor(['a'], whole_words=False).version)
+
+    def test_extract_nothing_with_empty_vocabulary(self):
+        extractor = KeywordExtractor([])
+        self.assertEqual(list(extractor.iter_matches('any text')), [])
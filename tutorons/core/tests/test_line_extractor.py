@@ -58,3 +58,12 @@ class ExtractLineTest(unittest.TestCase):
         self.assertEqual(r2.start_offset, 15)
         self.assertEqual(r2.end_offset, 29)
         self.assertEqual(r2.string, "    Second line")
+
+    def test_iterate_over_same_lines_as_extract(self):
+        node = HtmlDocument('<code>\n  First line\nSecond line\n</code>').code
+        extracted = [
+            (r.start_offset, r.end_offset, r.string) for r in self.extractor.extract(node)]
+        iterated = [
+            (r.start_offset, r.end_offset, r.string) for r in self.extractor.iter_extract(node)]
+        self.assertEqual(iterated, extracted)
+        self.assertEqual(len(iterated), 4)
@@ -5,10 +5,13 @@ from __future__ import unicode_literals
 import logging
 import unittest
 import re
+import multiprocessing
+from bs4 import BeautifulSoup
 
-from tutorons.core.scanner import NodeScanner
+from tutorons.core.scanner import NodeScanner, StreamScanner, scan_deadline, get_scan_deadline
 from tutorons.core.extractor import Region
-from tutorons.core.htmltools import HtmlDocument
+from tutorons.core.htmltools import HtmlDocument, get_css_selector
+from tutorons.core.cache import ExtractionCache
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -73,13 +76,318 @@ class ScanNodesTest(unittest.TestCase):
         self.assertEqual(len(regions), 2)
         self.assertTrue(any([r.start_offset == 11 and r.end_offset == 15 for r in regions]))
 
+    def test_text_of_scanned_child_is_blanked_for_parent(self):
+        node = HtmlDocument('<div><p>hello</p> hello</div>')
+        extractor = HelloTextExtractor()
+        scanner = NodeScanner(extractor, ['p', 'div'])
+        scanner.scan(node)
+        self.assertEqual(extractor.texts_seen, ['hello', '      hello'])
+
+    def test_scan_does_not_modify_document(self):
+        node = HtmlDocument('<div><p>hello</p> hello</div>')
+        scanner = NodeScanner(HelloTextExtractor(), ['p', 'div'])
+        regions = scanner.scan(node)
+        self.assertEqual(node.div.text, 'hello hello')
+        self.assertIs(regions[1].node, node.div)
+
+    def test_scan_tree_that_is_not_an_html_document(self):
+        node = BeautifulSoup('<div><p>hello</p> hello</div>', 'html5lib')
+        extractor = HelloTextExtractor()
+        scanner = NodeScanner(extractor, ['p', 'div'])
+        regions = scanner.scan(node)
+        self.assertEqual(len(regions), 2)
+        self.assertEqual(extractor.texts_seen, ['hello', '      hello'])
+
+    def test_scan_very_deep_document(self):
+        # We build this tree with Python's HTML parser, as html5lib takes minutes
+        # to parse documents this deep.
+        depth = 10000
+        node = BeautifulSoup(
+            '<div>' * depth + '<p>hello</p> hello' + '</div>' * depth, 'html.parser')
+        scanner = NodeScanner(HelloTextExtractor(), ['p', 'div'])
+        regions = scanner.scan(node)
+        self.assertEqual(len(regions), 2)
+        self.assertEqual(regions[0].node, node.p)
+        self.assertEqual(regions[1].node, node.p.parent)
+        self.assertEqual((regions[1].start_offset, regions[1].end_offset), (6, 10))
+
+    def test_scan_tags_after_text_moved_out_of_table(self):
+        # html5lib moves the text out of the table, which leaves the links between
+        # elements that `descendants` (and `find`) follow broken after it.
+        node = HtmlDocument('<table>stray text<tr><td><pre>hello</pre></td></tr></table>')
+        regions = NodeScanner(HelloTextExtractor(), ['pre']).scan(node)
+        self.assertEqual(len(regions), 1)
+        self.assertEqual(regions[0].node.name, 'pre')
+        self.assertEqual(regions[0].string, 'hello')
+
+    def test_scan_tags_after_element_moved_out_of_table(self):
+        node = HtmlDocument('<table><div>x</div><tr><td><code>hello</code></td></tr></table>')
+        regions = NodeScanner(HelloTextExtractor(), ['code']).scan(node)
+        self.assertEqual(len(regions), 1)
+        self.assertEqual(
+            get_css_selector(regions[0].node),
+            'HTML > BODY:nth-of-type(1) > TABLE:nth-of-type(1) > TBODY:nth-of-type(1) > '
+            'TR:nth-of-type(1) > TD:nth-of-type(1) > CODE:nth-of-type(1)')
+
+
+class IterScanTest(unittest.TestCase):
+
+    def test_iterate_over_same_regions_as_scan(self):
+        document = HtmlDocument(
+            '<div><p>hello</p><p>bye</p> hello<pre><code>hello</code> hello</pre></div>')
+        tags = ['p', 'div', 'code', 'pre']
+        scanned = NodeScanner(HelloTextExtractor(), tags).scan(document)
+        iterated = list(NodeScanner(HelloTextExtractor(), tags).iter_scan(document))
+        self.assertEqual(
+            [(r.node, r.start_offset, r.end_offset) for r in iterated],
+            [(r.node, r.start_offset, r.end_offset) for r in scanned],
+        )
+
+    def test_yield_regions_before_scanning_later_nodes(self):
+        extractor = HelloTextExtractor()
+        document = HtmlDocument('<p>hello</p><p>hello</p><p>hello</p>')
+        regions = NodeScanner(extractor, ['p']).iter_scan(document)
+        first_region = next(regions)
+        self.assertIs(first_region.node, document.p)
+        self.assertEqual(len(extractor.texts_seen), 1)
+
+    def test_stream_scanner_yields_regions_as_elements_close(self):
+        extractor = HelloTextExtractor()
+        regions = StreamScanner(extractor, ['p']).iter_scan('<p>hello</p><p>hello</p>')
+        next(regions)
+        self.assertEqual(len(extractor.texts_seen), 1)
+        self.assertEqual(len(list(regions)), 1)
+
+
+class ScanNodesInWorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = multiprocessing.Pool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def test_find_regions_in_distinct_elements(self):
+        node = HtmlDocument('<div><p>hello</p><p>hello</p></div>')
+        scanner = NodeScanner(HelloTextExtractor(), ['p'], pool=self.pool)
+        regions = scanner.scan(node)
+        self.assertEqual(len(regions), 2)
+        self.assertIs(regions[0].node, node.find_all('p')[0])
+        self.assertIs(regions[1].node, node.find_all('p')[1])
+
+    def test_blank_out_children_with_regions(self):
+        node = HtmlDocument('<div><p>hello</p><p>bye</p> hello<pre><code>hello</code></pre></div>')
+        scanner = NodeScanner(HelloTextExtractor(), ['p', 'div', 'code', 'pre'], pool=self.pool)
+        regions = scanner.scan(node)
+        self.assertEqual(
+            [(r.node.name, r.start_offset, r.end_offset) for r in regions],
+            [('p', 0, 4), ('code', 0, 4), ('div', 9, 13)]
+        )
+
+    def test_send_extractor_once_for_each_worker(self):
+        PickleCountingExtractor.pickle_count = 0
+        node = HtmlDocument('<div>' + '<p>hello</p>' * 10 + '</div>')
+        scanner = NodeScanner(PickleCountingExtractor(), ['p'], pool=self.pool)
+        regions = scanner.scan(node)
+        self.assertEqual(len(regions), 10)
+        self.assertIs(regions[9].node, node.find_all('p')[9])
+        self.assertEqual(PickleCountingExtractor.pickle_count, 2)
+
+
+class ExtractManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.document = HtmlDocument(
+            '<div><p>hello</p><p>bye</p> hello<pre><code>hello</code></pre></div>')
+        self.tags = ['p', 'div', 'code', 'pre']
+
+    def test_find_same_regions_as_extracting_one_node_at_a_time(self):
+        regions = NodeScanner(BatchHelloTextExtractor(), self.tags).scan(self.document)
+        expected_regions = NodeScanner(HelloTextExtractor(), self.tags).scan(self.document)
+        self.assertEqual(
+            [(r.node, r.start_offset, r.end_offset) for r in regions],
+            [(r.node, r.start_offset, r.end_offset) for r in expected_regions],
+        )
+
+    def test_extract_from_nodes_in_batches(self):
+        extractor = BatchHelloTextExtractor()
+        NodeScanner(extractor, self.tags).scan(self.document)
+        # All nodes that don't contain other candidates are extracted from in one batch.
+        # The rest wait for regions to be found in the nodes they contain.
+        self.assertEqual(extractor.batches, [
+            ['hello', 'bye', 'hello'],
+            ['     '],
+            ['     bye hello     '],
+        ])
+        self.assertEqual(extractor.texts_seen, [])
+
+    def test_iterate_over_same_regions_as_scan(self):
+        scanner = NodeScanner(BatchHelloTextExtractor(), self.tags)
+        self.assertEqual(
+            [(r.node, r.start_offset, r.end_offset) for r in scanner.iter_scan(self.document)],
+            [(r.node, r.start_offset, r.end_offset) for r in scanner.scan(self.document)],
+        )
+
+    def test_only_batch_uncached_nodes(self):
+        extractor = BatchHelloTextExtractor()
+        scanner = NodeScanner(extractor, ['p'], cache=ExtractionCache())
+        scanner.scan(HtmlDocument('<p>hello</p><p>bye</p>'))
+        regions = scanner.scan(HtmlDocument('<p>hello</p><p>new hello</p>'))
+        self.assertEqual(extractor.batches, [['hello', 'bye'], ['new hello']])
+        self.assertEqual([(r.start_offset, r.end_offset) for r in regions], [(0, 4), (4, 8)])
+
+
+class StreamScanTest(unittest.TestCase):
+
+    def scan_both_ways(self, doc, tags):
+        document = HtmlDocument(doc)
+        return [
+            [(get_css_selector(r.node), r.start_offset, r.end_offset, r.string) for r in regions]
+            for regions in [
+                NodeScanner(HelloTextExtractor(), tags).scan(document),
+                StreamScanner(HelloTextExtractor(), tags).scan(doc),
+            ]
+        ]
+
+    def test_find_same_regions_as_node_scanner(self):
+        doc = '\n'.join([
+            '<div>',
+            '  <p>hello</p>',
+            '  hello',
+            '  <pre>\nhello <code>hello</code> hello</pre>',
+            '</div>',
+        ])
+        tree_regions, stream_regions = self.scan_both_ways(doc, ['p', 'div', 'pre', 'code'])
+        self.assertEqual(len(stream_regions), 5)
+        self.assertEqual(stream_regions, tree_regions)
+
+    def test_find_same_regions_when_link_starts_in_link(self):
+        doc = '<a href=x>hello<a>hello</a><pre>hello</pre>'
+        tree_regions, stream_regions = self.scan_both_ways(doc, ['a', 'pre'])
+        self.assertEqual(stream_regions[-1][0], 'HTML > BODY:nth-of-type(1) > PRE:nth-of-type(1)')
+        self.assertEqual(stream_regions, tree_regions)
+
+    def test_find_same_regions_when_formatting_tag_closes_around_block(self):
+        doc = '<b>hello<p>hello</b>hello</p><pre>hello</pre>'
+        tree_regions, stream_regions = self.scan_both_ways(doc, ['b', 'p', 'pre'])
+        self.assertEqual(len(stream_regions), 4)
+        self.assertEqual(stream_regions, tree_regions)
+
+    def test_find_same_regions_when_form_is_nested(self):
+        doc = '<form><div><form><p>hello</p></form></div></form><pre>hello</pre>'
+        tree_regions, stream_regions = self.scan_both_ways(doc, ['form', 'p', 'pre'])
+        self.assertEqual(stream_regions, tree_regions)
+
+    def test_find_same_regions_when_formatting_tag_is_closed_by_block(self):
+        doc = '<p><i>hello<div>hello</i>hello</div><pre>hello</pre></p><pre>hello</pre>'
+        tree_regions, stream_regions = self.scan_both_ways(doc, ['p', 'i', 'div', 'pre'])
+        self.assertEqual(stream_regions, tree_regions)
+
+    def test_find_same_regions_after_regions_found_before_misnested_tags(self):
+        doc = '<p>hello</p><pre>hello</pre><b>hello<p>hello</b>hello</p><code>hello</code>'
+        tree_regions, stream_regions = self.scan_both_ways(doc, ['p', 'pre', 'b', 'code'])
+        self.assertEqual(len(stream_regions), 6)
+        self.assertEqual(stream_regions, tree_regions)
+
+    def test_node_of_region_has_text_of_element(self):
+        scanner = StreamScanner(HelloTextExtractor(), ['p'])
+        regions = scanner.scan('<div><p>hello <b>there</b></p></div>')
+        self.assertEqual(regions[0].node.name, 'p')
+        self.assertEqual(regions[0].node.text, 'hello there')
+
+    def test_skip_elements_without_scanner_tags(self):
+        extractor = HelloTextExtractor()
+        scanner = StreamScanner(extractor, ['code'])
+        regions = scanner.scan('<p>hello</p><code>hello</code>')
+        self.assertEqual(len(regions), 1)
+        self.assertEqual(extractor.texts_seen, ['hello'])
+
+
+class ScanDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.document = HtmlDocument('<p>hello</p><p>hello</p><p>hello</p>')
+
+    def test_scan_everything_when_deadline_is_not_reached(self):
+        with scan_deadline(60) as deadline:
+            regions = NodeScanner(HelloTextExtractor(), ['p']).scan(self.document)
+        self.assertEqual(len(regions), 3)
+        self.assertFalse(deadline.truncated)
+
+    def test_scan_nothing_after_deadline(self):
+        with scan_deadline(0) as deadline:
+            regions = NodeScanner(HelloTextExtractor(), ['p']).scan(self.document)
+        self.assertEqual(len(regions), 0)
+        self.assertTrue(deadline.truncated)
+
+    def test_return_regions_found_before_deadline(self):
+        with scan_deadline(60) as deadline:
+            extractor = ExpiringHelloTextExtractor()
+            regions = NodeScanner(extractor, ['p']).scan(self.document)
+        self.assertEqual(len(regions), 1)
+        self.assertEqual(len(extractor.texts_seen), 1)
+        self.assertTrue(deadline.truncated)
+
+    def test_stream_scan_returns_regions_found_before_deadline(self):
+        with scan_deadline(60) as deadline:
+            extractor = ExpiringHelloTextExtractor()
+            regions = StreamScanner(extractor, ['p']).scan('<p>hello</p><p>hello</p>')
+        self.assertEqual(len(regions), 1)
+        self.assertTrue(deadline.truncated)
+
+    def test_deadline_is_removed_after_block(self):
+        with scan_deadline(0):
+            pass
+        self.assertIsNone(get_scan_deadline())
+        regions = NodeScanner(HelloTextExtractor(), ['p']).scan(self.document)
+        self.assertEqual(len(regions), 3)
+
 
 class HelloTextExtractor(object):
     ''' Extractor for testing that pulls out substrings that say 'hello'. '''
+
+    def __init__(self):
+        self.texts_seen = []
+
     def extract(self, node):
+        self.texts_seen.append(node.text)
         regions = []
         matches = re.finditer('hello', node.text)
         for m in matches:
             region = Region(node, m.start(), m.end() - 1, node.text)
             regions.append(region)
         return regions
+
+
+class ExpiringHelloTextExtractor(HelloTextExtractor):
+    ''' Extractor that uses up the time left before the scan deadline. '''
+
+    def extract(self, node):
+        get_scan_deadline().end_time = 0
+        return super(ExpiringHelloTextExtractor, self).extract(node)
+
+
+class BatchHelloTextExtractor(HelloTextExtractor):
+    ''' Extractor that finds 'hello' in a batch of nodes at a time. '''
+
+    def __init__(self):
+        super(BatchHelloTextExtractor, self).__init__()
+        self.batches = []
+
+    def extract_many(self, nodes):
+        self.batches.append([n.text for n in nodes])
+        return [
+            [Region(n, m.start(), m.end() - 1, n.text) for m in re.finditer('hello', n.text)]
+            for n in nodes
+        ]
+
+
+class PickleCountingExtractor(HelloTextExtractor):
+    ''' Extractor that counts how many times it has been pickled to send to workers. '''
+
+    pickle_count = 0
+
+    def __getstate__(self):
+        PickleCountingExtractor.pickle_count += 1
+        return self.__dict__
@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import unittest
+
+from tutorons.core.scanner import NodeScanner
+from tutorons.core.parsercheck import compare_parser_backends
+from tutorons.core.tests.test_node_visitor import HelloTextExtractor
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def detect_hellos(document):
+    return NodeScanner(HelloTextExtractor(), ['p', 'pre']).scan(document)
+
+
+class CompareParserBackendsTest(unittest.TestCase):
+
+    def test_same_backend_has_no_differences(self):
+        comparisons = compare_parser_backends('<div><p>hello</p></div>', ['html5lib'])
+        self.assertEqual(comparisons['html5lib']['missing'], [])
+        self.assertEqual(comparisons['html5lib']['extra'], [])
+        self.assertGreater(comparisons['html5lib']['parse_time'], 0)
+
+    def test_find_tags_missing_from_backend(self):
+        comparisons = compare_parser_backends('<div><p>hello</p></div>', ['html.parser'])
+        missing_selectors = [p[0] for p in comparisons['html.parser']['missing']]
+        self.assertIn('HTML > BODY:nth-of-type(1) > DIV:nth-of-type(1)', missing_selectors)
+        self.assertIn(('DIV:nth-of-type(1)', 'hello'), comparisons['html.parser']['extra'])
+
+    def test_compare_positions_of_detected_regions(self):
+        # html5lib drops the newline at the start of a 'pre', which changes region offsets
+        comparisons = compare_parser_backends(
+            '<html><body><pre>\nhello</pre></body></html>', ['html5lib', 'html.parser'],
+            detect_func=detect_hellos)
+        self.assertEqual(comparisons['html5lib']['extra'], [])
+        self.assertEqual(
+            comparisons['html.parser']['missing'],
+            [('HTML > BODY:nth-of-type(1) > PRE:nth-of-type(1)', 0, 4, 'hello')])
+        self.assertEqual(
+            comparisons['html.parser']['extra'],
+            [('HTML > BODY:nth-of-type(1) > PRE:nth-of-type(1)', 1, 5, '\nhello')])
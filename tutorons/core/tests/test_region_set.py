@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import unittest
+from tutorons.core.htmltools import HtmlDocument, StreamedElement
+from tutorons.core.extractor import Region, RegionSet
+from tutorons.core.scanner import NodeScanner
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+class CommandRegion(Region):
+    ''' Region for testing that carries the command that was found. '''
+
+    def __init__(self, node, start_offset, end_offset, string, cmd):
+        super(CommandRegion, self).__init__(node, start_offset, end_offset, string)
+        self.cmd = cmd
+
+
+class CommandExtractor(object):
+    ''' Extractor for testing that finds each 'ls' command as a `CommandRegion`. '''
+
+    def extract(self, node):
+        start = node.text.find('ls')
+        if start == -1:
+            return []
+        return [CommandRegion(node, start, start + 1, 'ls', cmd='list')]
+
+
+class RegionTest(unittest.TestCase):
+
+    def test_region_keeps_offsets_out_of_instance_dictionary(self):
+        region = Region(None, 0, 1, 'ab')
+        self.assertEqual(region.__dict__, {})
+
+    def test_set_other_attributes_on_region(self):
+        region = Region(None, 0, 1, 'ab')
+        region.explanation = 'explanation'
+        self.assertEqual(region.explanation, 'explanation')
+
+
+class RegionSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.document = HtmlDocument('<p>first</p><p>second</p>')
+        self.first, self.second = self.document.find_all('p')
+        self.regions = RegionSet(self.document.index, [
+            Region(self.second, 0, 2, 'sec'),
+            Region(self.first, 1, 2, 'ir'),
+            Region(self.first, 0, 0, 'f'),
+            Region(self.second, 0, 2, 'sec'),
+        ])
+
+    def test_read_regions_in_order_added(self):
+        self.assertEqual(len(self.regions), 4)
+        self.assertEqual([r.string for r in self.regions], ['sec', 'ir', 'f', 'sec'])
+        self.assertIs(self.regions[1].node, self.first)
+        self.assertEqual(self.regions[1].start_offset, 1)
+        self.assertEqual(self.regions[1].end_offset, 2)
+
+    def test_read_regions_with_negative_indexes(self):
+        self.assertEqual(self.regions[-3].string, 'ir')
+        self.assertIs(self.regions[-3], self.regions[1])
+        with self.assertRaises(IndexError):
+            self.regions[-5]
+
+    def test_slice_regions(self):
+        regions = self.regions[1:]
+        self.assertIsInstance(regions, RegionSet)
+        self.assertEqual([r.string for r in regions], ['ir', 'f', 'sec'])
+        self.assertIs(regions[0].node, self.first)
+        self.assertEqual([r.string for r in self.regions[::-2]], ['sec', 'ir'])
+        self.assertEqual(len(self.regions[4:]), 0)
+
+    def test_read_same_region_object_each_time(self):
+        self.assertIs(self.regions[0], self.regions[0])
+        self.regions[0].string = 'edited'
+        self.assertEqual(self.regions[0].string, 'edited')
+        self.assertEqual(list(self.regions)[0].string, 'edited')
+        self.assertIs(self.regions[:1][0], self.regions[0])
+
+    def test_order_regions_by_node_and_offset(self):
+        ordered = self.regions.ordered()
+        self.assertEqual([r.string for r in ordered], ['f', 'ir', 'sec', 'sec'])
+
+    def test_filter_regions(self):
+        filtered = self.regions.filter(lambda r: r.node is self.second)
+        self.assertEqual([r.string for r in filtered], ['sec', 'sec'])
+
+    def test_deduplicate_regions(self):
+        deduplicated = self.regions.deduplicate()
+        self.assertEqual([r.string for r in deduplicated], ['sec', 'ir', 'f'])
+
+    def test_store_nodes_that_are_not_in_index(self):
+        element = StreamedElement('p', {}, 1, None)
+        regions = RegionSet(self.document.index)
+        regions.add(element, 0, 1, 'ab')
+        regions.add(self.first, 0, 1, 'fi')
+        self.assertIs(regions[0].node, element)
+        self.assertEqual([r.string for r in regions.ordered()], ['fi', 'ab'])
+
+    def test_store_nodes_without_index(self):
+        regions = RegionSet()
+        regions.add(self.second, 0, 2, 'sec')
+        self.assertIs(regions[0].node, self.second)
+
+    def test_keep_region_subclasses(self):
+        region = CommandRegion(self.first, 0, 1, 'ls', cmd='list')
+        regions = RegionSet(self.document.index, [region])
+        self.assertIs(regions[0], region)
+        self.assertEqual(regions.ordered()[0].cmd, 'list')
+
+    def test_keep_regions_with_other_attributes(self):
+        region = Region(self.first, 0, 1, 'fi')
+        region.explanation = 'explanation'
+        regions = RegionSet(self.document.index, [region])
+        self.assertIs(regions[0], region)
+
+    def test_keep_region_subclasses_from_scan(self):
+        document = HtmlDocument('<p>ls</p><p>ls -l</p>')
+        regions = NodeScanner(CommandExtractor(), ['p']).scan(document)
+        self.assertEqual([type(r) for r in regions], [CommandRegion, CommandRegion])
+        self.assertEqual([r.cmd for r in regions], ['list', 'list'])
+
+    def test_add_regions_to_lists_and_sets(self):
+        region = Region(self.first, 0, 0, 'f')
+        self.assertEqual([r.string for r in self.regions + []], ['sec', 'ir', 'f', 'sec'])
+        self.assertIsInstance(self.regions + [region], RegionSet)
+        self.assertEqual([r.string for r in [region] + self.regions[:1]], ['f', 'sec'])
+        self.assertEqual(len(self.regions + self.regions), 8)
+        regions = RegionSet(self.document.index)
+        regions += [region]
+        self.assertEqual([r.string for r in regions], ['f'])
+
+    def test_compare_regions_to_lists(self):
+        regions = self.regions[:2]
+        self.assertEqual(regions, [regions[0], regions[1]])
+        self.assertEqual(RegionSet(), [])
+        self.assertNotEqual(self.regions, [])
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import json
+import gzip
+import io
+from urllib import urlencode
+from django.test import TestCase, RequestFactory, override_settings
+
+from tutorons.core.views import pagescan, snippetexplain
+from tutorons.core.models import Block
+from tutorons.core.requestdata import read_body, RequestBodyError
+from tutorons.core.tests.test_views import scan_hellos
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def gzip_bytes(data):
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+        gzip_file.write(data)
+    return compressed.getvalue()
+
+
+class ReadBodyTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_read_body(self):
+        request = self.factory.post('/scan', '<p>hello</p>', content_type='text/html')
+        self.assertEqual(read_body(request, 100), b'<p>hello</p>')
+
+    def test_decompress_gzip_body(self):
+        request = self.factory.post(
+            '/scan', gzip_bytes(b'<p>hello</p>'), content_type='text/html',
+            HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(read_body(request, 100), b'<p>hello</p>')
+
+    def test_stop_reading_body_larger_than_max_size(self):
+        request = self.factory.post('/scan', 'x' * 101, content_type='text/html')
+        with self.assertRaises(RequestBodyError) as context:
+            read_body(request, 100)
+        self.assertEqual(context.exception.status, 413)
+
+    def test_stop_decompressing_body_larger_than_max_size(self):
+        request = self.factory.post(
+            '/scan', gzip_bytes(b'x' * 10 ** 6), content_type='text/html',
+            HTTP_CONTENT_ENCODING='gzip')
+        with self.assertRaises(RequestBodyError) as context:
+            read_body(request, 1000)
+        self.assertEqual(context.exception.status, 413)
+
+    def test_refuse_invalid_gzip_body(self):
+        request = self.factory.post(
+            '/scan', '<p>hello</p>', content_type='text/html', HTTP_CONTENT_ENCODING='gzip')
+        with self.assertRaises(RequestBodyError) as context:
+            read_body(request, 100)
+        self.assertEqual(context.exception.status, 400)
+
+    def test_refuse_unsupported_encoding(self):
+        request = self.factory.post(
+            '/scan', '<p>hello</p>', content_type='text/html', HTTP_CONTENT_ENCODING='br')
+        with self.assertRaises(RequestBodyError) as context:
+            read_body(request, 100)
+        self.assertEqual(context.exception.status, 415)
+
+
+class UploadDocumentTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = pagescan(scan_hellos)
+
+    def scan(self, request):
+        response = self.view(request)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_scan_raw_html_body_with_params_in_query(self):
+        request = self.factory.post(
+            '/hello/scan?origin=www.test.com&client_start_time=5',
+            '<p>hello</p>', content_type='text/html; charset=utf-8')
+        response = self.scan(request)
+        self.assertEqual(len(response['regions']), 1)
+        self.assertEqual(response['client_start_time'], '5')
+        self.assertEqual(Block.objects.get().url, 'www.test.com')
+
+    def test_scan_gzipped_html_body_with_params_in_headers(self):
+        request = self.factory.post(
+            '/hello/scan', gzip_bytes('<p>hello</p><p>héllo hello</p>'.encode('utf-8')),
+            content_type='text/html; charset=utf-8', HTTP_CONTENT_ENCODING='gzip',
+            HTTP_X_TUTORONS_ORIGIN='www.test.com', HTTP_X_TUTORONS_CLIENT_START_TIME='5')
+        response = self.scan(request)
+        self.assertEqual(len(response['regions']), 2)
+        self.assertEqual(response['regions'][1]['start_index'], 6)
+        self.assertEqual(response['client_start_time'], '5')
+        self.assertEqual(Block.objects.first().url, 'www.test.com')
+
+    def test_scan_gzipped_form(self):
+        form = urlencode({'origin': 'www.test.com', 'document': '<p>hello</p>'})
+        request = self.factory.post(
+            '/hello/scan', gzip_bytes(form), content_type='application/x-www-form-urlencoded',
+            HTTP_CONTENT_ENCODING='gzip')
+        response = self.scan(request)
+        self.assertEqual(len(response['regions']), 1)
+        self.assertEqual(Block.objects.get().url, 'www.test.com')
+
+    @override_settings(MAX_REQUEST_BODY_SIZE=1000)
+    def test_refuse_documents_larger_than_max_size(self):
+        request = self.factory.post(
+            '/hello/scan', gzip_bytes(b'<p>hello</p>' * 1000), content_type='text/html',
+            HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(self.view(request).status_code, 413)
+
+    def test_refuse_unsupported_content_type(self):
+        request = self.factory.post(
+            '/hello/scan', '{}', content_type='application/json')
+        self.assertEqual(self.view(request).status_code, 415)
+
+    def test_explain_raw_text_body(self):
+        view = snippetexplain(lambda text, edge_size: "Explanation of %s (%d)" % (text, edge_size))
+        request = self.factory.post(
+            '/hello/explain?origin=www.test.com&edge_size=3', 'abs(2)', content_type='text/plain')
+        response = json.loads(view(request).content)
+        self.assertEqual(response['region']['document'], "Explanation of abs(2) (3)")
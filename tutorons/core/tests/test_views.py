@@ -0,0 +1,393 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import json
+from django.test import TestCase, RequestFactory, override_settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import request_finished
+from django.db import close_old_connections
+
+from tutorons.core.views import pagescan, pagescan_batch, snippetexplain_batch
+from tutorons.core.models import ServerQuery, Region
+from tutorons.core.metrics import counters
+from tutorons.core.scanner import NodeScanner, StreamScanner
+from tutorons.core.htmltools import HtmlDocument
+from tutorons.core.cache import ScanResultCache
+from tutorons.core.tests.test_node_visitor import HelloTextExtractor
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def scan_hellos(document):
+    regions = NodeScanner(HelloTextExtractor(), ['p']).scan(document)
+    return [(r, "<p>Greeting</p>") for r in regions]
+
+
+def stream_hellos(document):
+    regions = StreamScanner(HelloTextExtractor(), ['p']).scan(document)
+    return [(r, "<p>Greeting</p>") for r in regions]
+
+
+class PageScanTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def post(self, view, document):
+        request = self.factory.post('/hello/scan', data={
+            'origin': 'www.test.com',
+            'document': document,
+        })
+        return json.loads(view(request).content)
+
+    def test_scan_parsed_document(self):
+        documents = []
+
+        def scan(document):
+            documents.append(document)
+            return scan_hellos(document)
+
+        response = self.post(pagescan(scan), '<div><p>hello</p></div>')
+        self.assertIsInstance(documents[0], HtmlDocument)
+        self.assertEqual(len(response['regions']), 1)
+        region = response['regions'][0]
+        self.assertEqual(
+            region['node'],
+            'HTML > BODY:nth-of-type(1) > DIV:nth-of-type(1) > P:nth-of-type(1)')
+        self.assertEqual(region['start_index'], 0)
+        self.assertEqual(region['end_index'], 4)
+
+    def test_scan_streamed_document(self):
+        parsed_response = self.post(pagescan(scan_hellos), '<div><p>hello</p></div>')
+        streamed_response = self.post(
+            pagescan(streaming=True)(stream_hellos), '<div><p>hello</p></div>')
+        for key in ['node', 'start_index', 'end_index', 'document']:
+            self.assertEqual(
+                streamed_response['regions'][0][key],
+                parsed_response['regions'][0][key]
+            )
+
+    def test_scan_is_not_truncated_within_time_budget(self):
+        response = self.post(pagescan(time_budget=60)(scan_hellos), '<p>hello</p>')
+        self.assertEqual(len(response['regions']), 1)
+        self.assertFalse(response['truncated'])
+        self.assertGreaterEqual(response['elapsed_time'], 0)
+
+    def test_scan_is_truncated_after_time_budget(self):
+        response = self.post(pagescan(time_budget=0)(scan_hellos), '<p>hello</p>')
+        self.assertEqual(response['regions'], [])
+        self.assertTrue(response['truncated'])
+
+    def test_skip_documents_without_scanned_tags(self):
+        documents = []
+
+        def scan(document):
+            documents.append(document)
+            return scan_hellos(document)
+
+        skipped_before = counters['pagescan_prefilter_skipped']
+        response = self.post(pagescan(tags=['p'])(scan), '<div>hello</div>')
+        self.assertEqual(response['regions'], [])
+        self.assertEqual(documents, [])
+        self.assertEqual(ServerQuery.objects.count(), 1)
+        self.assertEqual(Region.objects.count(), 0)
+        self.assertEqual(counters['pagescan_prefilter_skipped'], skipped_before + 1)
+
+    def test_scan_documents_with_scanned_tags(self):
+        passed_before = counters['pagescan_prefilter_passed']
+        response = self.post(pagescan(tags=['p'])(scan_hellos), '<div><P>hello</P></div>')
+        self.assertEqual(len(response['regions']), 1)
+        self.assertEqual(counters['pagescan_prefilter_passed'], passed_before + 1)
+
+    def test_scan_with_generator(self):
+
+        def scan(document):
+            scanner = NodeScanner(HelloTextExtractor(), ['p'])
+            for region in scanner.iter_scan(document):
+                yield (region, "<p>Greeting</p>")
+
+        response = self.post(pagescan(scan), '<p>hello</p><p>hello</p>')
+        self.assertEqual(len(response['regions']), 2)
+
+
+@override_settings(API_JSON_INDENT=None)
+class CompactResponseTest(TestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().post('/hello/scan', data={
+            'origin': 'www.test.com',
+            'document': '<p>hello</p><p>hello</p>',
+        })
+        self.regions_explained = 0
+
+    def scan(self, document):
+        for region in NodeScanner(HelloTextExtractor(), ['p']).iter_scan(document):
+            self.regions_explained += 1
+            yield (region, "<p>Greeting</p>")
+
+    def test_respond_with_compact_json(self):
+        response = pagescan(self.scan)(self.request)
+        content = b''.join(response.streaming_content)
+        self.assertNotIn(b'\n', content)
+        self.assertNotIn(b'", "', content)
+        data = json.loads(content)
+        self.assertEqual(len(data['regions']), 2)
+        self.assertEqual(data['regions'][1]['document'], "<p>Greeting</p>")
+        self.assertFalse(data['truncated'])
+
+    def test_stream_regions_as_they_are_explained(self):
+        response = pagescan(self.scan)(self.request)
+        content = b''
+        chunks = iter(response.streaming_content)
+        while b'Greeting' not in content:
+            content += next(chunks)
+        self.assertEqual(self.regions_explained, 1)
+        content += b''.join(chunks)
+        self.assertEqual(self.regions_explained, 2)
+
+    def test_log_regions_once_response_is_sent(self):
+        response = pagescan(self.scan)(self.request)
+        self.assertEqual(Region.objects.count(), 0)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(
+            sorted(unicode(r.id) for r in Region.objects.all()),
+            sorted(r['region_id'] for r in data['regions']),
+        )
+        self.assertIsNotNone(ServerQuery.objects.get().end_time)
+
+    def test_finish_valid_json_when_explainer_fails_mid_stream(self):
+
+        def scan(document):
+            for region in self.scan(document):
+                if self.regions_explained > 1:
+                    raise ValueError("Explainer failed")
+                yield region
+
+        response = pagescan(scan)(self.request)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(data['regions']), 1)
+        self.assertIn('error', data)
+        self.assertIn('query_id', data)
+        self.assertEqual(
+            [unicode(r.id) for r in Region.objects.all()], [data['regions'][0]['region_id']])
+        self.assertIsNotNone(ServerQuery.objects.get().end_time)
+
+    def test_log_regions_sent_before_client_disconnects(self):
+        response = pagescan(self.scan)(self.request)
+        content = b''
+        chunks = iter(response.streaming_content)
+        while b'Greeting' not in content:
+            content += next(chunks)
+        # Like the test client, keep the test's database connection open when the server
+        # closes the response
+        request_finished.disconnect(close_old_connections)
+        try:
+            response.close()
+        finally:
+            request_finished.connect(close_old_connections)
+        self.assertEqual(self.regions_explained, 1)
+        self.assertEqual(Region.objects.count(), 1)
+        self.assertIsNotNone(ServerQuery.objects.get().end_time)
+
+    def test_successful_response_has_no_error(self):
+        response = pagescan(self.scan)(self.request)
+        self.assertNotIn('error', json.loads(b''.join(response.streaming_content)))
+
+
+class BatchPageScanTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def post(self, view, documents):
+        request = self.factory.post('/hello/scan_batch', data={
+            'origin': 'www.test.com',
+            'documents': json.dumps(documents),
+        })
+        return view(request)
+
+    def test_scan_each_document(self):
+        response = self.post(pagescan_batch(scan_hellos), [
+            '<p>hello</p>',
+            '<div>hello</div>',
+            '<p>hello</p><p>hello</p>',
+        ])
+        results = json.loads(response.content)['results']
+        self.assertEqual(sorted(results.keys()), ['0', '1', '2'])
+        self.assertEqual(len(results['0']['regions']), 1)
+        self.assertEqual(results['1']['regions'], [])
+        self.assertEqual(len(results['2']['regions']), 2)
+        self.assertFalse(results['2']['truncated'])
+
+    def test_log_batch_as_one_query(self):
+        response = json.loads(self.post(
+            pagescan_batch(scan_hellos), ['<p>hello</p>', '<p>hello</p><p>hello</p>']).content)
+        query = ServerQuery.objects.get()
+        self.assertEqual(response['query_id'], unicode(query.id))
+        self.assertIsNotNone(query.end_time)
+        self.assertEqual(Region.objects.filter(query=query).count(), 3)
+        region_ids = [
+            r['region_id'] for result in response['results'].values() for r in result['regions']]
+        self.assertEqual(
+            sorted(region_ids), sorted(unicode(r.id) for r in Region.objects.all()))
+
+    def test_scan_identical_documents_once(self):
+        documents = []
+
+        def scan(document):
+            documents.append(document)
+            return scan_hellos(document)
+
+        response = self.post(pagescan_batch(scan), ['<p>hello</p>', '<p>hello</p>'])
+        results = json.loads(response.content)['results']
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(len(results['1']['regions']), 1)
+        self.assertNotEqual(
+            results['0']['regions'][0]['region_id'], results['1']['regions'][0]['region_id'])
+        self.assertEqual(Region.objects.count(), 2)
+
+    def test_documents_after_time_budget_are_truncated(self):
+        response = self.post(
+            pagescan_batch(time_budget=0)(scan_hellos), ['<p>hello</p>', '<p>hello</p>'])
+        data = json.loads(response.content)
+        self.assertEqual(data['results']['1']['regions'], [])
+        self.assertTrue(data['results']['1']['truncated'])
+        self.assertTrue(data['truncated'])
+
+    def test_scan_documents_sent_as_json_body(self):
+        request = self.factory.post(
+            '/hello/scan_batch?origin=www.test.com', json.dumps(['<p>hello</p>']),
+            content_type='application/json')
+        results = json.loads(pagescan_batch(scan_hellos)(request).content)['results']
+        self.assertEqual(len(results['0']['regions']), 1)
+
+    def test_refuse_documents_that_are_not_an_array_of_strings(self):
+        self.assertEqual(self.post(pagescan_batch(scan_hellos), {}).status_code, 400)
+        self.assertEqual(self.post(pagescan_batch(scan_hellos), [1]).status_code, 400)
+        self.assertEqual(ServerQuery.objects.count(), 0)
+
+    @override_settings(MAX_BATCH_SIZE=2)
+    def test_refuse_batches_larger_than_max_size(self):
+        response = self.post(pagescan_batch(scan_hellos), ['<p>hello</p>'] * 3)
+        self.assertEqual(response.status_code, 413)
+
+    @override_settings(API_JSON_INDENT=None)
+    def test_stream_compact_results(self):
+        response = self.post(pagescan_batch(scan_hellos), ['<p>hello</p>', '<p>hello</p>'])
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(data['results']['1']['regions']), 1)
+        self.assertEqual(Region.objects.count(), 2)
+
+
+class BatchSnippetExplainTest(TestCase):
+
+    def test_explain_each_snippet(self):
+        texts = []
+
+        def explain(text, edge_size):
+            texts.append(text)
+            return "Explanation of " + text
+
+        request = RequestFactory().post('/hello/explain_batch', data={
+            'origin': 'www.test.com',
+            'texts': json.dumps(['abs(2)', 'len(x)', 'abs(2)']),
+        })
+        response = json.loads(snippetexplain_batch(explain)(request).content)
+        self.assertEqual(sorted(texts), ['abs(2)', 'len(x)'])
+        self.assertEqual(response['regions']['1']['document'], "Explanation of len(x)")
+        self.assertEqual(response['regions']['2']['document'], "Explanation of abs(2)")
+        self.assertEqual(response['sq_id'], unicode(ServerQuery.objects.get().id))
+        self.assertEqual(Region.objects.count(), 3)
+
+
+class ScanResultCacheTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.backend = LocMemCache('scan-result-test', {})
+        self.backend.clear()
+        self.documents = []
+
+    def scan(self, document):
+        self.documents.append(document)
+        return scan_hellos(document)
+
+    def post(self, view, document=None, **headers):
+        data = {'origin': 'www.test.com'}
+        if document is not None:
+            data['document'] = document
+        return view(self.factory.post('/hello/scan', data=data, **headers))
+
+    def test_scan_document_sent_again_once(self):
+        view = pagescan(self.scan, result_cache=ScanResultCache('hello', backend=self.backend))
+        first_response = json.loads(self.post(view, '<p>hello</p>').content)
+        second_response = json.loads(self.post(view, '<p>hello</p>').content)
+        self.assertEqual(len(self.documents), 1)
+        self.assertEqual(len(second_response['regions']), 1)
+        for key in ['node', 'start_index', 'end_index', 'document']:
+            self.assertEqual(
+                second_response['regions'][0][key], first_response['regions'][0][key])
+
+    def test_log_new_query_and_regions_for_cached_results(self):
+        view = pagescan(self.scan, result_cache=ScanResultCache('hello', backend=self.backend))
+        self.post(view, '<p>hello</p>')
+        response = json.loads(self.post(view, '<p>hello</p>').content)
+        self.assertEqual(ServerQuery.objects.count(), 2)
+        region = Region.objects.get(id=response['regions'][0]['region_id'])
+        self.assertEqual(unicode(region.query.id), response['query_id'])
+        self.assertEqual(response['regions'][0]['query_id'], response['query_id'])
+        self.assertEqual(region.string, 'hello')
+        self.assertEqual(region.block.url, 'www.test.com')
+
+    def test_fail_precondition_if_etag_matches(self):
+        view = pagescan(self.scan, result_cache=ScanResultCache('hello', backend=self.backend))
+        etag = self.post(view, '<p>hello</p>')['ETag']
+        response = self.post(view, '<p>hello</p>', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(ServerQuery.objects.count(), 2)
+        self.assertEqual(len(self.documents), 1)
+
+    def test_fail_precondition_without_document(self):
+        view = pagescan(self.scan, result_cache=ScanResultCache('hello', backend=self.backend))
+        etag = self.post(view, '<p>hello</p>')['ETag']
+        compressed_etag = etag[:-1] + ';gzip"'
+        response = self.post(view, HTTP_IF_NONE_MATCH=compressed_etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_ask_for_document_if_etag_is_unknown(self):
+        view = pagescan(self.scan, result_cache=ScanResultCache('hello', backend=self.backend))
+        response = self.post(view, HTTP_IF_NONE_MATCH='W/"unknown"')
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNotNone(ServerQuery.objects.get().end_time)
+
+    def test_scan_changed_document(self):
+        view = pagescan(self.scan, result_cache=ScanResultCache('hello', backend=self.backend))
+        etag = self.post(view, '<p>hello</p>')['ETag']
+        response = self.post(view, '<p>hello</p><p>hello</p>', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(json.loads(response.content)['regions']), 2)
+
+    def test_scan_again_when_version_changes(self):
+        old_view = pagescan(
+            self.scan, result_cache=ScanResultCache('hello', version=1, backend=self.backend))
+        new_view = pagescan(
+            self.scan, result_cache=ScanResultCache('hello', version=2, backend=self.backend))
+        etag = self.post(old_view, '<p>hello</p>')['ETag']
+        response = self.post(new_view, '<p>hello</p>', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.documents), 2)
+
+    def test_dont_save_truncated_results(self):
+        cache = ScanResultCache('hello', backend=self.backend)
+        truncating_view = pagescan(time_budget=0, result_cache=cache)(self.scan)
+        etag = self.post(truncating_view, '<p>hello</p>')['ETag']
+        response = self.post(
+            pagescan(self.scan, result_cache=cache), '<p>hello</p>', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['regions']), 1)
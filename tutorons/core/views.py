@@ -4,73 +4,357 @@
 from __future__ import unicode_literals
 import logging
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
 import json
+import time
+import types
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 from tutorons.core.extractor import Region
-from tutorons.core.htmltools import get_css_selector, HtmlDocument
-from tutorons.core.dblogger import DbLogger
+from tutorons.core.htmltools import get_css_selector, get_parsed_document, compile_tag_pattern, \
+    HtmlDocument
+from tutorons.core.dblogger import DbLogger, get_region_record_fields
+from tutorons.core.scanner import scan_deadline
+from tutorons.core.requestdata import get_request_params, RequestBodyError
+from tutorons.core.metrics import counters
+from tutorons.middleware.compression import compress_response
 
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
+DEFAULT_MAX_BATCH_SIZE = 100
+# Batches can also be sent as a raw JSON array, instead of as a form field
+BATCH_CONTENT_TYPES = ('application/json',)
+
 
 def _get_resource_url(request, resource):
     return "//" + request.get_host() + resource
 
 
+def _get_json_encoder():
+    '''
+    Get the function that encodes values in responses as JSON.  Responses are compact,
+    unless the API_JSON_INDENT setting is set (e.g., during development).  Compact
+    responses are encoded with ujson if it is installed.
+    '''
+    indent = getattr(settings, 'API_JSON_INDENT', None)
+    if indent is not None:
+        return lambda value: json.dumps(value, indent=indent)
+    if ujson is not None:
+        return ujson.dumps
+    return lambda value: json.dumps(value, separators=(',', ':'))
+
+
+class _JsonObject(object):
+    ''' A nested JSON object, encoded from (key, value) fields like a response (see below). '''
+
+    def __init__(self, fields):
+        self.fields = fields
+
+
+def _get_field_value(value):
+    if isinstance(value, types.GeneratorType):
+        return list(value)
+    if isinstance(value, _JsonObject):
+        return dict((k, _get_field_value(v)) for k, v in value.fields)
+    return value() if callable(value) else value
+
+
+def _close(value):
+    if isinstance(value, types.GeneratorType):
+        value.close()
+
+
+def _iter_json_object(fields, encode, errors=None):
+    '''
+    Encode a JSON object from a list of (key, value) fields, one piece at a time.
+    Generators are encoded as arrays, one item at a time, and `_JsonObject`s are encoded
+    as objects, one field at a time.  Functions are called for their value, once all of
+    the fields before them have been encoded.
+
+    Part of the object may already have been sent when making a value fails, so the
+    error is logged, and the object is finished with the values made so far and an
+    `error` field, to keep the response valid JSON.  Generators are closed when the
+    object is, even if it isn't finished (e.g., when the client disconnects), so
+    that they can clean up.
+    '''
+    top_level = errors is None
+    errors = [] if top_level else errors
+    fields_encoded = 0
+
+    yield '{'
+    try:
+        for key, value in fields:
+            try:
+                # Values are encoded before their key is sent, so that a value that
+                # fails doesn't leave a key without a value.
+                encoded_value = None if isinstance(value, (types.GeneratorType, _JsonObject)) \
+                    else encode(_get_field_value(value))
+                yield (',' if fields_encoded > 0 else '') + encode(key) + ':'
+                fields_encoded += 1
+                if isinstance(value, types.GeneratorType):
+                    yield '['
+                    try:
+                        for j, item in enumerate(value):
+                            yield (',' if j > 0 else '') + encode(item)
+                    except Exception:
+                        logging.exception("Failed to encode the items of '%s'", key)
+                        errors.append(key)
+                    yield ']'
+                elif isinstance(value, _JsonObject):
+                    for piece in _iter_json_object(value.fields, encode, errors):
+                        yield piece
+                else:
+                    yield encoded_value
+            finally:
+                _close(value)
+    except Exception:
+        logging.exception("Failed to encode the fields of a response")
+        errors.append(None)
+    finally:
+        _close(fields)
+
+    if top_level and errors:
+        yield (',' if fields_encoded > 0 else '') + encode('error') + ':' + \
+            encode("The server failed while making this response, so it may be incomplete.")
+    yield '}'
+
+
+def _make_json_response(fields):
+    '''
+    Make a response with a JSON object of (key, value) fields (see `_iter_json_object`).
+    Compact responses are streamed as they are encoded, so items of arrays can be sent
+    before later items are made.  Pretty-printed responses are sent once all values are known.
+    '''
+    encode = _get_json_encoder()
+    if getattr(settings, 'API_JSON_INDENT', None) is not None:
+        return HttpResponse(encode(dict((k, _get_field_value(v)) for k, v in fields)))
+    return StreamingHttpResponse(_iter_json_object(fields, encode))
+
+
+def _get_if_none_match_tags(request):
+    '''
+    Get the tags of the ETags in a request's If-None-Match header.  Suffixes that the
+    compression middleware adds to ETags (like ';gzip') are removed.
+    '''
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return [etag.split(';')[0] for etag in parse_etags(header) if etag] if header else []
+
+
 def _package_region(region, document, region_id, query_id):
     return {
         'node': get_css_selector(region.node),
         'start_index': region.start_offset,
         'end_index': region.end_offset,
         'document': document,
-        'region_id': region_id,
-        'query_id': query_id,
+        'region_id': unicode(region_id),
+        'query_id': unicode(query_id),
     }
 
 
-def pagescan(scan_func):
+def _scan_document(scan_func, document_content, streaming, tag_pattern):
+    '''
+    Scan a document with the function wrapped by a 'scan' view, unless it has none of
+    the tags that match `tag_pattern`.  Returns the (region, explanation) pairs.
+    '''
+    if tag_pattern is not None and not tag_pattern.search(document_content or ''):
+        # The document can't contain any of the tags that the module scans
+        counters.increment('pagescan_prefilter_skipped')
+        return []
+    if tag_pattern is not None:
+        counters.increment('pagescan_prefilter_passed')
+    document = document_content if streaming else get_parsed_document(document_content)
+    return scan_func(document)
+
+
+def _get_batch_items(params, name):
+    '''
+    Get the items of a batch request, sent as a JSON array of strings in the `name`
+    parameter.  Raises a `RequestBodyError` if they aren't, or if there are more of
+    them than the MAX_BATCH_SIZE setting.
+    '''
+    try:
+        items = json.loads(params.get(name) or '')
+    except ValueError:
+        raise RequestBodyError("`%s` must be a JSON array of strings" % name, 400)
+    if not isinstance(items, list) or not all(isinstance(i, basestring) for i in items):
+        raise RequestBodyError("`%s` must be a JSON array of strings" % name, 400)
+    max_batch_size = getattr(settings, 'MAX_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE)
+    if len(items) > max_batch_size:
+        raise RequestBodyError("Batches can have at most %d items" % max_batch_size, 413)
+    return items
+
+
+def pagescan(scan_func=None, streaming=False, time_budget=None, tags=None, result_cache=None):
     '''
     A wrapper around 'scan' views.
     Handles a lot of the "scanning" boilerplate of fetching request
     arguments, logging the request and its results, and returning the
     results as and HTTP response.
+
+    The wrapped function returns (or yields) pairs of regions and their explanations.
+    If it is a generator (e.g., explaining regions from a scanner's `iter_scan`),
+    each region is explained as soon as it is found.  Compact responses (see
+    `_get_json_encoder`) are streamed, so each region is sent as soon as it is
+    explained.  All of the regions are logged together once the scan is done.
+
+    The wrapped function is passed the document as an `HtmlDocument`.  Documents
+    are cached and shared between requests, so it must not modify them.  To scan
+    large documents without parsing them, wrap the function with
+    `@pagescan(streaming=True)`: it will be passed the document's HTML as a
+    string, which it can scan with a `StreamScanner`.
+
+    Scans stop finding regions after the number of seconds in the SCAN_TIME_BUDGET
+    setting, or `time_budget` if it is passed to the wrapper.  Responses report
+    whether the scan was `truncated` this way, and the `elapsed_time` of the scan.
+
+    The document can be sent as a form field, or as a raw (and optionally gzipped)
+    body, with the other parameters in the query string or headers (see
+    `get_request_params`).
+
+    If the `tags` that the module scans are passed to the wrapper, documents that
+    have no tags with these names are not parsed or scanned.  Instead, the wrapper
+    responds right away with no regions.  The number of documents skipped and
+    scanned this way are counted in `tutorons.core.metrics.counters`.
+
+    If a `result_cache` (a `ScanResultCache`) is passed to the wrapper, the regions of
+    each document are saved once it has been scanned (unless the scan was truncated),
+    and documents that are sent again aren't scanned again.  Responses have an ETag
+    that names the document and the module's version.  Clients that kept the results
+    of a page can send its ETag in an If-None-Match header, with the same document or
+    no document at all.  As RFC 7232 says for requests other than GET and HEAD, if the
+    ETag matches saved results, the wrapper doesn't scan and responds with a 412
+    (Precondition Failed) status and the ETag, which tells the client its results are
+    current.  Requests with no document whose ETags don't match get a 400 status, like
+    other requests that are missing a document, and should be sent again with the
+    document.  Queries are logged either way, and the regions sent from the cache are
+    logged again for the new query.
     '''
+    if scan_func is None:
+        return lambda scan_func: pagescan(
+            scan_func, streaming=streaming, time_budget=time_budget, tags=tags,
+            result_cache=result_cache)
+
+    tag_pattern = compile_tag_pattern(tags) if tags is not None else None
+
     def wrapper(request):
 
-        document_content = request.POST.get('document')
-        client_req_time = request.POST.get('client_start_time')
+        try:
+            params = get_request_params(request, 'document')
+        except RequestBodyError as error:
+            return HttpResponse(unicode(error), status=error.status)
+        document_content = params.get('document')
+        client_req_time = params.get('client_start_time')
+
+        # Look up the results of scanning this document before
+        tag = None
+        cached_results = None
+        results_current = False
+        results_missing = False
+        if result_cache is not None:
+            client_tags = _get_if_none_match_tags(request)
+            if document_content:
+                tag = result_cache.get_tag(document_content)
+                cached_results = result_cache.get(tag)
+                # Truncated results aren't saved, so clients that got them aren't told
+                # they are up to date
+                results_current = tag in client_tags and cached_results is not None
+            elif client_tags:
+                # The client didn't send the document, as it expects it hasn't changed
+                tag = next((t for t in client_tags if result_cache.get(t) is not None), None)
+                results_current = tag is not None
+                results_missing = tag is None
 
         # Log request information
         db_logger = DbLogger()
         query_record = db_logger.log_query(request)
 
-        # Scan document with wrapped method to get regions
-        # and their explanations
-        document = HtmlDocument(document_content)
-        regions = scan_func(document)
-        regions_explained = []
-        for region, explanation in regions:
-            region_record = db_logger.log_region(request, query_record, region)
-            regions_explained.append(
-                _package_region(region, explanation, region_record.id, query_record.id)
-            )
+        # Clients that didn't send the document are asked for it, if there are no results
+        # for it to stand in for.  These requests are logged like any other.
+        if results_missing:
+            db_logger.update_server_end_time(query_record)
+            return HttpResponse(
+                "No results are saved for this page.  Send the document.", status=400)
 
-        # Update the runtime of the scan
-        db_logger.update_server_end_time(query_record)
+        # The precondition "If-None-Match" failed: the client's results are current, so
+        # the document isn't scanned.
+        if results_current:
+            db_logger.update_server_end_time(query_record)
+            response = HttpResponse(
+                "The results for this page haven't changed.", status=412)
+            response['ETag'] = 'W/"%s"' % tag
+            return response
+
+        # Scan document with wrapped method to get regions and their explanations.
+        # Each region is packaged as soon as it is explained, so it can be sent
+        # before the rest of the regions have been found.
+        budget = time_budget if time_budget is not None else \
+            getattr(settings, 'SCAN_TIME_BUDGET', None)
+        scan_state = {}
+
+        def iter_packaged_regions():
+
+            region_records = []
+            results = []
+            try:
+                with scan_deadline(budget) as deadline:
+                    scan_state['deadline'] = deadline
+                    if cached_results is not None:
+                        for record_fields, packaged_region in cached_results:
+                            region_record = db_logger.copy_region_record(
+                                request, query_record, record_fields)
+                            region_records.append(region_record)
+                            yield dict(
+                                packaged_region,
+                                region_id=unicode(region_record.id),
+                                query_id=unicode(query_record.id),
+                            )
+                    else:
+                        regions = _scan_document(
+                            scan_func, document_content, streaming, tag_pattern)
+                        for region, explanation in regions:
+                            region_record = db_logger.make_region_record(
+                                request, query_record, region)
+                            region_records.append(region_record)
+                            packaged_region = _package_region(
+                                region, explanation, region_record.id, query_record.id)
+                            results.append(
+                                (get_region_record_fields(region_record), packaged_region))
+                            yield packaged_region
+
+                # Only complete results are saved, so later requests don't get truncated ones
+                if tag is not None and cached_results is None and not deadline.truncated:
+                    result_cache.set(tag, results)
+
+            finally:
+                # Log all regions at once, with a fixed number of queries however many there
+                # are, and update the runtime of the scan.  This happens even if the scan
+                # fails, or the client disconnects before the response is finished.
+                db_logger.save_region_records(region_records)
+                db_logger.update_server_end_time(query_record)
 
         # Send back a response
-        return HttpResponse(
-            json.dumps({
-                'regions': regions_explained,
-                'client_query_url': _get_resource_url(request, "/api/v1/client_query/"),
-                'view_url': _get_resource_url(request, "/api/v1/view/"),
-                'query_id': query_record.id,
-                'client_start_time': client_req_time,
-            }, indent=2))
+        response = _make_json_response([
+            ('regions', iter_packaged_regions()),
+            ('client_query_url', _get_resource_url(request, "/api/v1/client_query/")),
+            ('view_url', _get_resource_url(request, "/api/v1/view/")),
+            ('query_id', unicode(query_record.id)),
+            ('client_start_time', client_req_time),
+            ('truncated', lambda: scan_state['deadline'].truncated),
+            ('elapsed_time', lambda: scan_state['deadline'].elapsed_time),
+        ])
+        if tag is not None:
+            # The ETag is weak, as the ids in the response are new for each request
+            response['ETag'] = 'W/"%s"' % tag
+        return response
 
-    return wrapper
+    return compress_response(wrapper)
 
 
 def snippetexplain(explain_func):
@@ -78,13 +362,18 @@ def snippetexplain(explain_func):
     A wrapper around 'explaining' views.
     Handles a lot of the "explaining" boilerplate of fetching request
     arguments, logging the request and its results, and returning the
-    results as and HTTP response.
+    results as and HTTP response.  The text can be sent in any of the ways that
+    `pagescan` accepts documents.
     '''
     def wrapper(request):
 
-        text = request.POST.get('text')
-        client_start_time = request.POST.get('client_start_time')
-        edge_size = int(request.POST.get('edge_size', 0))
+        try:
+            params = get_request_params(request, 'text')
+        except RequestBodyError as error:
+            return HttpResponse(unicode(error), status=error.status)
+        text = params.get('text')
+        client_start_time = params.get('client_start_time')
+        edge_size = int(params.get('edge_size', 0))
 
         db_logger = DbLogger()
         query_record = db_logger.log_query(request)
@@ -97,12 +386,146 @@ def snippetexplain(explain_func):
         # Update the runtime of the scan
         db_logger.update_server_end_time(query_record)
 
-        return HttpResponse(json.dumps({
-            "region": explained_region,
-            "url": _get_resource_url(request, "/api/v1/client_query/"),
-            "sq_id": query_record.id,
-            "client_start_time": client_start_time,
-            "error": 0
-        }, indent=2))
+        return _make_json_response([
+            ("region", explained_region),
+            ("url", _get_resource_url(request, "/api/v1/client_query/")),
+            ("sq_id", unicode(query_record.id)),
+            ("client_start_time", client_start_time),
+            ("error", 0),
+        ])
+
+    return compress_response(wrapper)
+
+
+def pagescan_batch(scan_func=None, streaming=False, time_budget=None, tags=None):
+    '''
+    A wrapper around 'scan' views for many documents at once.  It takes the same
+    arguments as `pagescan`, and wraps the same kind of function, which is called
+    once for each document.
+
+    The documents are sent in the `documents` parameter as a JSON array of strings
+    (or as a raw JSON body, with the other parameters in the query string or headers).
+    They are all logged under one query, and their regions are all logged together
+    once the last document has been scanned.  Identical documents in a batch are only
+    scanned once, and all documents share the module's caches.
+
+    The response has the same fields as a `pagescan` response, except that instead of
+    `regions`, it has `results`: an object from the index of each document in the batch
+    to its `regions`, whether its scan was `truncated`, and the `elapsed_time` of its scan.
+    The time budget is shared by the whole batch, so documents that come after it runs
+    out aren't scanned, and are reported as truncated.
+    '''
+    if scan_func is None:
+        return lambda scan_func: pagescan_batch(
+            scan_func, streaming=streaming, time_budget=time_budget, tags=tags)
+
+    tag_pattern = compile_tag_pattern(tags) if tags is not None else None
+
+    def wrapper(request):
+
+        try:
+            params = get_request_params(
+                request, 'documents', raw_content_types=BATCH_CONTENT_TYPES)
+            documents = _get_batch_items(params, 'documents')
+        except RequestBodyError as error:
+            return HttpResponse(unicode(error), status=error.status)
+        client_req_time = params.get('client_start_time')
+
+        db_logger = DbLogger()
+        query_record = db_logger.log_query(request)
+
+        budget = time_budget if time_budget is not None else \
+            getattr(settings, 'SCAN_TIME_BUDGET', None)
+        scan_state = {}
+
+        def iter_results():
+
+            region_records = []
+            scanned_documents = {}
+            try:
+                with scan_deadline(budget) as deadline:
+                    scan_state['deadline'] = deadline
+                    for index, document_content in enumerate(documents):
+                        start_time = time.time()
+                        if document_content not in scanned_documents:
+                            scanned_documents[document_content] = [] if deadline.check() \
+                                else list(_scan_document(
+                                    scan_func, document_content, streaming, tag_pattern))
+                        packaged_regions = []
+                        for region, explanation in scanned_documents[document_content]:
+                            region_record = db_logger.make_region_record(
+                                request, query_record, region)
+                            region_records.append(region_record)
+                            packaged_regions.append(_package_region(
+                                region, explanation, region_record.id, query_record.id))
+                        yield (unicode(index), {
+                            'regions': packaged_regions,
+                            'truncated': deadline.truncated,
+                            'elapsed_time': time.time() - start_time,
+                        })
+            finally:
+                # As in `pagescan`, regions are logged even if the batch fails part way
+                db_logger.save_region_records(region_records)
+                db_logger.update_server_end_time(query_record)
+
+        return _make_json_response([
+            ('results', _JsonObject(iter_results())),
+            ('client_query_url', _get_resource_url(request, "/api/v1/client_query/")),
+            ('view_url', _get_resource_url(request, "/api/v1/view/")),
+            ('query_id', unicode(query_record.id)),
+            ('client_start_time', client_req_time),
+            ('truncated', lambda: scan_state['deadline'].truncated),
+            ('elapsed_time', lambda: scan_state['deadline'].elapsed_time),
+        ])
+
+    return compress_response(wrapper)
+
+
+def snippetexplain_batch(explain_func):
+    '''
+    A wrapper around 'explaining' views for many snippets at once.  The snippets are
+    sent in the `texts` parameter as a JSON array of strings (or as a raw JSON body).
+    Identical snippets are only explained once, and all snippets are logged under one
+    query.  The response has the same fields as a `snippetexplain` response, except
+    that instead of `region`, it has `regions`: an object from the index of each snippet
+    in the batch to its explained region.
+    '''
+    def wrapper(request):
+
+        try:
+            params = get_request_params(request, 'texts', raw_content_types=BATCH_CONTENT_TYPES)
+            texts = _get_batch_items(params, 'texts')
+        except RequestBodyError as error:
+            return HttpResponse(unicode(error), status=error.status)
+        client_start_time = params.get('client_start_time')
+        edge_size = int(params.get('edge_size', 0))
+
+        db_logger = DbLogger()
+        query_record = db_logger.log_query(request)
+
+        explained_texts = {}
+        for text in texts:
+            if text not in explained_texts:
+                region = Region(HtmlDocument(text), 0, len(text) - 1, text)
+                explained_texts[text] = (region, explain_func(text, edge_size))
+        regions = [explained_texts[text][0] for text in texts]
+        region_records = db_logger.log_regions(request, query_record, regions)
+        explained_regions = [
+            (unicode(index), _package_region(
+                explained_texts[text][0], explained_texts[text][1],
+                region_record.id, query_record.id))
+            for index, (text, region_record) in enumerate(zip(texts, region_records))
+        ]
+
+        # Update the runtime of the scan
+        db_logger.update_server_end_time(query_record)
+
+        return _make_json_response([
+            ("regions", _JsonObject(explained_regions)),
+            ("url", _get_resource_url(request, "/api/v1/client_query/")),
+            ("sq_id", unicode(query_record.id)),
+            ("client_start_time", client_start_time),
+            ("error", 0),
+        ])
 
-    return wrapper
+    return compress_response(wrapper)
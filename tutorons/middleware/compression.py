@@ -0,0 +1,238 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import re
+import time
+import zlib
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import decorator_from_middleware
+
+from tutorons.core.metrics import counters
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVELS = {
+    'br': 4,
+    'zstd': 3,
+    'gzip': 6,
+}
+DEFAULT_STREAM_FLUSH_SIZE = 4096
+DEFAULT_STREAM_FLUSH_INTERVAL = 0.2
+COMPRESSIBLE_CONTENT_TYPE = re.compile(
+    r'^(text/|application/(json|javascript|xml)|application/[\w.+-]+\+(json|xml))')
+
+
+class _GzipCompressor(object):
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor(object):
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _ZstdCompressor(object):
+
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def get_available_encodings():
+    ''' Get the content encodings this server can compress with, from most to least preferred. '''
+    encodings = []
+    if brotli is not None:
+        encodings.append(('br', _BrotliCompressor))
+    if zstandard is not None:
+        encodings.append(('zstd', _ZstdCompressor))
+    encodings.append(('gzip', _GzipCompressor))
+    return encodings
+
+
+def parse_accept_encoding(header):
+    ''' Get a dictionary from each encoding in an Accept-Encoding header to its quality. '''
+    qualities = {}
+    for part in header.split(','):
+        params = part.strip().split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[encoding] = quality
+    return qualities
+
+
+def choose_encoding(header, encodings):
+    '''
+    Choose the encoding to compress a response with, given the request's Accept-Encoding
+    header and a list of the (name, compressor class) pairs the server supports, in
+    order of preference.  Returns the pair, or None if the client accepts none of them.
+    '''
+    qualities = parse_accept_encoding(header)
+    default_quality = qualities.get('*', 0.0)
+    accepted = [
+        (qualities.get(name, default_quality), -i, (name, compressor_class))
+        for i, (name, compressor_class) in enumerate(encodings)
+    ]
+    accepted = [a for a in accepted if a[0] > 0]
+    if not accepted:
+        return None
+    return max(accepted)[2]
+
+
+class CompressionMiddleware(object):
+    '''
+    Compresses responses with the best encoding that both the client and the server
+    support: brotli or zstd, if their packages are installed, or gzip.  Responses
+    smaller than the COMPRESSION_MIN_SIZE setting (in bytes) aren't compressed.
+    Each encoding is compressed at the level in the COMPRESSION_LEVELS setting.
+
+    Streamed responses are compressed one piece at a time.  Pieces are flushed to the
+    client once COMPRESSION_STREAM_FLUSH_SIZE bytes of them have been compressed, or
+    once COMPRESSION_STREAM_FLUSH_INTERVAL seconds have passed since the last flush, so
+    that the client can read them before the rest of the response is ready.  Every
+    flush makes the response bigger, so small pieces aren't flushed one at a time.
+
+    This middleware only changes the body of a response, and the Content-Encoding,
+    Content-Length, ETag, and Vary headers, so the headers added by the CORS middleware
+    are kept.  Strong ETags get a suffix with the encoding, as the compressed bytes
+    differ from the raw ones.  Weak ETags are kept as they are: they only promise an
+    equivalent response, which a compressed one is, and a response to a conditional
+    request (which isn't compressed) can then send the same ETag as the response whose
+    results the client has.
+
+    Only the responses of the views that scan and explain are worth compressing, so
+    instead of listing this middleware in MIDDLEWARE_CLASSES, which would compress every
+    response on the site, wrap those views with `compress_response`.  The `pagescan` and
+    `snippetexplain` wrappers (and their batch versions) already do.
+
+    The raw and compressed sizes of responses are counted in
+    `tutorons.core.metrics.counters`.
+    '''
+
+    def process_response(self, request, response):
+
+        if response.has_header('Content-Encoding'):
+            return response
+        if not COMPRESSIBLE_CONTENT_TYPE.match(response.get('Content-Type', '')):
+            return response
+        min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE)
+        if not response.streaming and len(response.content) < min_size:
+            return response
+
+        # The response depends on the encodings the client accepts, even if it isn't
+        # compressed for this one.
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = choose_encoding(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''), get_available_encodings())
+        if encoding is None:
+            return response
+
+        name, compressor_class = encoding
+        levels = getattr(settings, 'COMPRESSION_LEVELS', DEFAULT_LEVELS)
+        compressor = compressor_class(levels.get(name, DEFAULT_LEVELS[name]))
+
+        if response.streaming:
+            response.streaming_content = self._compress_stream(
+                response.streaming_content, compressor, name)
+            if response.has_header('Content-Length'):
+                del response['Content-Length']
+        else:
+            content = response.content
+            compressed_content = compressor.compress(content) + compressor.finish()
+            if len(compressed_content) >= len(content):
+                return response
+            response.content = compressed_content
+            response['Content-Length'] = str(len(compressed_content))
+            self._count(name, len(content), len(compressed_content))
+
+        # Compressed responses are different representations, so they need different
+        # strong ETags
+        if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+            response['ETag'] = re.sub(r'"$', ';%s"' % name, response['ETag'])
+        response['Content-Encoding'] = name
+        return response
+
+    def _compress_stream(self, chunks, compressor, name):
+        flush_size = getattr(settings, 'COMPRESSION_STREAM_FLUSH_SIZE', DEFAULT_STREAM_FLUSH_SIZE)
+        flush_interval = getattr(
+            settings, 'COMPRESSION_STREAM_FLUSH_INTERVAL', DEFAULT_STREAM_FLUSH_INTERVAL)
+        raw_size = 0
+        compressed_size = 0
+        unflushed_size = 0
+        flush_time = time.time()
+        for chunk in chunks:
+            raw_size += len(chunk)
+            unflushed_size += len(chunk)
+            compressed_chunk = compressor.compress(chunk)
+            if unflushed_size >= flush_size or time.time() - flush_time >= flush_interval:
+                compressed_chunk += compressor.flush()
+                unflushed_size = 0
+                flush_time = time.time()
+            if compressed_chunk:
+                compressed_size += len(compressed_chunk)
+                yield compressed_chunk
+        last_chunk = compressor.finish()
+        compressed_size += len(last_chunk)
+        self._count(name, raw_size, compressed_size)
+        yield last_chunk
+
+    def _count(self, name, raw_size, compressed_size):
+        counters.increment('compressed_responses_' + name)
+        counters.increment('compression_raw_bytes', raw_size)
+        counters.increment('compression_compressed_bytes', compressed_size)
+
+
+# Decorator that compresses the responses of one view with `CompressionMiddleware`
+compress_response = decorator_from_middleware(CompressionMiddleware)
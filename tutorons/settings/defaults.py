@@ -27,6 +27,55 @@ except Exception as e:
         "If that's what you're doing right now, then kudos!\n")
 CORS_ORIGIN_ALLOW_ALL = True  # We're okay accepting connections from anywhere
 
+# Scanning
+# Backend that BeautifulSoup uses to parse pages (e.g., 'html5lib', 'lxml', 'html.parser').
+# Other backends are faster than html5lib, but can change the positions of regions.
+# Run `python manage.py compareparsers <pages>` before switching to one of them.
+HTML_PARSER = 'html5lib'
+# Parsed pages are kept in memory so that pages that are posted again aren't parsed again.
+# This limits the memory (in bytes) that each process uses for the pages kept.  A parsed
+# page takes up about 100 times as much memory as its HTML, so this keeps about 1.3MB of HTML.
+PARSED_DOCUMENT_CACHE_SIZE = 128 * 1024 * 1024
+
+# Number of seconds a 'scan' request can spend finding regions before it stops and
+# returns the regions found so far.  Modules can override this with
+# `@pagescan(time_budget=...)`.  Set to None to let scans take as long as they need.
+SCAN_TIME_BUDGET = 5.0
+
+# Number of spaces to indent JSON responses with.  If None, responses are compact, and
+# responses to 'scan' requests are streamed to the client as regions are explained.
+API_JSON_INDENT = None
+
+# Responses to 'scan' and 'explain' requests are compressed with brotli ('br') or zstd if
+# their packages are installed and the client accepts them, or else gzip.  Responses
+# smaller than COMPRESSION_MIN_SIZE bytes aren't compressed.  Higher levels compress more,
+# but take longer.
+COMPRESSION_MIN_SIZE = 1024
+# Streamed responses are flushed to the client once this many bytes of them have been
+# compressed, or once this many seconds have passed since the last flush.
+COMPRESSION_STREAM_FLUSH_SIZE = 4096
+COMPRESSION_STREAM_FLUSH_INTERVAL = 0.2
+COMPRESSION_LEVELS = {
+    'br': 4,
+    'zstd': 3,
+    'gzip': 6,
+}
+
+# Largest request body (in bytes, after it's decompressed) that 'scan' and 'explain'
+# requests can send.  Larger requests are refused with a 413 status.
+MAX_REQUEST_BODY_SIZE = 20 * 1024 * 1024
+
+# Most documents or snippets that one batch 'scan' or 'explain' request can send.
+MAX_BATCH_SIZE = 100
+
+# Logging
+# If true, queries and regions are saved to the database by a background thread after
+# the response is sent, instead of before.  Records are saved in batches of up to
+# DB_LOG_BATCH_SIZE records, at most DB_LOG_FLUSH_INTERVAL seconds after they're logged.
+DB_LOG_ASYNC = False
+DB_LOG_BATCH_SIZE = 200
+DB_LOG_FLUSH_INTERVAL = 1.0
+
 # Application definition
 
 INSTALLED_APPS = (
@@ -66,6 +115,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Tests use a file instead of an in-memory database, so that the background
+        # thread that saves logs (see DB_LOG_ASYNC) sees the same database as the tests.
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
     }
 }
 
@@ -5,6 +5,9 @@ DEBUG = True
 TEMPLATE_DEBUG = True
 ALLOWED_HOSTS = []
 
+# Pretty-print responses, so they're easier to read while debugging
+API_JSON_INDENT = 2
+
 # Emulate an SSL server on localhost
 INSTALLED_APPS += (
     "sslserver",